@@ -29,11 +29,14 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 
-from obspy.core import read, UTCDateTime, util
+from obspy.core import read, UTCDateTime
 from obspy.iris import Client
 from obspy.signal import cross_correlation, pazToFreqResp, invsim
 from obspy.taup import taup
 
+from geometry import geometry_event
+from resp_paz import resp_paz
+
 
 ########################################################################
 ############################# Main Program #############################
@@ -378,14 +381,15 @@ def single_comparison():
     ls_first = glob.glob(os.path.join(input['first_path'], identity_all))
     ls_second = glob.glob(os.path.join(input['second_path'], identity_all))
     
+    if input['phase'] != 'N':
+        dist_all = geometry_files(ls_first)
+    
     for i in range(0, len(ls_first)):
         try:
             tr1 = read(ls_first[i])[0]
     
             if input['phase'] != 'N':
-                evsta_dist = util.locations2degrees(lat1 = tr1.stats.sac.evla, \
-                                        long1 = tr1.stats.sac.evlo, lat2 = tr1.stats.sac.stla, \
-                                        long2 = tr1.stats.sac.stlo)
+                evsta_dist = dist_all[ls_first[i]]
                 
                 taup_tt = taup.getTravelTimes(delta = evsta_dist, depth = tr1.stats.sac.evdp)
                 
@@ -418,7 +422,7 @@ def single_comparison():
                 response_file = os.path.join(input['first_path'], '..', 'Resp/RESP.' + identity)
                 
                 # Extract the PAZ info from response file
-                paz = readRESP(response_file, unit = input['corr_unit'])
+                paz = resp_paz(response_file, unit = input['corr_unit'])
                 
                 poles = paz['poles']
                 zeros = paz['zeros']
@@ -699,6 +703,11 @@ def cross_corr(max_ts = 5.):
     cc_open.writelines(str(len(ls_first)) + ',\n')
     cc_open.close()
     
+    # geometry of all the waveforms before the (parallel) jobs
+    dist_all = {}
+    if input['phase'] != 'N':
+        dist_all = geometry_files(ls_first)
+    
     if input['cc_parallel'] == 'Y':
         # Parallel Cross Correlation
         import pprocess
@@ -715,6 +724,7 @@ def cross_corr(max_ts = 5.):
         for i in range(0, len(ls_first)):
             parallel_job(ls_first = ls_first[i], ls_second = ls_second, \
                             identity_all = identity_all, max_ts = max_ts,
+                            evsta_dist = dist_all.get(ls_first[i]),
                             print_sta = str(i+1) + '/' + str(len(ls_first)))        
         
         parallel_results.finish()
@@ -724,15 +734,17 @@ def cross_corr(max_ts = 5.):
         #for i in range(0, 20):
             cc_core(ls_first = ls_first[i], ls_second = ls_second, \
                             identity_all = identity_all, max_ts = max_ts,
+                            evsta_dist = dist_all.get(ls_first[i]),
                             print_sta = str(i+1) + '/' + str(len(ls_first)))
 
 ###################### cc_core #########################################
 
-def cc_core(ls_first, ls_second, identity_all, max_ts, print_sta):
+def cc_core(ls_first, ls_second, identity_all, max_ts, print_sta, \
+                                                        evsta_dist = None):
     
     """
     Perform the main part of the cross correlation and creating 
-    the cc.txt file
+    the cc.txt file (evsta_dist: epicentral distance of the waveform)
     """
     
     global input
@@ -744,10 +756,6 @@ def cc_core(ls_first, ls_second, identity_all, max_ts, print_sta):
         tr1 = read(ls_first)[0]
             
         if input['phase'] != 'N':
-            evsta_dist = util.locations2degrees(lat1 = tr1.stats.sac.evla, \
-                                    long1 = tr1.stats.sac.evlo, lat2 = tr1.stats.sac.stla, \
-                                    long2 = tr1.stats.sac.stlo)
-            
             taup_tt = taup.getTravelTimes(delta = evsta_dist, depth = tr1.stats.sac.evdp)
             
             phase_exist = 'N'
@@ -857,6 +865,48 @@ def cc_core(ls_first, ls_second, identity_all, max_ts, print_sta):
         print error
         print '##################'
 
+###################### geometry_files ##################################
+
+def geometry_files(ls_files):
+    
+    """
+    Epicentral distance of all the waveforms of the first path,
+    computed once per event (cached in the info folder of the event
+    with the SEED identities: net.sta.loc.cha).
+    Returns {waveform: distance}
+    """
+    
+    global input
+    
+    address_info = os.path.normpath(os.path.join(input['first_path'], \
+                                                        '..', 'info'))
+    # {(evla, evlo): [[waveform], [id], [stla], [stlo]]}
+    events = {}
+    for ls_file in ls_files:
+        try:
+            tr = read(ls_file, headonly=True)[0]
+        except Exception, error:
+            print 'Could not read the header of %s: %s' %(ls_file, error)
+            continue
+        ev_key = (tr.stats.sac.evla, tr.stats.sac.evlo)
+        if not ev_key in events:
+            events[ev_key] = [[], [], [], []]
+        events[ev_key][0].append(ls_file)
+        events[ev_key][1].append(tr.stats.network + '.' + \
+                    tr.stats.station + '.' + tr.stats.location + '.' + \
+                    tr.stats.channel)
+        events[ev_key][2].append(tr.stats.sac.stla)
+        events[ev_key][3].append(tr.stats.sac.stlo)
+    
+    dist_all = {}
+    for ev_key in events:
+        ev_files, sta_id, sta_lat, sta_lon = events[ev_key]
+        dist = geometry_event(address_info, ev_key[0], ev_key[1], \
+                                            sta_id, sta_lat, sta_lon)[0]
+        for k in range(0, len(ev_files)):
+            dist_all[ev_files[k]] = dist[k]
+    return dist_all
+
 ###################### read_cc #########################################
 
 def read_cc(max_coeff = 0.99, width = 0.001, max_ts = 5.):
@@ -927,111 +977,6 @@ def read_cc(max_coeff = 0.99, width = 0.001, max_ts = 5.):
     
     plt.show()
 
-###################### readRESP ########################################
-
-def readRESP(resp_file, unit):
-
-    resp_open = open(resp_file)
-    resp_read = resp_open.readlines()
-    
-    check_resp = []
-    
-    for resp_line in resp_read:
-        if "velocity in meters per second" in resp_line.lower() or \
-            "velocity in meters/second" in resp_line.lower() or \
-            "m/s -" in resp_line.lower():
-            check_resp.append('M/S')
-        
-        elif "m/s**2 - acceleration" in resp_line.lower():
-            check_resp.append('M/S**2')
-    
-    if check_resp == []:
-        print '\n*****************************************************'
-        print 'The response file is not in the right dimension (M/S)'
-        print 'This could cause problems in the instrument correction.'
-        print 'Please check the response file:'
-        print resp_file
-        print '*****************************************************'
-        sys.exit()
-    
-    gain_num = []
-    A0_num = []
-    poles_num = []
-    poles = []
-    zeros = []
-    zeros_num = []
-    #if clients == 'iris':
-    if resp_read[0].find('obspy.xseed') == -1:
-        for i in range(0, len(resp_read)):
-            if resp_read[i].find('B058F04') != -1:  
-                gain_num.append(i)
-            if resp_read[i].find('B053F07') != -1:  
-                A0_num.append(i)
-            if resp_read[i].find('B053F10-13') != -1:  
-                zeros_num.append(i)
-            if resp_read[i].find('B053F15-18') != -1:  
-                poles_num.append(i)
-                
-    #elif clients == 'arc':
-    elif resp_read[0].find('obspy.xseed') != -1:
-        for i in range(0, len(resp_read)):
-            if resp_read[i].find('B058F04') != -1:  
-                gain_num.append(i)
-            if resp_read[i].find('B043F08') != -1:  
-                A0_num.append(i)
-            if resp_read[i].find('B043F11-14') != -1:  
-                zeros_num.append(i)
-            if resp_read[i].find('B043F16-19') != -1:  
-                poles_num.append(i)
-        
-    list_sensitivity = resp_read[gain_num[-1]].split('\n')[0].split(' ')
-    list_new_sensitivity = [x for x in list_sensitivity if x]
-    sensitivity = eval(list_new_sensitivity[-1])
-    
-    list_A0 = resp_read[A0_num[0]].split('\n')[0].split(' ')
-    list_new_A0 = [x for x in list_A0 if x]
-    A0 = eval(list_new_A0[-1])
-
-    
-    for i in range(0, len(poles_num)):
-        
-        list_poles = resp_read[poles_num[i]].split('\n')[0].split(' ')
-        list_new_poles = [x for x in list_poles if x]
-        
-        poles_r = eval(list_new_poles[-4])
-        poles_i = eval(list_new_poles[-3])
-        poles.append(complex(poles_r, poles_i))
-    
-    for i in range(0, len(zeros_num)):
-        
-        list_zeros = resp_read[zeros_num[i]].split('\n')[0].split(' ')
-        list_new_zeros = [x for x in list_zeros if x]
-        
-        zeros_r = eval(list_new_zeros[-4])
-        zeros_i = eval(list_new_zeros[-3])
-        zeros.append(complex(zeros_r, zeros_i))
-            
-    if check_resp[0] == 'M/S':
-        if unit.lower() == 'dis':
-            zeros.append(0j)
-        #if unit.lower() == 'vel':
-        #    zeros = [0j, 0j]
-        #if unit.lower() == 'acc':
-        #    zeros = [0j]
-    elif check_resp[0] == 'M/S**2':
-        if unit.lower() == 'dis':
-            zeros.append(0j)
-            zeros.append(0j)
-    
-    paz = {\
-    'poles': poles,
-    'zeros': zeros,
-    'gain': A0,
-    'sensitivity': sensitivity\
-    }
- 
-    return paz
-
 ########################################################################
 ########################################################################
 ########################################################################
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------
+#   Filename:  dir_index.py
+#   Purpose:   persisted index of the folders of an obspyDMT archive,
+#              validated by the modification time of the folders
+#   Author:    Kasra Hosseini
+#   Email:     hosseini@geophysik.uni-muenchen.de
+#   License:   GPLv3
+#-------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+#----------------Import required Modules (Python and Obspy)-------------
+#-----------------------------------------------------------------------
+
+# Added this line for python 2.5 compatibility
+from __future__ import with_statement
+import os
+import time
+import fnmatch
+import json
+
+# name of the index file in the root folder
+index_name = '.obspyDMT_index'
+# smaller trees are just walked (no index file)
+index_min_dirs = 50
+# folders modified less than index_lag seconds before the index was
+# saved are listed again (coarse mtime resolution, eg: NFS)
+index_lag = 2.0
+
+########################################################################
+###################### Functions are defined here ######################
+########################################################################
+
+###################### locate_index ####################################
+
+def locate_index(root = '.', target = 'info'):
+
+    """
+    Same as locate (all the subdirectories of root with the name target)
+    but based on an index of the tree saved in root.
+    The index keeps the modification time and the subfolders of every
+    folder (relative to root): only the folders that changed since the
+    last call are listed again, the whole tree is walked only if there
+    is no (valid) index.
+    """
+
+    index_file = os.path.join(root, index_name)
+
+    dirs = None
+    t_index = 0
+    if os.path.isfile(index_file):
+        dirs, t_index = index_load(index_file)
+
+    t_scan = time.time()
+    if dirs == None:
+        index_new = False
+        if os.path.isdir(root) and not os.path.isfile(index_file):
+            # the index file is created before the scan, so that writing
+            # it later does not change the mtime of the root folder
+            try:
+                open(index_file, 'a').close()
+                index_new = True
+            except Exception, e:
+                pass
+        dirs = {}
+        dir_scan(root, '', dirs)
+        changed = True
+        if index_new and len(dirs) < index_min_dirs:
+            # small tree: no index
+            try:
+                os.remove(index_file)
+            except Exception, e:
+                pass
+    else:
+        changed = dir_validate(root, dirs, t_index)
+
+    if changed and len(dirs) >= index_min_dirs and \
+                                        os.path.isfile(index_file):
+        try:
+            # written in place, the mtime of the root does not change
+            index_open = open(index_file, 'r+b')
+            index_open.truncate()
+            json.dump({'time': t_scan, 'dirs': dirs}, index_open)
+            index_open.close()
+        except Exception, e:
+            pass
+
+    matches = []
+    for path in sorted(dirs.keys()):
+        for dirname in fnmatch.filter(dirs[path][1], target):
+            matches.append(os.path.join(root, path, dirname))
+    return matches
+
+###################### index_load ######################################
+
+def index_load(index_file):
+
+    """
+    Reads the index file (JSON: the index is in the archive and could be
+    written by other users, nothing is executed while reading it).
+    Returns (dirs, time of the index) or (None, 0) if it is not valid.
+    """
+
+    try:
+        index_open = open(index_file, 'rb')
+        index = json.load(index_open)
+        index_open.close()
+        dirs = {}
+        for path, (mtime, subdirs) in index['dirs'].items():
+            dirs[index_str(path)] = (float(mtime), \
+                                    [index_str(x) for x in subdirs])
+        return dirs, float(index['time'])
+    except Exception, e:
+        return None, 0
+
+###################### index_str #######################################
+
+def index_str(name):
+
+    """
+    Name of a folder read from the index (JSON strings are unicode)
+    """
+
+    if isinstance(name, unicode):
+        return name.encode('utf-8')
+    return str(name)
+
+###################### dir_scan ########################################
+
+def dir_scan(root, path, dirs):
+
+    """
+    Walks the tree of root/path (like os.walk, symbolic links are not
+    followed) and adds (mtime, subfolders) of every folder to dirs.
+    """
+
+    stack = [path]
+    while stack:
+        path = stack.pop()
+        path_full = os.path.join(root, path)
+        try:
+            # mtime before the listing: changes during the listing are
+            # found in the next call
+            mtime = os.stat(path_full).st_mtime
+            names = os.listdir(path_full)
+        except OSError:
+            continue
+        subdirs = []
+        for name in names:
+            if os.path.isdir(os.path.join(path_full, name)):
+                subdirs.append(name)
+                if not os.path.islink(os.path.join(path_full, name)):
+                    stack.append(os.path.join(path, name))
+        dirs[path] = (mtime, sorted(subdirs))
+
+###################### dir_remove ######################################
+
+def dir_remove(path, dirs):
+
+    """
+    Removes a folder and all its subfolders from dirs
+    """
+
+    if not path:
+        dirs.clear()
+        return
+    for path_rm in [p for p in dirs if p == path or \
+                                    p.startswith(path + os.sep)]:
+        del dirs[path_rm]
+
+###################### dir_validate ####################################
+
+def dir_validate(root, dirs, t_index):
+
+    """
+    Checks the mtime of all the folders in dirs and lists again only
+    the folders that changed; returns True if dirs has been changed.
+    """
+
+    changed = False
+    for path in sorted(dirs.keys()):
+        if not path in dirs:
+            # removed together with its parent folder
+            continue
+        mtime, subdirs = dirs[path]
+        path_full = os.path.join(root, path)
+        try:
+            mtime_now = os.stat(path_full).st_mtime
+        except OSError:
+            dir_remove(path, dirs)
+            changed = True
+            continue
+        if mtime_now == mtime and mtime < t_index - index_lag:
+            continue
+        try:
+            names = os.listdir(path_full)
+        except OSError:
+            dir_remove(path, dirs)
+            changed = True
+            continue
+        subdirs_now = sorted([name for name in names \
+                        if os.path.isdir(os.path.join(path_full, name))])
+        for name in subdirs:
+            if not name in subdirs_now:
+                dir_remove(os.path.join(path, name), dirs)
+        for name in subdirs_now:
+            if not name in subdirs and \
+                    not os.path.islink(os.path.join(path_full, name)):
+                dir_scan(root, os.path.join(path, name), dirs)
+        dirs[path] = (mtime_now, subdirs_now)
+        changed = True
+    return changed
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------
+#   Filename:  event_table.py
+#   Purpose:   columnar event table (NumPy structured array) used by
+#              obspyDMT to handle and store the event catalogs
+#   Author:    Kasra Hosseini
+#   Email:     hosseini@geophysik.uni-muenchen.de
+#   License:   GPLv3
+#-------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+#----------------Import required Modules (Python and Obspy)-------------
+#-----------------------------------------------------------------------
+
+# Added this line for python 2.5 compatibility
+from __future__ import with_statement
+import os
+
+import numpy as np
+from obspy.core import UTCDateTime
+
+from geometry import locations2degrees_array
+
+# one row per event, times are POSIX timestamps (UTC)
+event_dtype = np.dtype([('event_id', 'S64'), ('origin_id', 'S128'),
+                        ('author', 'S64'), ('datetime', 'f8'),
+                        ('latitude', 'f8'), ('longitude', 'f8'),
+                        ('depth', 'f8'), ('magnitude', 'f8'),
+                        ('magnitude_type', 'S16'), ('flynn_region', 'S64'),
+                        ('t1', 'f8'), ('t2', 'f8')])
+
+# columns that are UTCDateTime in the list of events
+event_times = ['datetime', 't1', 't2']
+
+########################################################################
+###################### Functions are defined here ######################
+########################################################################
+
+###################### event_row #######################################
+
+def event_row(event_id = '', origin_id = '', author = '',
+                datetime = None, latitude = None, longitude = None,
+                depth = None, magnitude = None, magnitude_type = '',
+                flynn_region = '', t1 = None, t2 = None):
+
+    """
+    One row (tuple) of the event table, missing values are NaN or ''
+    """
+
+    row = []
+    for value, column in [(event_id, 'event_id'), (origin_id, 'origin_id'),
+                    (author, 'author'), (datetime, 'datetime'),
+                    (latitude, 'latitude'), (longitude, 'longitude'),
+                    (depth, 'depth'), (magnitude, 'magnitude'),
+                    (magnitude_type, 'magnitude_type'),
+                    (flynn_region, 'flynn_region'), (t1, 't1'), (t2, 't2')]:
+        if column in event_times:
+            if value is None:
+                value = np.nan
+            else:
+                value = UTCDateTime(value).timestamp
+        elif event_dtype[column].kind == 'f':
+            try:
+                value = float(value)
+            except Exception, e:
+                value = np.nan
+        else:
+            if value is None:
+                value = ''
+            elif isinstance(value, unicode):
+                value = value.encode('ascii', 'replace')
+            else:
+                value = str(value)
+        row.append(value)
+    return tuple(row)
+
+###################### events_table ####################################
+
+def events_table(events):
+
+    """
+    Converts a list of events (dictionaries) to the event table
+    """
+
+    rows = []
+    for event in events:
+        kwargs = {}
+        for column in event_dtype.names:
+            kwargs[column] = event.get(column)
+        rows.append(event_row(**kwargs))
+    return np.array(rows, dtype = event_dtype)
+
+###################### events_list #####################################
+
+def events_list(table):
+
+    """
+    Converts the event table to a list of events (dictionaries),
+    as used in obspyDMT (compatibility accessor)
+    """
+
+    events = []
+    for row in table.tolist():
+        event = dict(zip(event_dtype.names, row))
+        for column in event_times:
+            if np.isnan(event[column]):
+                event[column] = None
+            else:
+                event[column] = UTCDateTime(event[column])
+        events.append(event)
+    return events
+
+###################### events_table_concat #############################
+
+def events_table_concat(tables):
+
+    """
+    Concatenates a list of event tables
+    """
+
+    tables = [table for table in tables if table is not None]
+    if not tables:
+        return np.zeros(0, dtype = event_dtype)
+    return np.concatenate(tables)
+
+###################### events_table_unique #############################
+
+def events_table_unique(table):
+
+    """
+    Removes the repeated events (same origin_id, or event_id if there is
+    no origin_id) and sorts the events by time
+    """
+
+    if len(table) == 0:
+        return table
+    key = np.where(table['origin_id'] != '', table['origin_id'],
+                                                table['event_id'])
+    key_uniq, num_uniq = np.unique(key, return_index = True)
+    table = table[np.sort(num_uniq)]
+    return table[np.argsort(table['datetime'], kind = 'mergesort')]
+
+###################### events_table_select #############################
+
+def events_table_select(table, params, min_date, max_date):
+
+    """
+    Vectorized selection of the events that satisfy the request
+    parameters (params: refer to events_params in obspyDMT) and the
+    time window, returns the selected events (event table).
+    """
+
+    sel = (table['datetime'] >= UTCDateTime(min_date).timestamp) & \
+            (table['datetime'] <= UTCDateTime(max_date).timestamp)
+    sel &= (table['magnitude'] >= params['min_mag']) & \
+            (table['magnitude'] <= params['max_mag'])
+    # depths are negative downwards: min_depth is the shallowest one
+    sel &= (table['depth'] >= params['max_depth']) & \
+            (table['depth'] <= params['min_depth'])
+    sel &= (table['latitude'] >= params['evlatmin']) & \
+            (table['latitude'] <= params['evlatmax']) & \
+            (table['longitude'] >= params['evlonmin']) & \
+            (table['longitude'] <= params['evlonmax'])
+    if not (params['evradmin'] == 0.0 and params['evradmax'] == 180.0):
+        dist = locations2degrees_array(params['evlat'], params['evlon'],
+                                table['latitude'], table['longitude'])
+        sel &= (dist >= params['evradmin']) & (dist <= params['evradmax'])
+    return table[sel]
+
+###################### events_table_save ###############################
+
+def events_table_save(table, address):
+
+    """
+    Saves the event table in NumPy format (address),
+    it can be read back with events_table_load
+    """
+
+    table_tmp = address + '.' + str(os.getpid())
+    table_open = open(table_tmp, 'wb')
+    np.save(table_open, np.asarray(table, dtype = event_dtype))
+    table_open.close()
+    os.rename(table_tmp, address)
+
+###################### events_table_load ###############################
+
+def events_table_load(address, mmap_mode = 'r'):
+
+    """
+    Reads the event table saved by events_table_save, by default the
+    file is memory-mapped (mmap_mode = None to read it into memory).
+    """
+
+    return np.load(address, mmap_mode = mmap_mode)
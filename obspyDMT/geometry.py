@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------
+#   Filename:  geometry.py
+#   Purpose:   event-station geometry (distance, azimuth, back-azimuth)
+#              for obspyDMT, compareDMT and obspyDMT_managing_node
+#   Author:    Kasra Hosseini
+#   Email:     hosseini@geophysik.uni-muenchen.de
+#   License:   GPLv3
+#-------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+#----------------Import required Modules (Python and Obspy)-------------
+#-----------------------------------------------------------------------
+
+# Added this line for python 2.5 compatibility
+from __future__ import with_statement
+import os
+
+import numpy as np
+
+########################################################################
+###################### Functions are defined here ######################
+########################################################################
+
+###################### locations2degrees_array #########################
+
+def locations2degrees_array(lat1, long1, lat2, long2):
+
+    """
+    Same as locations2degrees but for NumPy arrays (or a mixture of
+    scalars and arrays), returns the great circle distance(s) in degrees.
+    """
+
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    long_diff = np.radians(long2) - np.radians(long1)
+    gd = np.degrees(np.arctan2(np.sqrt((np.cos(lat2) * \
+                np.sin(long_diff)) ** 2 + (np.cos(lat1) * np.sin(lat2) - \
+                np.sin(lat1) * np.cos(lat2) * np.cos(long_diff)) ** 2), \
+                np.sin(lat1) * np.sin(lat2) + np.cos(lat1) * np.cos(lat2) * \
+                np.cos(long_diff)))
+    return gd
+
+###################### azimuth_array ###################################
+
+def azimuth_array(lat1, long1, lat2, long2):
+
+    """
+    Azimuth(s) (deg, clockwise from north, 0-360) of the great circle
+    from point 1 to point 2 on a sphere, for NumPy arrays or scalars.
+    """
+
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    long_diff = np.radians(long2) - np.radians(long1)
+    az = np.degrees(np.arctan2(np.sin(long_diff) * np.cos(lat2), \
+                np.cos(lat1) * np.sin(lat2) - \
+                np.sin(lat1) * np.cos(lat2) * np.cos(long_diff)))
+    return np.mod(az, 360.)
+
+###################### evsta_geometry ##################################
+
+def evsta_geometry(ev_lat, ev_lon, sta_lat, sta_lon):
+
+    """
+    Epicentral distance, azimuth and back-azimuth (all in deg) for
+    all the event x station pairs.
+    Returns three arrays with the shape (number of events, number of
+    stations).
+    """
+
+    ev_lat = np.atleast_1d(np.asarray(ev_lat, dtype=float))[:, np.newaxis]
+    ev_lon = np.atleast_1d(np.asarray(ev_lon, dtype=float))[:, np.newaxis]
+    sta_lat = np.atleast_1d(np.asarray(sta_lat, dtype=float))[np.newaxis, :]
+    sta_lon = np.atleast_1d(np.asarray(sta_lon, dtype=float))[np.newaxis, :]
+
+    dist = locations2degrees_array(ev_lat, ev_lon, sta_lat, sta_lon)
+    az = azimuth_array(ev_lat, ev_lon, sta_lat, sta_lon)
+    baz = azimuth_array(sta_lat, sta_lon, ev_lat, ev_lon)
+    return dist, az, baz
+
+###################### geometry_read ###################################
+
+def geometry_read(address_info):
+
+    """
+    Reads the cached geometry of one event ("info/geometry.npz").
+    Returns None if there is no (readable) cache.
+    """
+
+    geo_file = os.path.join(address_info, 'geometry.npz')
+    if not os.path.isfile(geo_file):
+        return None
+    try:
+        geo_npz = np.load(geo_file)
+        geo = {}
+        for key in ['evla', 'evlo', 'id', 'stla', 'stlo', \
+                                            'dist', 'az', 'baz']:
+            geo[key] = geo_npz[key]
+        geo_npz.close()
+    except Exception, e:
+        print 'Could not read the geometry cache: %s' %(e)
+        return None
+    return geo
+
+###################### geometry_event ##################################
+
+def geometry_event(address_info, ev_lat, ev_lon, sta_id, sta_lat, sta_lon):
+
+    """
+    Epicentral distance, azimuth and back-azimuth of one event to all
+    the given stations (sta_id: net.sta.loc.cha).
+    The results are cached in "info/geometry.npz" of the event and only
+    the stations that are not in the cache (or have moved) are computed.
+    Returns (dist, az, baz) arrays in the same order as sta_id.
+    """
+
+    ev_lat = float(ev_lat)
+    ev_lon = float(ev_lon)
+    sta_id = [str(x) for x in sta_id]
+    sta_lat = np.asarray(sta_lat, dtype=float)
+    sta_lon = np.asarray(sta_lon, dtype=float)
+
+    dist = np.empty(len(sta_id))
+    az = np.empty(len(sta_id))
+    baz = np.empty(len(sta_id))
+
+    geo = None
+    if address_info and os.path.isdir(address_info):
+        geo = geometry_read(address_info)
+    if geo and not (np.isclose(geo['evla'], ev_lat) and \
+                                np.isclose(geo['evlo'], ev_lon)):
+        geo = None
+
+    cached = {}
+    if geo:
+        for k in range(0, len(geo['id'])):
+            cached[str(geo['id'][k])] = k
+
+    num_miss = []
+    for j in range(0, len(sta_id)):
+        k = cached.get(sta_id[j])
+        if k is not None and np.isclose(geo['stla'][k], sta_lat[j]) and \
+                                np.isclose(geo['stlo'][k], sta_lon[j]):
+            dist[j] = geo['dist'][k]
+            az[j] = geo['az'][k]
+            baz[j] = geo['baz'][k]
+        else:
+            num_miss.append(j)
+
+    if not num_miss:
+        return dist, az, baz
+
+    num_miss = np.array(num_miss)
+    dist_m, az_m, baz_m = evsta_geometry(ev_lat, ev_lon, \
+                                sta_lat[num_miss], sta_lon[num_miss])
+    dist[num_miss] = dist_m[0]
+    az[num_miss] = az_m[0]
+    baz[num_miss] = baz_m[0]
+
+    if address_info and os.path.isdir(address_info):
+        geo_new = {'id': [], 'stla': [], 'stlo': [], \
+                                'dist': [], 'az': [], 'baz': []}
+        sta_id_set = set(sta_id)
+        if geo:
+            for k in range(0, len(geo['id'])):
+                if str(geo['id'][k]) in sta_id_set:
+                    continue
+                for key in geo_new:
+                    geo_new[key].append(geo[key][k])
+        for j in range(0, len(sta_id)):
+            geo_new['id'].append(sta_id[j])
+            geo_new['stla'].append(sta_lat[j])
+            geo_new['stlo'].append(sta_lon[j])
+            geo_new['dist'].append(dist[j])
+            geo_new['az'].append(az[j])
+            geo_new['baz'].append(baz[j])
+        # write to a temporary file first: parallel jobs (pprocess) could
+        # update the same cache and should never see a half-written file
+        geo_tmp = os.path.join(address_info, \
+                                'geometry.npz.' + str(os.getpid()))
+        try:
+            geo_open = open(geo_tmp, 'wb')
+            np.savez(geo_open, evla = ev_lat, evlo = ev_lon, \
+                    id = np.array(geo_new['id']), \
+                    stla = np.array(geo_new['stla'], dtype=float), \
+                    stlo = np.array(geo_new['stlo'], dtype=float), \
+                    dist = np.array(geo_new['dist'], dtype=float), \
+                    az = np.array(geo_new['az'], dtype=float), \
+                    baz = np.array(geo_new['baz'], dtype=float))
+            geo_open.close()
+            os.rename(geo_tmp, os.path.join(address_info, 'geometry.npz'))
+        except Exception, e:
+            print 'Could not save the geometry cache: %s' %(e)
+
+    return dist, az, baz
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------
+#   Filename:  header_rebuild.py
+#   Purpose:   rebuild of the station_event files from the headers of
+#              the saved waveforms (parallel over files and events)
+#   Author:    Kasra Hosseini
+#   Email:     hosseini@geophysik.uni-muenchen.de
+#   License:   GPLv3
+#-------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+#----------------Import required Modules (Python and Obspy)-------------
+#-----------------------------------------------------------------------
+
+# Added this line for python 2.5 compatibility
+from __future__ import with_statement
+import os
+
+try:
+    import pprocess
+except Exception, e:
+    pprocess = None
+
+from metadata_db import db_channels_sync
+from waveform_volume import waveform_read, waveform_glob
+
+# number of waveforms per job
+rebuild_chunk = 200
+
+########################################################################
+###################### Functions are defined here ######################
+########################################################################
+
+###################### station_event_line ##############################
+
+def station_event_line(address_st, event_id):
+
+    """
+    Line of the station_event file for one waveform, only the header
+    of the waveform is read. Returns None if the file can not be read.
+    """
+
+    try:
+        sta_stats = waveform_read(address_st, headonly = True)[0].stats
+    except Exception, e:
+        print e
+        print 'could not read the waveform data: %s' %(address_st)
+        return None
+
+    try:
+        sta_info = sta_stats.network + ',' + sta_stats.station + ',' + \
+                    sta_stats.location + ',' + sta_stats.channel + ',' + \
+                    str(sta_stats.sac.stla) + ',' + str(sta_stats.sac.stlo) + ',' + \
+                    str(sta_stats.sac.stel) + ',' + str(sta_stats.sac.stdp) + ',' + \
+                    event_id + ',' + \
+                    str(sta_stats.sac.evla) + ',' + str(sta_stats.sac.evlo) + ',' + \
+                    str(sta_stats.sac.evdp) + ',' + str(sta_stats.sac.mag) + ',' + \
+                    'iris' + ',' + '\n'
+    except Exception, e:
+        sta_info = sta_stats.network + ',' + sta_stats.station + ',' + \
+                    sta_stats.location + ',' + sta_stats.channel + ',' + \
+                    str(-12345.0) + ',' + str(-12345.0) + ',' + \
+                    str(-12345.0) + ',' + str(-12345.0) + ',' + \
+                    event_id + ',' + \
+                    str(-12345.0) + ',' + str(-12345.0) + ',' + \
+                    str(-12345.0) + ',' + str(-12345.0) + ',' + \
+                    'iris' + ',' + '\n'
+    return sta_info
+
+###################### station_event_lines #############################
+
+def station_event_lines(ls_stas, event_id):
+
+    """
+    Lines of the station_event file for a list of waveforms (one job)
+    """
+
+    sta_lines = []
+    for address_st in ls_stas:
+        sta_info = station_event_line(address_st, event_id)
+        if sta_info:
+            sta_lines.append(sta_info)
+    return sta_lines
+
+###################### station_event_rebuild ###########################
+
+def station_event_rebuild(address_infos, num_proc = 1):
+
+    """
+    Creates the station_event files of a list of "info" folders from
+    the headers of the waveforms (BH_RAW or BH).
+    The waveforms of all the events are read in parallel (num_proc:
+    number of processes of the calling program, eg: --req_np)
+    and each station_event file is written at once.
+    """
+
+    jobs = []
+    for address in address_infos:
+        event_address = os.path.dirname(os.path.normpath(address))
+        if os.path.isdir(os.path.join(event_address, 'BH_RAW')):
+            sta_address = os.path.join(event_address, 'BH_RAW')
+        else:
+            sta_address = os.path.join(event_address, 'BH')
+        ls_stas = waveform_glob(sta_address)
+        print '%s: %s waveforms' %(event_address, len(ls_stas))
+        for k in range(0, len(ls_stas), rebuild_chunk):
+            jobs.append((address, ls_stas[k:k+rebuild_chunk], \
+                                    os.path.basename(event_address)))
+
+    if num_proc > 1 and len(jobs) > 1 and pprocess:
+        parallel_results = pprocess.Map(limit = num_proc)
+        parallel_job = parallel_results.manage(\
+                                pprocess.MakeParallel(station_event_lines))
+        for job in jobs:
+            parallel_job(job[1], job[2])
+        results = [sta_lines for sta_lines in parallel_results]
+    else:
+        results = [station_event_lines(job[1], job[2]) for job in jobs]
+
+    sta_ev = {}
+    for address in address_infos:
+        sta_ev[address] = []
+    for k in range(0, len(jobs)):
+        sta_ev[jobs[k][0]].extend(results[k])
+
+    for address in address_infos:
+        sta_file_open = open(os.path.join(address, 'station_event'), 'w')
+        sta_file_open.writelines(sta_ev[address])
+        sta_file_open.close()
+    # all the events in one transaction of the metadata catalog
+    db_channels_sync([os.path.dirname(os.path.normpath(x)) \
+                                                for x in address_infos])
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------
+#   Filename:  ic_manifest.py
+#   Purpose:   manifest of the corrected waveforms (hash of the raw
+#              waveform and response, correction parameters) to skip
+#              the waveforms that are up to date
+#   Author:    Kasra Hosseini
+#   Email:     hosseini@geophysik.uni-muenchen.de
+#   License:   GPLv3
+#-------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+#----------------Import required Modules (Python and Obspy)-------------
+#-----------------------------------------------------------------------
+
+# Added this line for python 2.5 compatibility
+from __future__ import with_statement
+import os
+import json
+import hashlib
+
+from waveform_volume import volume_name, volume_index, volume_bytes, \
+                        waveform_exists
+
+# name of the manifest in the folder of the corrected waveforms
+ic_manifest_name = '.obspyDMT_ic'
+
+########################################################################
+###################### Functions are defined here ######################
+########################################################################
+
+###################### ic_stat #########################################
+
+def ic_stat(address_st):
+
+    """
+    Key that changes when the content of a file (or of a waveform in the
+    volume) could have changed, None if it does not exist
+    """
+
+    try:
+        st_stat = os.stat(address_st)
+        return ('file', st_stat.st_mtime, st_stat.st_size)
+    except OSError:
+        pass
+    address_dir = os.path.dirname(address_st)
+    index = volume_index(address_dir)
+    if not os.path.basename(address_st) in index:
+        return None
+    # the volume is appended or rewritten (compacted) as a new file
+    volume_stat = os.stat(os.path.join(address_dir, volume_name))
+    return ('volume', volume_stat.st_ino) + \
+                                    tuple(index[os.path.basename(address_st)])
+
+###################### ic_hash #########################################
+
+def ic_hash(address_st, old = None):
+
+    """
+    (stat key, md5) of a file or of a waveform in the volume,
+    old: previous (stat key, md5), the content is only read again if
+    the stat key has changed. None if it does not exist.
+    """
+
+    key = ic_stat(address_st)
+    if key == None:
+        return None
+    if old and old[0] == key:
+        return old
+    if key[0] == 'file':
+        md5 = hashlib.md5()
+        st_open = open(address_st, 'rb')
+        while True:
+            st_block = st_open.read(1024**2)
+            if not st_block:
+                break
+            md5.update(st_block)
+        st_open.close()
+        return (key, md5.hexdigest())
+    return (key, hashlib.md5(volume_bytes(os.path.dirname(address_st), \
+                            os.path.basename(address_st))).hexdigest())
+
+###################### ic_tuple ########################################
+
+def ic_tuple(value):
+
+    """
+    Lists of a manifest read from JSON back to tuples (hashes, stat keys
+    and parameters are compared with tuples)
+    """
+
+    if isinstance(value, list):
+        return tuple([ic_tuple(x) for x in value])
+    if isinstance(value, dict):
+        return dict([(str(x), ic_tuple(value[x])) for x in value])
+    return value
+
+###################### ic_manifest_load ################################
+
+def ic_manifest_load(address_bh):
+
+    """
+    Manifest of a folder of corrected waveforms
+    {station_id: {'raw': hash, 'resp': hash, 'params': parameters}}
+    """
+
+    manifest_file = os.path.join(address_bh, ic_manifest_name)
+    if not os.path.isfile(manifest_file):
+        return {}
+    try:
+        # JSON: the manifest is in the archive, nothing is executed
+        manifest_open = open(manifest_file, 'rb')
+        manifest = ic_tuple(json.load(manifest_open))
+        manifest_open.close()
+    except Exception, e:
+        print 'Could not read the correction manifest: %s' %(e)
+        return {}
+    return manifest
+
+###################### ic_manifest_save ################################
+
+def ic_manifest_save(address_bh, manifest):
+
+    """
+    Saves the manifest of a folder of corrected waveforms
+    """
+
+    manifest_file = os.path.join(address_bh, ic_manifest_name)
+    manifest_tmp = manifest_file + '.' + str(os.getpid())
+    try:
+        manifest_open = open(manifest_tmp, 'wb')
+        json.dump(manifest, manifest_open)
+        manifest_open.close()
+        os.rename(manifest_tmp, manifest_file)
+    except Exception, e:
+        print 'Could not save the correction manifest: %s' %(e)
+
+###################### ic_entry ########################################
+
+def ic_entry(address_st, resp_file, params, old = None):
+
+    """
+    Entry of the manifest for a raw waveform, its response file and
+    the correction parameters (old: previous entry)
+    """
+
+    if not old:
+        old = {'raw': None, 'resp': None}
+    return {'raw': ic_hash(address_st, old['raw']),
+            'resp': ic_hash(resp_file, old['resp']),
+            'params': params}
+
+###################### ic_same #########################################
+
+def ic_same(entry, old):
+
+    """
+    True if the raw waveform, the response file and the parameters
+    of the two entries are the same
+    """
+
+    if not old or not entry['raw']:
+        return False
+    return entry['params'] == old['params'] and \
+            entry['raw'][1] == old['raw'][1] and \
+            (entry['resp'] and entry['resp'][1]) == \
+            (old['resp'] and old['resp'][1])
+
+###################### ic_pending ######################################
+
+def ic_pending(address_bh, ls_stas, resp_files, corr_files, params, \
+                                                            force = False):
+
+    """
+    Waveforms (ls_stas) that have to be corrected: new, changed (raw
+    waveform or response file), other parameters or the corrected
+    waveform (corr_files) does not exist any more (all if force).
+    Returns the waveforms and their new entries {station_id: entry}.
+    """
+
+    manifest = ic_manifest_load(address_bh)
+    changed = False
+    ls_pending = []
+    entries = {}
+    for k in range(0, len(ls_stas)):
+        station_id = os.path.basename(ls_stas[k])
+        old = manifest.get(station_id)
+        entry = ic_entry(ls_stas[k], resp_files[k], params, old)
+        if force or not ic_same(entry, old) or \
+                                    not waveform_exists(corr_files[k]):
+            ls_pending.append(ls_stas[k])
+            entries[station_id] = entry
+        elif entry != old:
+            # same content, new stat keys (not hashed again next time)
+            manifest[station_id] = entry
+            changed = True
+    if changed:
+        ic_manifest_save(address_bh, manifest)
+    return ls_pending, entries
+
+###################### ic_manifest_update ##############################
+
+def ic_manifest_update(address_bh, entries, corr_files, t_start):
+
+    """
+    Adds the waveforms that have been corrected (corrected waveform
+    written after t_start) to the manifest.
+    entries: {station_id: entry}, corr_files: {station_id: file}
+    """
+
+    manifest = ic_manifest_load(address_bh)
+    changed = False
+    for station_id in entries:
+        corr_file = corr_files[station_id]
+        if os.path.isfile(corr_file) and \
+                            os.path.getmtime(corr_file) >= int(t_start):
+            manifest[station_id] = entries[station_id]
+            changed = True
+    if changed:
+        ic_manifest_save(address_bh, manifest)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------
+#   Filename:  ic_spool.py
+#   Purpose:   spool folder (queue of files) between the download
+#              processes and the instrument correction processes
+#   Author:    Kasra Hosseini
+#   Email:     hosseini@geophysik.uni-muenchen.de
+#   License:   GPLv3
+#-------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+#----------------Import required Modules (Python and Obspy)-------------
+#-----------------------------------------------------------------------
+
+# Added this line for python 2.5 compatibility
+from __future__ import with_statement
+import os
+import glob
+import time
+import shutil
+
+# a task is one file: <name>.task, taken by renaming it to <name>.task.<pid>
+task_ext = '.task'
+# the spool is closed (no more tasks) when this file exists
+close_name = 'closed'
+
+########################################################################
+###################### Functions are defined here ######################
+########################################################################
+
+###################### spool_open ######################################
+
+def spool_open(spool_dir):
+
+    """
+    Creates an empty spool folder (the tasks of a previous run are removed)
+    """
+
+    if os.path.isdir(spool_dir):
+        shutil.rmtree(spool_dir)
+    os.makedirs(spool_dir)
+
+###################### spool_put #######################################
+
+def spool_put(spool_dir, name, task):
+
+    """
+    Adds a task (list of strings, eg: addresses) to the spool,
+    name: unique name of the task
+    """
+
+    # the time in the name keeps the order of the tasks
+    task_file = os.path.join(spool_dir, '%.6f_%s%s' %(time.time(), name, \
+                                                                task_ext))
+    task_tmp = task_file + '.tmp' + str(os.getpid())
+    task_open = open(task_tmp, 'w')
+    task_open.writelines([x + '\n' for x in task])
+    task_open.close()
+    # the task appears complete (rename is atomic)
+    os.rename(task_tmp, task_file)
+
+###################### spool_take ######################################
+
+def spool_take(spool_dir):
+
+    """
+    Takes the oldest task of the spool (only one process gets it),
+    returns None if there is no task.
+    """
+
+    ls_tasks = sorted(glob.glob(os.path.join(spool_dir, '*' + task_ext)))
+    for task_file in ls_tasks:
+        task_taken = task_file + '.' + str(os.getpid())
+        try:
+            os.rename(task_file, task_taken)
+        except OSError:
+            # taken by another process
+            continue
+        task_open = open(task_taken)
+        task = [x.rstrip('\n') for x in task_open.readlines()]
+        task_open.close()
+        os.remove(task_taken)
+        return task
+    return None
+
+###################### spool_close #####################################
+
+def spool_close(spool_dir):
+
+    """
+    Closes the spool: the processes stop when there is no task left
+    """
+
+    open(os.path.join(spool_dir, close_name), 'w').close()
+
+###################### spool_closed ####################################
+
+def spool_closed(spool_dir):
+
+    """
+    True if the spool has been closed
+    """
+
+    return os.path.isfile(os.path.join(spool_dir, close_name))
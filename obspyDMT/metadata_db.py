@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------
+#   Filename:  metadata_db.py
+#   Purpose:   indexed metadata catalog (SQLite) of an obspyDMT
+#              archive: events, channels, artifacts and processing
+#   Author:    Kasra Hosseini
+#   Email:     hosseini@geophysik.uni-muenchen.de
+#   License:   GPLv3
+#-------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+#----------------Import required Modules (Python and Obspy)-------------
+#-----------------------------------------------------------------------
+
+# Added this line for python 2.5 compatibility
+from __future__ import with_statement
+import os
+import math
+import time
+import sqlite3
+
+from obspy.core import UTCDateTime
+
+# name of the catalog in the datapath
+db_name = 'obspyDMT.sqlite'
+
+# the text files (quake and station_event) are the reference: the
+# catalog keeps their mtime and size and is only used for the events
+# whose files have not changed since. Only the main process writes to
+# the catalog (one transaction per step), the parallel processes never
+# open it (the datapath could be on NFS).
+db_schema = """
+CREATE TABLE IF NOT EXISTS archives (
+    address TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS events (
+    address TEXT PRIMARY KEY, event_id TEXT, datetime REAL,
+    latitude REAL, longitude REAL, depth REAL, magnitude REAL,
+    t1 REAL, t2 REAL, quake_mtime REAL, quake_size INTEGER,
+    sta_ev_mtime REAL, sta_ev_size INTEGER, sta_ev_lines INTEGER);
+CREATE TABLE IF NOT EXISTS channels (
+    address TEXT, channel_id TEXT, num INTEGER, client TEXT,
+    net TEXT, sta TEXT, loc TEXT, cha TEXT,
+    stla TEXT, stlo TEXT, stel TEXT, stdp TEXT,
+    event_id TEXT, evla TEXT, evlo TEXT, evdp TEXT, mag TEXT,
+    PRIMARY KEY (address, channel_id, client));
+CREATE INDEX IF NOT EXISTS channels_num ON channels (address, num);
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY, address TEXT, channel_id TEXT,
+    kind TEXT, size INTEGER, mtime REAL);
+CREATE INDEX IF NOT EXISTS artifacts_channel
+    ON artifacts (address, channel_id);
+CREATE TABLE IF NOT EXISTS processing (
+    address TEXT, channel_id TEXT, step TEXT, state TEXT, time REAL,
+    PRIMARY KEY (address, channel_id, step));
+"""
+
+# columns added to the events of the catalogs of older versions
+db_events_columns = [('quake_mtime', 'REAL'), ('quake_size', 'INTEGER'),
+                     ('sta_ev_mtime', 'REAL'), ('sta_ev_size', 'INTEGER'),
+                     ('sta_ev_lines', 'INTEGER')]
+
+# catalogs (datapath) with a checked schema in this process
+db_ready = set()
+
+########################################################################
+###################### Functions are defined here ######################
+########################################################################
+
+###################### db_path #########################################
+
+def db_path(address):
+
+    """
+    Normalized absolute path, as stored in the catalog
+    """
+
+    return os.path.abspath(os.path.normpath(address))
+
+###################### db_stat #########################################
+
+def db_stat(path):
+
+    """
+    (mtime, size) of a file, (None, None) if it does not exist
+    """
+
+    try:
+        path_stat = os.stat(path)
+    except OSError:
+        return (None, None)
+    return (path_stat.st_mtime, path_stat.st_size)
+
+###################### db_open #########################################
+
+def db_open(datapath):
+
+    """
+    Opens the catalog of the datapath, the schema is created (or
+    completed) once per process.
+    """
+
+    db_conn = sqlite3.connect(os.path.join(datapath, db_name), timeout = 120)
+    if not datapath in db_ready:
+        db_conn.executescript(db_schema)
+        columns = [row[1] for row in \
+                        db_conn.execute('PRAGMA table_info(events)')]
+        for column, column_type in db_events_columns:
+            if not column in columns:
+                db_conn.execute('ALTER TABLE events ADD COLUMN %s %s' \
+                                                    %(column, column_type))
+        db_conn.commit()
+        db_ready.add(datapath)
+    return db_conn
+
+###################### db_find #########################################
+
+def db_find(address, levels = 4):
+
+    """
+    Finds the catalog in the address or in its parent folders,
+    returns the datapath or None.
+    """
+
+    address = db_path(address)
+    for i in range(0, levels + 1):
+        if os.path.isfile(os.path.join(address, db_name)):
+            return address
+        address_up = os.path.dirname(address)
+        if address_up == address:
+            break
+        address = address_up
+    return None
+
+###################### db_events_add ###################################
+
+def db_events_add(eventpath, events):
+
+    """
+    Registers the archive (eventpath) and its events (with the stat of
+    their quake files) in the catalog of the datapath (parent of the
+    eventpath) in one transaction.
+    """
+
+    eventpath = db_path(eventpath)
+    rows = []
+    for event in events:
+        address_event = os.path.join(eventpath, event['event_id'])
+        rows.append((address_event,
+                    event['event_id'], event['datetime'].timestamp,
+                    float(event['latitude']), float(event['longitude']),
+                    abs(float(event['depth'])), abs(float(event['magnitude'])),
+                    event['t1'].timestamp, event['t2'].timestamp) + \
+                    db_stat(os.path.join(address_event, 'info', 'quake')) + \
+                    (None, None))
+    try:
+        db_conn = db_open(os.path.dirname(eventpath))
+        try:
+            db_conn.execute('INSERT OR IGNORE INTO archives VALUES (?)',
+                                                            (eventpath,))
+            db_conn.executemany('INSERT OR REPLACE INTO events (address, '
+                        'event_id, datetime, latitude, longitude, depth, '
+                        'magnitude, t1, t2, quake_mtime, quake_size, '
+                        'sta_ev_mtime, sta_ev_size) VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            db_conn.commit()
+        finally:
+            db_conn.close()
+    except Exception, e:
+        print 'Could not update the metadata catalog: %s' %(e)
+
+###################### db_events_set ###################################
+
+def db_events_set(address, rows):
+
+    """
+    Adds the events of parsed quake files to the catalog (one
+    transaction), rows: [(info folder, (event_id, datetime, latitude,
+    longitude, depth, magnitude, t1, t2)), ...] (refer to quake_row).
+    Archives without a catalog get one in the address.
+    """
+
+    if not rows:
+        return
+    datapath = db_find(rows[0][0]) or db_path(address)
+    try:
+        db_conn = db_open(datapath)
+        try:
+            for address_info, row in rows:
+                values = tuple(row) + \
+                        db_stat(os.path.join(address_info, 'quake')) + \
+                        (os.path.dirname(db_path(address_info)),)
+                if not db_conn.execute('UPDATE events SET event_id = ?, '
+                        'datetime = ?, latitude = ?, longitude = ?, '
+                        'depth = ?, magnitude = ?, t1 = ?, t2 = ?, '
+                        'quake_mtime = ?, quake_size = ? WHERE address = ?',
+                        values).rowcount:
+                    db_conn.execute('INSERT INTO events (event_id, '
+                        'datetime, latitude, longitude, depth, magnitude, '
+                        't1, t2, quake_mtime, quake_size, address) VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
+            db_conn.commit()
+        finally:
+            db_conn.close()
+    except Exception, e:
+        print 'Could not update the metadata catalog: %s' %(e)
+
+###################### db_channels_sync ################################
+
+def db_channels_sync(address_events):
+
+    """
+    Copies the station_event files of the events (after the download
+    or the rebuild of the files) to the catalog together with the
+    artifacts of the channels (raw waveform, response and PAZ files that
+    exist), all the events in one transaction.
+    The order of the channels (num) is the order of the lines, the
+    number of lines is kept: the catalog is not used for the files with
+    lines that are not channels or repeated channels (one row each).
+    """
+
+    if not address_events:
+        return
+    datapath = db_find(address_events[0])
+    if not datapath:
+        return
+    events = []
+    for address_event in address_events:
+        address_event = db_path(address_event)
+        sta_ev_file = os.path.join(address_event, 'info', 'station_event')
+        sta_ev_stat = db_stat(sta_ev_file)
+        if sta_ev_stat[0] == None:
+            continue
+        sta_ev_open = open(sta_ev_file, 'r')
+        syn_lines = sta_ev_open.readlines()
+        sta_ev_open.close()
+        channels = []
+        artifacts = []
+        for syn in syn_lines:
+            syn = syn.split(',')
+            if len(syn) < 14:
+                continue
+            channel_id = syn[0] + '.' + syn[1] + '.' + syn[2] + '.' + syn[3]
+            channels.append([address_event, channel_id, len(channels), \
+                                                    syn[13]] + syn[0:13])
+            for kind, path in [('raw', os.path.join('BH_RAW', channel_id)),
+                        ('resp', os.path.join('Resp', 'RESP.' + channel_id)),
+                        ('paz', os.path.join('Resp', 'PAZ.' + channel_id + \
+                                                                '.full')),
+                        ('paz', os.path.join('Resp', 'PAZ.' + channel_id + \
+                                                                '.paz'))]:
+                path = os.path.join(address_event, path)
+                path_stat = db_stat(path)
+                if path_stat[0] != None:
+                    artifacts.append((path, address_event, channel_id, kind,
+                                        path_stat[1], path_stat[0]))
+        events.append((address_event, sta_ev_stat + (len(syn_lines),), \
+                                                    channels, artifacts))
+    try:
+        db_conn = db_open(datapath)
+        try:
+            for address_event, sta_ev_stat, channels, artifacts in events:
+                db_conn.execute('DELETE FROM channels WHERE address = ?',
+                                                        (address_event,))
+                db_conn.executemany('INSERT OR REPLACE INTO channels VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        channels)
+                db_conn.executemany('INSERT OR REPLACE INTO artifacts VALUES '
+                                '(?, ?, ?, ?, ?, ?)', artifacts)
+                db_conn.execute('UPDATE events SET sta_ev_mtime = ?, '
+                        'sta_ev_size = ?, sta_ev_lines = ? WHERE address = ?',
+                        sta_ev_stat + (address_event,))
+            db_conn.commit()
+        finally:
+            db_conn.close()
+    except Exception, e:
+        print 'Could not update the metadata catalog: %s' %(e)
+
+###################### db_processing_event #############################
+
+def db_processing_event(address_event, step, states):
+
+    """
+    Sets the processing state of the channels of one event in one
+    transaction (eg: step = 'BH_VEL') and adds the resulting artifacts,
+    states: [(channel_id, 'done' or 'failed', path or None), ...]
+    """
+
+    if not states:
+        return
+    datapath = db_find(address_event)
+    if not datapath:
+        return
+    address_event = db_path(address_event)
+    t_now = time.time()
+    processing = []
+    artifacts = []
+    for channel_id, state, path in states:
+        processing.append((address_event, channel_id, step, state, t_now))
+        if path:
+            path_stat = db_stat(path)
+            if path_stat[0] != None:
+                artifacts.append((db_path(path), address_event, channel_id,
+                                'corrected', path_stat[1], path_stat[0]))
+    try:
+        db_conn = db_open(datapath)
+        try:
+            db_conn.executemany('INSERT OR REPLACE INTO processing VALUES '
+                                '(?, ?, ?, ?, ?)', processing)
+            db_conn.executemany('INSERT OR REPLACE INTO artifacts VALUES '
+                                '(?, ?, ?, ?, ?, ?)', artifacts)
+            db_conn.commit()
+        finally:
+            db_conn.close()
+    except Exception, e:
+        print 'Could not update the metadata catalog: %s' %(e)
+
+###################### db_rows #########################################
+
+def db_rows(address_infos, columns):
+
+    """
+    Rows (columns) of the events of the info folders from the catalog,
+    {info folder: row}, empty if there is no catalog.
+    """
+
+    if not address_infos:
+        return {}
+    datapath = db_find(address_infos[0])
+    if not datapath:
+        return {}
+    rows = {}
+    try:
+        db_conn = db_open(datapath)
+        try:
+            for address_info in address_infos:
+                row = db_conn.execute('SELECT ' + columns + ' FROM events '
+                        'WHERE address = ?', \
+                        (os.path.dirname(db_path(address_info)),)).fetchone()
+                if row:
+                    rows[address_info] = row
+        finally:
+            db_conn.close()
+    except Exception, e:
+        print 'Could not read the metadata catalog: %s' %(e)
+        return {}
+    return rows
+
+###################### db_quake_info ###################################
+
+def db_quake_info(address_infos):
+
+    """
+    Events of the info folders (same as quake_info) from the catalog,
+    only for the quake files that have not changed since they were
+    catalogued: one event or None (read the quake file) per info folder.
+    """
+
+    rows = db_rows(address_infos, 'quake_mtime, quake_size, event_id, '
+                'datetime, latitude, longitude, depth, magnitude, t1, t2')
+    events = []
+    for address_info in address_infos:
+        row = rows.get(address_info)
+        if not row or row[0] == None or tuple(row[0:2]) != \
+                        db_stat(os.path.join(address_info, 'quake')):
+            events.append(None)
+            continue
+        # same precision as the quake files
+        events.append({'author': 'NONE',
+                    'datetime': UTCDateTime(math.floor(row[3])),
+                    'depth': round(row[6], 5),
+                    'event_id': str(row[2]),
+                    'flynn_region': 'NONE',
+                    'latitude': round(row[4], 5),
+                    'longitude': round(row[5], 5),
+                    'magnitude': round(row[7], 5),
+                    'magnitude_type': 'NONE',
+                    'origin_id': -12345.0,
+                    't1': UTCDateTime(math.floor(row[8])),
+                    't2': UTCDateTime(math.floor(row[9]))})
+    return events
+
+###################### db_read_station_event ###########################
+
+def db_read_station_event(address_infos):
+
+    """
+    Channels of the info folders (same as read_station_event) from the
+    catalog, only for the station_event files that have not changed
+    since they were catalogued and with one row per line: one list or
+    None (read the station_event file) per info folder.
+    """
+
+    rows = db_rows(address_infos, 'sta_ev_mtime, sta_ev_size, sta_ev_lines')
+    checked = []
+    for address_info in address_infos:
+        row = rows.get(address_info)
+        checked.append(bool(row) and row[0] != None and row[2] != None and \
+                    tuple(row[0:2]) == \
+                    db_stat(os.path.join(address_info, 'station_event')))
+    sta_ev = [None for address_info in address_infos]
+    if not True in checked:
+        return sta_ev
+    try:
+        db_conn = db_open(db_find(address_infos[0]))
+        try:
+            for k in range(0, len(address_infos)):
+                if not checked[k]:
+                    continue
+                sta_ev[k] = []
+                for row in db_conn.execute('SELECT net, sta, loc, cha, '
+                        'stla, stlo, stel, stdp, event_id, evla, evlo, '
+                        'evdp, mag, client FROM channels WHERE address = ? '
+                        'ORDER BY num', \
+                        (os.path.dirname(db_path(address_infos[k])),)):
+                    sta_ev[k].append([str(x) for x in row] + ['\n'])
+                if len(sta_ev[k]) != rows[address_infos[k]][2]:
+                    sta_ev[k] = None
+        finally:
+            db_conn.close()
+    except Exception, e:
+        print 'Could not read the metadata catalog: %s' %(e)
+        return [None for address_info in address_infos]
+    return sta_ev
@@ -27,14 +27,17 @@ import time
 import random
 import shutil
 import pickle
+import json
 import glob
 import ConfigParser
 import commands
 import subprocess
 import tarfile
+import io
+import struct
 from datetime import datetime
 #import multiprocessing
-from lxml import objectify
+from lxml import etree
 from optparse import OptionParser
 from datetime import datetime
 
@@ -55,6 +58,9 @@ except Exception, error:
 global descrip
 descrip = []
 
+# travel-time table of the first arrival (refer to tt_table)
+tt_grid = None
+
 try:
     from obspy import __version__ as obs_ver
 except Exception, error:
@@ -67,7 +73,7 @@ except Exception, error:
         print '------------------------------------------------------'
         sys.exit(2)
 
-from obspy.core import read, UTCDateTime
+from obspy.core import read, UTCDateTime, Stream, Trace
 from obspy.signal import seisSim, invsim
 from obspy.xseed import Parser
 
@@ -86,6 +92,27 @@ except Exception, error:
     from obspy.taup.taup import locations2degrees
 from obspy.taup import taup
 import numpy as np
+from geometry import geometry_event
+from event_table import event_dtype, event_row, events_table, events_list, \
+                        events_table_concat, events_table_unique, \
+                        events_table_select, events_table_save
+from dir_index import locate_index
+from quake_parse import quake_tokens, quake_row, quake_event
+from header_rebuild import station_event_rebuild
+from waveform_volume import volume_pack, waveform_exists, waveform_read, \
+                        waveform_file, waveform_glob, waveform_trace, \
+                        waveform_npts, sac_byteorder, sac_head
+from resp_cache import resp_correct, resp_correct_batch, \
+                        resp_correct_chunked, chunk_correct, chunk_nfft, \
+                        detrend_chunked, taper_chunked
+from sac_batch import sac_correct
+from resp_paz import resp_paz, paz_index_build
+from ic_spool import spool_open, spool_put, spool_take, spool_close, \
+                        spool_closed
+from ic_manifest import ic_entry, ic_pending, ic_manifest_update
+from metadata_db import db_events_add, db_events_set, db_channels_sync, \
+                        db_processing_event, db_quake_info, \
+                        db_read_station_event
 descrip.append('numpy ver: ' + np.__version__)
 import scipy
 descrip.append('scipy ver: ' + scipy.__version__)
@@ -154,6 +181,11 @@ def obspyDMT(**kwargs):
     if input['seismicity'] == 'Y':
         seismicity()
        
+    # ------------------Instrument correction during the download------
+    ic_stream = None
+    if input['ic_stream'] == 'Y':
+        ic_stream = IC_stream_start(input)
+    
     # ------------------IRIS--------------------------------------------
     if input['IRIS'] == 'Y':
         print '\n********************************************************'
@@ -167,6 +199,9 @@ def obspyDMT(**kwargs):
         print 'ArcLink -- Download waveforms, response files and meta-data'
         print '***********************************************************'
         ARC_network(input)
+    
+    if ic_stream:
+        IC_stream_finish(input, ic_stream)
                 
     # ------------------IRIS-Updating-----------------------------------
     if input['iris_update'] != 'N':
@@ -182,15 +217,24 @@ def obspyDMT(**kwargs):
         print '************************'
         ARC_update(input, address = input['arc_update'])
     
+    # ------------------IRIS/Arclink-instrument (one pool)---------------
+    ic_clients = [x for x in ['iris', 'arc'] if input[x + '_ic'] != 'N' \
+                                            or input[x + '_ic_auto'] == 'Y']
+    if ic_clients and input['ic_parallel'] == 'Y':
+        print '\n******************************************'
+        print 'IRIS/ArcLink -- Instrument Correction'
+        print '******************************************'
+        IC_archive(input, ic_clients)
+    
     # ------------------IRIS-instrument---------------------------------
-    if input['iris_ic'] != 'N' or input['iris_ic_auto'] == 'Y':
+    if 'iris' in ic_clients and input['ic_parallel'] != 'Y':
         print '\n*****************************'
         print 'IRIS -- Instrument Correction'
         print '*****************************'
         IRIS_ARC_IC(input, clients = 'iris')
     
     # ------------------Arclink-instrument------------------------------
-    if input['arc_ic'] != 'N' or input['arc_ic_auto'] == 'Y':
+    if 'arc' in ic_clients and input['ic_parallel'] != 'Y':
         print '\n********************************'
         print 'ArcLink -- Instrument Correction'
         print '********************************'
@@ -337,10 +381,23 @@ def command_parse():
     parser.add_option("--event_circle", action="store",
                       dest="event_circle", help=helpmsg)
     
-    helpmsg = "maximum number of events to be requested. [Default: 2500]"
+    helpmsg = "maximum number of events in one request to the event " + \
+                "catalog, longer time ranges are requested in several " + \
+                "pages. [Default: 2500]"
     parser.add_option("--max_result", action="store",
                       dest="max_result", help=helpmsg)
     
+    helpmsg = "use the local event catalog cache (EVENTS-CACHE in the " + \
+                "datapath), only the months that are not already " + \
+                "in the cache are requested from the event catalog."
+    parser.add_option("--event_cache", action="store_true",
+                      dest="event_cache", help=helpmsg)
+    
+    helpmsg = "number of parallel requests to the event catalog " + \
+                "(each one for a part of the time range). [Default: 4]"
+    parser.add_option("--event_np", action="store",
+                      dest="event_np", help=helpmsg)
+    
     helpmsg = "Just retrieve the event information and create an event archive."
     parser.add_option("--event_info", action="store_true",
                       dest="event_info", help=helpmsg)
@@ -350,6 +407,13 @@ def command_parse():
     parser.add_option("--seismicity", action="store_true",
                       dest="seismicity", help=helpmsg)
     
+    helpmsg = "type of the seismicity map: 'scatter' (one symbol per " + \
+                "event), 'density' (2-D histogram of the events) or " + \
+                "'auto' (density for more than 20000 events). " + \
+                "[Default: 'auto']"
+    parser.add_option("--seismicity_mode", action="store",
+                      dest="seismicity_mode", help=helpmsg)
+    
     helpmsg = "event-based request (please refer to the tutorial). [Default: 'Y']"
     parser.add_option("--get_events", action="store",
                       dest="get_events", help=helpmsg)
@@ -510,6 +574,36 @@ def command_parse():
     parser.add_option("--station_circle", action="store",
                       dest="station_circle", help=helpmsg)
    
+    helpmsg = "send the requests only for the stations within the " + \
+                "defined epicentral distance range (deg) from the event, " + \
+                "syntax: <min_epi>/<max_epi>. " + \
+                "[Default: all the available stations]"
+    parser.add_option("--req_epi", action="store",
+                      dest="req_epi", help=helpmsg)
+    
+    helpmsg = "send the requests only for the stations within the " + \
+                "defined azimuth range (deg, event to station), " + \
+                "syntax: <min_azi>/<max_azi> (eg: '300/60' for the " + \
+                "stations in the north). [Default: all the available stations]"
+    parser.add_option("--req_azi", action="store",
+                      dest="req_azi", help=helpmsg)
+    
+    helpmsg = "send the requests for maximum max_num stations in each " + \
+                "azimuth bin with the width of bin_width (deg), the " + \
+                "closest stations are kept, syntax: <bin_width>/<max_num>. " + \
+                "[Default: all the available stations]"
+    parser.add_option("--req_azi_bin", action="store",
+                      dest="req_azi_bin", help=helpmsg)
+    
+    helpmsg = "send the requests only for the preferred channels of " + \
+                "each station (one set of co-located channels per station), " + \
+                "syntax: comma separated groups of band/instrument codes, " + \
+                "location codes and orientations ordered by preference, " + \
+                "eg: 'BH>HH,00>10>--,ZNE>Z12'. " + \
+                "[Default: all the available channels]"
+    parser.add_option("--chan_pref", action="store",
+                      dest="chan_pref", help=helpmsg)
+    
     helpmsg = "test the program for the desired number of requests, " + \
                 "eg: '--test 10' will test the program for 10 requests. " + \
                 "[Default: 'N']"
@@ -575,6 +669,35 @@ def command_parse():
     parser.add_option("--ic_np", action="store",
                         dest="ic_np", help=helpmsg)
     
+    helpmsg = "Number of traces that are corrected together " + \
+                "(--ic_obspy_full: traces with the same sampling rate " + \
+                "and length are deconvolved as one array, " + \
+                "--ic_sac_full: one SAC process). [Default: 100]"
+    parser.add_option("--ic_batch", action="store",
+                        dest="ic_batch", help=helpmsg)
+    
+    helpmsg = "traces longer than this number of samples are corrected " + \
+                "in overlapping segments (overlap-save, --ic_obspy_full " + \
+                "and --ic_paz), the memory does not depend on the " + \
+                "length of the trace. 0: one FFT for the whole trace. " + \
+                "[Default: 0]"
+    parser.add_option("--ic_segment", action="store",
+                        dest="ic_segment", help=helpmsg)
+    
+    helpmsg = "correct each channel as soon as it has been downloaded " + \
+                "(--iris_ic_auto, --arc_ic_auto), the instrument " + \
+                "correction (--ic_np processes) runs during the " + \
+                "download of the other channels."
+    parser.add_option("--ic_stream", action="store_true",
+                        dest="ic_stream", help=helpmsg)
+    
+    helpmsg = "correct all the waveforms again, by default the " + \
+                "waveforms whose raw data, response file and correction " + \
+                "parameters did not change since the last correction " + \
+                "are skipped."
+    parser.add_option("--ic_force", action="store_true",
+                        dest="ic_force", help=helpmsg)
+    
     helpmsg = "Instrument Correction (full response), using obspy modules"
     parser.add_option("--ic_obspy_full", action="store",
                       dest="ic_obspy_full", help=helpmsg)
@@ -588,6 +711,12 @@ def command_parse():
     parser.add_option("--ic_paz", action="store_true",
                       dest="ic_paz", help=helpmsg)
     
+    helpmsg = "folder to keep the evaluated instrument responses " + \
+                "(--ic_obspy_full) between the runs, the responses are " + \
+                "always cached in memory during one run. [Default: None]"
+    parser.add_option("--resp_cache", action="store",
+                      dest="resp_cache", help=helpmsg)
+    
     helpmsg = "apply a bandpass filter to the data trace before " + \
                 "deconvolution ('None' if you do not need pre_filter), " + \
                 "syntax: '(f1,f2,f3,f4)' which are the four corner " + \
@@ -612,6 +741,12 @@ def command_parse():
     parser.add_option("--zip_r", action="store_true",
                         dest="zip_r", help=helpmsg)
     
+    helpmsg = "pack the waveforms of each event and processing level " + \
+                "(BH_RAW, BH, BH_VEL, BH_ACC) in one volume with an " + \
+                "index (waveforms.volume) instead of one file per channel."
+    parser.add_option("--container", action="store_true",
+                        dest="container", help=helpmsg)
+    
     helpmsg = "merge the IRIS waveforms in the specified folder, " + \
                 "syntax: --iris_merge address_of_the_target_folder. " + \
                 "[Default: 'N']"
@@ -787,10 +922,16 @@ def read_input_command(parser, **kwargs):
                 'evlat': None, 'evlon': None, 
                 'evradmin': None, 'evradmax': None,
                 'max_result': 2500,
+                'event_np': 4,
                 'lat_cba': None, 'lon_cba': None, 
                 'mr_cba': None, 'Mr_cba': None,
                 'mlat_rbb': None, 'Mlat_rbb': None, 
                 'mlon_rbb': None, 'Mlon_rbb': None,
+                'req_min_epi': None, 'req_max_epi': None,
+                'req_min_azi': None, 'req_max_azi': None,
+                'req_azi_bin': None, 'req_azi_bin_max': None,
+                'chan_pref': None, 'chan_pref_band': None, 
+                'chan_pref_loc': None, 'chan_pref_orient': None,
                 'test': 'N',
                 'iris_update': 'N', 'arc_update': 'N', 'update_all': 'N',
                 'email': 'N',
@@ -798,6 +939,8 @@ def read_input_command(parser, **kwargs):
                 'iris_ic': 'N', 'iris_ic_auto': 'Y',
                 'arc_ic': 'N', 'arc_ic_auto': 'Y',
                 'ic_np': 20,
+                'ic_batch': 100,
+                'ic_segment': 0,
                 'ic_obspy_full': 'Y',
                 'pre_filt': '(0.008, 0.012, 3.0, 4.0)',
                 'corr_unit': 'DIS',
@@ -811,6 +954,7 @@ def read_input_command(parser, **kwargs):
                 'plot_ray': 'N', 'plot_epi': 'N', 'plot_dt': 'N',
                 'plot_ray_gmt': 'N',
                 'plot_save': '.', 'plot_format': 'png',
+                'seismicity_mode': 'auto',
                 'min_epi': 0.0, 'max_epi': 180.0,
             }
     
@@ -994,6 +1138,64 @@ def read_input_command(parser, **kwargs):
             print "Erroneous circle given."
             sys.exit(2)
     
+    # epicentral distance restriction of the requests
+    if options.req_epi:
+        try:
+            options.req_epi = options.req_epi.split('/')
+            if len(options.req_epi) != 2:
+                print "Erroneous epicentral distance range given."
+                sys.exit(2)
+            options.req_min_epi = float(options.req_epi[0])
+            options.req_max_epi = float(options.req_epi[1])
+        except:
+            print "Erroneous epicentral distance range given."
+            sys.exit(2)
+    
+    # azimuth restriction of the requests
+    if options.req_azi:
+        try:
+            options.req_azi = options.req_azi.split('/')
+            if len(options.req_azi) != 2:
+                print "Erroneous azimuth range given."
+                sys.exit(2)
+            options.req_min_azi = float(options.req_azi[0]) % 360.
+            options.req_max_azi = float(options.req_azi[1]) % 360.
+        except:
+            print "Erroneous azimuth range given."
+            sys.exit(2)
+    
+    # maximum number of stations per azimuth bin
+    if options.req_azi_bin:
+        try:
+            options.req_azi_bin = options.req_azi_bin.split('/')
+            if len(options.req_azi_bin) != 2:
+                print "Erroneous azimuth bin given."
+                sys.exit(2)
+            options.req_azi_bin_max = int(options.req_azi_bin[1])
+            options.req_azi_bin = float(options.req_azi_bin[0])
+            if options.req_azi_bin <= 0:
+                print "Erroneous azimuth bin given."
+                sys.exit(2)
+        except:
+            print "Erroneous azimuth bin given."
+            sys.exit(2)
+    
+    # channel preferences (band/instrument, location, orientation)
+    if options.chan_pref:
+        for pref in options.chan_pref.split(','):
+            # an empty location code is the same as '--'
+            pref = [code.strip() or '--' for code in pref.split('>')]
+            if False not in [len(code) == 3 for code in pref]:
+                options.chan_pref_orient = pref
+            elif False not in [len(code) == 2 and code.isalpha() \
+                                                    for code in pref]:
+                options.chan_pref_band = pref
+            elif False not in [len(code) == 2 for code in pref]:
+                options.chan_pref_loc = pref
+            else:
+                print "Erroneous channel preference given."
+                sys.exit(2)
+    
     # delete data path if -R or --reset args are given at cmdline
     if options.reset:
         # try-except so we don't get an exception if path doesnt exist
@@ -1039,10 +1241,19 @@ def read_input_command(parser, **kwargs):
     input['preset'] = float(options.preset)
     input['offset'] = float(options.offset)
     input['max_result'] = int(options.max_result)
+    input['event_np'] = int(options.event_np)
+    if options.event_cache:
+        input['event_cache'] = 'Y'
+    else:
+        input['event_cache'] = 'N'
     if options.seismicity:
         input['seismicity'] = 'Y'
     else:
         input['seismicity'] = 'N'
+    if options.seismicity_mode not in ['auto', 'scatter', 'density']:
+        print "Erroneous seismicity map type given."
+        sys.exit(2)
+    input['seismicity_mode'] = options.seismicity_mode
     input['get_events'] = options.get_events
     if options.get_continuous:
         input['get_events'] = 'N'
@@ -1100,6 +1311,16 @@ def read_input_command(parser, **kwargs):
     input['Mlon_rbb'] = options.Mlon_rbb
     input['mlat_rbb'] = options.mlat_rbb
     input['Mlat_rbb'] = options.Mlat_rbb    
+    input['req_min_epi'] = options.req_min_epi
+    input['req_max_epi'] = options.req_max_epi
+    input['req_min_azi'] = options.req_min_azi
+    input['req_max_azi'] = options.req_max_azi
+    input['req_azi_bin'] = options.req_azi_bin
+    input['req_azi_bin_max'] = options.req_azi_bin_max
+    input['chan_pref'] = options.chan_pref
+    input['chan_pref_band'] = options.chan_pref_band
+    input['chan_pref_loc'] = options.chan_pref_loc
+    input['chan_pref_orient'] = options.chan_pref_orient
     if options.test != 'N':
         input['test'] = 'Y'
         input['test_num'] = int(options.test)
@@ -1120,6 +1341,13 @@ def read_input_command(parser, **kwargs):
     if options.ic_parallel: options.ic_parallel = 'Y'
     input['ic_parallel'] = options.ic_parallel
     input['ic_np'] = int(options.ic_np)
+    input['ic_batch'] = int(options.ic_batch)
+    input['ic_segment'] = int(options.ic_segment)
+    if options.ic_stream: options.ic_stream = 'Y'
+    input['ic_stream'] = options.ic_stream
+    input['ic_spool'] = None
+    if options.ic_force: options.ic_force = 'Y'
+    input['ic_force'] = options.ic_force
     input['ic_obspy_full'] = options.ic_obspy_full
     if options.ic_sac_full: options.ic_sac_full = 'Y'
     input['ic_sac_full'] = options.ic_sac_full
@@ -1130,10 +1358,15 @@ def read_input_command(parser, **kwargs):
         input['ic_obspy_full'] = 'N'
     input['corr_unit'] = options.corr_unit
     input['pre_filt'] = options.pre_filt
+    input['resp_cache'] = options.resp_cache
     if options.zip_w: options.zip_w = 'Y'
     input['zip_w'] = options.zip_w
     if options.zip_r: options.zip_r = 'Y'
     input['zip_r'] = options.zip_r
+    if options.container:
+        input['container'] = 'Y'
+    else:
+        input['container'] = 'N'
     input['iris_merge'] = options.iris_merge
     input['arc_merge'] = options.arc_merge
     input['merge_all'] = options.merge_all
@@ -1286,6 +1519,10 @@ def read_input_file():
     input['preset'] = config.getfloat('Event_Request', 'preset')
     input['offset'] = config.getfloat('Event_Request', 'offset')
     input['max_result'] = config.getint('Event_Request', 'max_results')
+    input['event_cache'] = 'N'
+    input['event_np'] = 1
+    input['evlat'] = None; input['evlon'] = None
+    input['evradmin'] = None; input['evradmax'] = None
     
     input['get_events'] = config.get('Request', 'get_events')
     input['input_period'] = config.get('Parallel', 'input_period')
@@ -1370,6 +1607,13 @@ def read_input_file():
     input['report'] = config.get('report', 'report')
     
     input['corr_unit'] = config.get('instrument_correction', 'corr_unit')
+    input['ic_batch'] = 100
+    input['ic_segment'] = 0
+    input['ic_stream'] = 'N'
+    input['ic_spool'] = None
+    input['ic_force'] = 'N'
+    input['container'] = 'N'
+    input['resp_cache'] = None
     input['pre_filt'] = config.get('instrument_correction', 'pre_filter')
     
     input['plt_event'] = config.get('ObsPyPT', 'plot_event')
@@ -1442,51 +1686,378 @@ def get_Events(input, request):
         print "Longitude:" + " " + str(events[i]['longitude'])
         print "Magnitude:" + " " + str(events[i]['magnitude'])
     print "-------------------------------------------------"
-    Event_cat = open(os.path.join(eventpath, 'EVENTS-INFO', 'EVENT-CATALOG'), 'a+')
-    Event_cat.writelines(str(Period) + '\n')
-    Event_cat.writelines('-------------------------------------' + '\n')
-    Event_cat.writelines('Information about the requested Events:' + '\n\n')
-    Event_cat.writelines('Number of Events: ' + str(len_events) + '\n')
-    Event_cat.writelines('min datetime: ' + str(input['min_date']) + '\n')
-    Event_cat.writelines('max datetime: ' + str(input['max_date']) + '\n')
-    Event_cat.writelines('min magnitude: ' + str(input['min_mag']) + '\n')
-    Event_cat.writelines('max magnitude: ' + str(input['max_mag']) + '\n')
-    Event_cat.writelines('min latitude: ' + str(input['evlatmin']) + '\n')
-    Event_cat.writelines('max latitude: ' + str(input['evlatmax']) + '\n')
-    Event_cat.writelines('min longitude: ' + str(input['evlonmin']) + '\n')
-    Event_cat.writelines('max longitude: ' + str(input['evlonmax']) + '\n')
-    Event_cat.writelines('min depth: ' + str(input['min_depth']) + '\n')
-    Event_cat.writelines('max depth: ' + str(input['max_depth']) + '\n')
-    Event_cat.writelines('-------------------------------------' + '\n\n')
-    Event_cat.close()
+    Event_cat = []
+    Event_cat.append(str(Period) + '\n')
+    Event_cat.append('-------------------------------------' + '\n')
+    Event_cat.append('Information about the requested Events:' + '\n\n')
+    Event_cat.append('Number of Events: ' + str(len_events) + '\n')
+    Event_cat.append('min datetime: ' + str(input['min_date']) + '\n')
+    Event_cat.append('max datetime: ' + str(input['max_date']) + '\n')
+    Event_cat.append('min magnitude: ' + str(input['min_mag']) + '\n')
+    Event_cat.append('max magnitude: ' + str(input['max_mag']) + '\n')
+    Event_cat.append('min latitude: ' + str(input['evlatmin']) + '\n')
+    Event_cat.append('max latitude: ' + str(input['evlatmax']) + '\n')
+    Event_cat.append('min longitude: ' + str(input['evlonmin']) + '\n')
+    Event_cat.append('max longitude: ' + str(input['evlonmax']) + '\n')
+    Event_cat.append('min depth: ' + str(input['min_depth']) + '\n')
+    Event_cat.append('max depth: ' + str(input['max_depth']) + '\n')
+    Event_cat.append('-------------------------------------' + '\n\n')
     
     for j in range(0, len_events):
-        Event_cat = open(os.path.join(eventpath, 'EVENTS-INFO', 'EVENT-CATALOG'), 'a')
-        Event_cat.writelines("Event No: " + str(j) + '\n')
-        Event_cat.writelines("Catalog: " + events[j]['author'] + '\n')
-        Event_cat.writelines("Event-ID: " + str(events[j]['event_id']) + '\n')
-        Event_cat.writelines("Date Time: " + str(events[j]['datetime']) + '\n')
-        Event_cat.writelines("Magnitude: " + str(events[j]['magnitude']) + '\n')
-        Event_cat.writelines("Depth: " + str(events[j]['depth']) + '\n')
-        Event_cat.writelines("Latitude: " + str(events[j]['latitude']) + '\n')
-        Event_cat.writelines("Longitude: " + str(events[j]['longitude']) + '\n')
+        Event_cat.append("Event No: " + str(j) + '\n')
+        Event_cat.append("Catalog: " + events[j]['author'] + '\n')
+        Event_cat.append("Event-ID: " + str(events[j]['event_id']) + '\n')
+        Event_cat.append("Date Time: " + str(events[j]['datetime']) + '\n')
+        Event_cat.append("Magnitude: " + str(events[j]['magnitude']) + '\n')
+        Event_cat.append("Depth: " + str(events[j]['depth']) + '\n')
+        Event_cat.append("Latitude: " + str(events[j]['latitude']) + '\n')
+        Event_cat.append("Longitude: " + str(events[j]['longitude']) + '\n')
         
         try:
-            Event_cat.writelines("Flynn-Region: " + \
+            Event_cat.append("Flynn-Region: " + \
                                 str(events[j]['flynn_region']) + '\n')
         except Exception, e:
-            Event_cat.writelines("Flynn-Region: " + 'None' + '\n')
-        Event_cat.writelines('-------------------------------------' + '\n')
-        Event_cat.close()
-    Event_file = open(os.path.join(eventpath, 'EVENTS-INFO', 'event_list'), 'a+')
-    pickle.dump(events, Event_file)
-    Event_file.close()
+            Event_cat.append("Flynn-Region: " + 'None' + '\n')
+        Event_cat.append('-------------------------------------' + '\n')
+    Event_cat_open = open(os.path.join(eventpath, 'EVENTS-INFO', \
+                                                'EVENT-CATALOG'), 'a+')
+    Event_cat_open.write(''.join(Event_cat))
+    Event_cat_open.close()
+    events_table_save(events_table(events), \
+                os.path.join(eventpath, 'EVENTS-INFO', 'event_table.npy'))
     print 'Number of events: %s' %(len_events)
     t_event_2 = datetime.now()
     t_event = t_event_2 - t_event_1
     print 'Time for retrieving and saving the event info: %s' %(t_event)
     return events
 
+###################### events_params ###################################
+
+def events_params(input):
+    
+    """
+    Parameters of the event catalog request (everything except the time)
+    """
+    
+    params = {'catalog': input['event_catalog'], 
+              'mag_type': input['mag_type'], 
+              'min_mag': input['min_mag'], 'max_mag': input['max_mag'],
+              'min_depth': input['min_depth'], 'max_depth': input['max_depth'],
+              'max_result': input['max_result']}
+    if input['evlatmin']==None:
+        params['evlatmin']=-90.0;params['evlatmax']=+90.0
+        params['evlonmin']=-180.0;params['evlonmax']=+180.0
+    else:
+        params['evlatmin']=input['evlatmin'];params['evlatmax']=input['evlatmax']
+        params['evlonmin']=input['evlonmin'];params['evlonmax']=input['evlonmax']
+    if input['evlat']==None:
+        params['evlat']=0.0;params['evlon']=0.0
+        params['evradmax']=180.0;params['evradmin']=0.0
+    else:
+        params['evlat']=input['evlat'];params['evlon']=input['evlon']
+        params['evradmax']=input['evradmax'];params['evradmin']=input['evradmin']
+    return params
+
+###################### events_catalog ##################################
+
+def events_catalog(params, min_date, max_date):
+    
+    """
+    Request the events of one time window from the event catalog 
+    (EMSC or IRIS), returns the event table (refer to event_table.py)
+    """
+    
+    if params['catalog'] == 'EMSC':
+        client_neries = Client_neries()
+        events = client_neries.getEvents(min_datetime=min_date, \
+            max_datetime=max_date, min_magnitude=params['min_mag'], \
+            max_magnitude=params['max_mag'], min_latitude=params['evlatmin'], \
+            max_latitude=params['evlatmax'], min_longitude=params['evlonmin'], \
+            max_longitude=params['evlonmax'], min_depth = params['min_depth'], \
+            max_depth=params['max_depth'], magnitude_type=params['mag_type'],
+            max_results=params['max_result'])
+        events = events_table(events)
+    elif params['catalog'] == 'IRIS':
+        client_iris = Client_iris()
+        events_QML = client_iris.getEvents(\
+                minlat=params['evlatmin'],maxlat=params['evlatmax'],\
+                minlon=params['evlonmin'],maxlon=params['evlonmax'],\
+                lat=params['evlat'],lon=params['evlon'],\
+                maxradius=params['evradmax'],minradius=params['evradmin'],\
+                mindepth=-params['min_depth'],maxdepth=-params['max_depth'],\
+                starttime=min_date,endtime=max_date,\
+                minmag=params['min_mag'],maxmag=params['max_mag'],\
+                magtype=params['mag_type'],limit=params['max_result'])
+        rows = []
+        for i in range(0, len(events_QML)):
+            event_QML = events_QML.events[i]
+            origin = event_QML.preferred_origin() or event_QML.origins[0]
+            magnitude = event_QML.preferred_magnitude() or \
+                                                event_QML.magnitudes[0]
+            rows.append(event_row(\
+                author = magnitude.creation_info.author or \
+                        event_QML.magnitudes[0].creation_info.author, \
+                event_id = origin.time.strftime('%Y%m%d') + '_' + str(i), \
+                origin_id = event_QML.preferred_origin_id or \
+                        event_QML.origins[0].resource_id.resource_id, \
+                longitude = origin.longitude, latitude = origin.latitude, \
+                datetime = origin.time, depth = -origin.depth, \
+                magnitude = magnitude.mag, \
+                magnitude_type = magnitude.magnitude_type.lower(), \
+                flynn_region = 'NAN'))
+        events = np.array(rows, dtype = event_dtype)
+    return events
+
+###################### events_paged ####################################
+
+def events_paged(params, windows, num_proc = 1, num_retry = 2):
+    
+    """
+    Request the events of the given time windows [(t1, t2), ...] 
+    from the event catalog in pages.
+    The windows are split into pages based on the expected number of 
+    events (Gutenberg-Richter, b=1, for the magnitude and the area of 
+    the request) and the pages are requested in parallel (num_proc).
+    Pages that reach max_result (the catalog returns at most max_result 
+    events) are split again and re-requested, failed pages are requested 
+    again (num_retry times), the events are then merged and 
+    de-duplicated by their origin_id.
+    Returns one event table for each window and a list of flags: False 
+    if some pages of the window failed (the table is not complete).
+    """
+    
+    # expected number of events per second
+    area = (math.sin(math.radians(params['evlatmax'])) - \
+            math.sin(math.radians(params['evlatmin'])))/2. * \
+            (params['evlonmax'] - params['evlonmin'])/360.
+    rate = 10**(8.0 - params['min_mag']) * max(area, 0.01) / \
+                                                    (365.25*24.*3600.)
+    page_len = max(0.5 * params['max_result'] / rate, 3600.)
+    
+    # [window, t1, t2, number of failed requests]
+    pages = []
+    for w in range(0, len(windows)):
+        t1 = UTCDateTime(windows[w][0])
+        t2 = UTCDateTime(windows[w][1])
+        num_pages = int(math.ceil((t2 - t1) / page_len))
+        # use all the processes for long windows
+        num_pages = max(num_pages, min(num_proc, int((t2 - t1)/86400.)))
+        num_pages = max(num_pages, 1)
+        for p in range(0, num_pages):
+            pages.append([w, t1 + p*(t2 - t1)/num_pages, \
+                                t1 + (p+1)*(t2 - t1)/num_pages, 0])
+    
+    windows_events = [[] for w in windows]
+    windows_complete = [True for w in windows]
+    while pages:
+        if num_proc > 1 and len(pages) > 1 and 'pprocess' in sys.modules:
+            parallel_results = pprocess.Map(limit=num_proc)
+            parallel_job = \
+                parallel_results.manage(pprocess.MakeParallel(events_page))
+            for page in pages:
+                parallel_job(params, page[1], page[2])
+            pages_events = [page_events for page_events in parallel_results]
+        else:
+            pages_events = [events_page(params, page[1], page[2]) \
+                                                    for page in pages]
+        pages_split = []
+        pages_retry = []
+        for p in range(0, len(pages)):
+            w = pages[p][0]
+            if pages_events[p] is None:
+                if pages[p][3] < num_retry:
+                    pages_retry.append([w, pages[p][1], pages[p][2], \
+                                                        pages[p][3] + 1])
+                else:
+                    print 'WARNING: the events of %s -- %s are missing ' \
+                            'in the event catalog (request failed)!' \
+                            %(pages[p][1], pages[p][2])
+                    windows_complete[w] = False
+            elif len(pages_events[p]) >= params['max_result'] and \
+                                    pages[p][2] - pages[p][1] > 60.:
+                # truncated page
+                t_mid = pages[p][1] + (pages[p][2] - pages[p][1])/2.
+                pages_split.append([w, pages[p][1], t_mid, 0])
+                pages_split.append([w, t_mid, pages[p][2], 0])
+            else:
+                windows_events[w].append(pages_events[p])
+        if pages_split:
+            print 'Event catalog: %s page(s) reached max_result, ' \
+                    'requesting %s smaller pages...' \
+                    %(len(pages_split)/2, len(pages_split))
+        if pages_retry:
+            print 'Event catalog: requesting %s failed page(s) again...' \
+                                                        %(len(pages_retry))
+        pages = pages_split + pages_retry
+    
+    for w in range(0, len(windows)):
+        windows_events[w] = events_table_unique(\
+                                    events_table_concat(windows_events[w]))
+    return windows_events, windows_complete
+
+###################### events_page #####################################
+
+def events_page(params, min_date, max_date):
+    
+    """
+    Request one page of the events (refer to events_paged), 
+    returns None if the request failed.
+    """
+    
+    try:
+        return events_catalog(params, str(min_date), str(max_date))
+    except Exception, e:
+        print 30*'-'
+        print 'Event catalog request failed for %s -- %s:' %(min_date, max_date)
+        print e
+        print 30*'-'
+        return None
+
+###################### events_cache ####################################
+
+def events_cache(params, min_date, max_date, address, num_proc = 1):
+    
+    """
+    Get the events from the local event catalog cache (address).
+    The cache is tiled by month, each tile keeps the events together with 
+    the request parameters that they satisfy. Only the tiles that do not 
+    cover the current request are sent to the event catalog.
+    The tiles that are not completely in the past are never stored.
+    """
+    
+    min_date = UTCDateTime(min_date)
+    max_date = UTCDateTime(max_date)
+    cache_path = os.path.join(address, params['catalog'])
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_path)
+    
+    tiles = []
+    tile_start = UTCDateTime(min_date.year, min_date.month, 1)
+    while tile_start < max_date:
+        if tile_start.month == 12:
+            tile_end = UTCDateTime(tile_start.year + 1, 1, 1)
+        else:
+            tile_end = UTCDateTime(tile_start.year, tile_start.month + 1, 1)
+        tile_file = os.path.join(cache_path, '%04i-%02i' \
+                                %(tile_start.year, tile_start.month))
+        tile = events_tile_load(tile_file)
+        tile_events = None
+        for entry in tile:
+            if events_cache_cover(entry['params'], params):
+                tile_events = entry['events']
+                break
+        tiles.append([tile_start, tile_end, tile_file, tile, tile_events])
+        tile_start = tile_end
+    
+    # all the missing tiles are requested together
+    num_miss = [k for k in range(0, len(tiles)) if tiles[k][4] is None]
+    if num_miss:
+        tiles_events, tiles_complete = events_paged(params, \
+                [(tiles[k][0], tiles[k][1]) for k in num_miss], num_proc)
+        for k in range(0, len(num_miss)):
+            tile_start, tile_end, tile_file, tile, tile_events = \
+                                                        tiles[num_miss[k]]
+            tile_events = tiles_events[k]
+            tiles[num_miss[k]][4] = tile_events
+            # incomplete tiles (failed pages) are never stored
+            if tiles_complete[k] and tile_end < UTCDateTime():
+                tile.append({'params': params, 'events': tile_events})
+                events_tile_save(tile_file, tile)
+    
+    events = []
+    for k in range(0, len(tiles)):
+        if tiles[k][4] is not None:
+            events.append(events_table_select(tiles[k][4], params, \
+                                                    min_date, max_date))
+    print 'Event cache: %s month(s) from the cache, %s month(s) requested' \
+                                %(len(tiles) - len(num_miss), len(num_miss))
+    return events_table_unique(events_table_concat(events))
+
+###################### events_tile_load ################################
+
+def events_tile_load(tile_file):
+    
+    """
+    Reads one month of the local event catalog cache (JSON: the cache is 
+    in the datapath and could be written by other users, nothing is 
+    executed while reading it), returns [{'params', 'events'}, ...]
+    """
+    
+    if not os.path.isfile(tile_file):
+        return []
+    try:
+        tile_open = open(tile_file, 'rb')
+        tile_json = json.load(tile_open)
+        tile_open.close()
+        tile = []
+        for entry in tile_json:
+            params = {}
+            for key in entry['params']:
+                params[str(key)] = entry['params'][key]
+                if isinstance(params[str(key)], unicode):
+                    params[str(key)] = str(params[str(key)])
+            tile.append({'params': params, 'events': np.array(\
+                    [tuple(row) for row in entry['events']], \
+                    dtype = event_dtype)})
+    except Exception, e:
+        print 'Could not read the event cache %s: %s' %(tile_file, e)
+        return []
+    return tile
+
+###################### events_tile_save ################################
+
+def events_tile_save(tile_file, tile):
+    
+    """
+    Saves one month of the local event catalog cache (refer to 
+    events_tile_load)
+    """
+    
+    tile_json = []
+    for entry in tile:
+        tile_json.append({'params': entry['params'], \
+                                'events': entry['events'].tolist()})
+    tile_tmp = tile_file + '.' + str(os.getpid())
+    try:
+        tile_open = open(tile_tmp, 'wb')
+        json.dump(tile_json, tile_open)
+        tile_open.close()
+        os.rename(tile_tmp, tile_file)
+    except Exception, e:
+        print 'Could not save the event cache %s: %s' %(tile_file, e)
+
+###################### events_cache_cover ##############################
+
+def events_cache_cover(params_cache, params):
+    
+    """
+    Check whether the request parameters of a cached tile (params_cache) 
+    cover the new request (params)
+    """
+    
+    if params_cache['catalog'] != params['catalog'] or \
+                params_cache['mag_type'] != params['mag_type']:
+        return False
+    if params_cache['min_mag'] > params['min_mag'] or \
+                params_cache['max_mag'] < params['max_mag']:
+        return False
+    # depths are negative downwards: min_depth is the shallowest one
+    if params_cache['min_depth'] < params['min_depth'] or \
+                params_cache['max_depth'] > params['max_depth']:
+        return False
+    if params_cache['evlatmin'] > params['evlatmin'] or \
+                params_cache['evlatmax'] < params['evlatmax'] or \
+                params_cache['evlonmin'] > params['evlonmin'] or \
+                params_cache['evlonmax'] < params['evlonmax']:
+        return False
+    circle = ['evlat', 'evlon', 'evradmin', 'evradmax']
+    if not (params_cache['evradmin'] == 0.0 and \
+                params_cache['evradmax'] == 180.0) and \
+                [params_cache[key] for key in circle] != \
+                [params[key] for key in circle]:
+        return False
+    return True
+
 ###################### events_info #####################################
 
 def events_info(request):
@@ -1495,82 +2066,31 @@ def events_info(request):
     """
     global input
     if request == 'event-based':
-        if input['evlatmin']==None:
-            evlatmin=-90.0;evlatmax=+90.0;evlonmin=-180.0;evlonmax=+180.0
-        else:
-            evlatmin=input['evlatmin'];evlatmax=input['evlatmax']
-            evlonmin=input['evlonmin'];evlonmax=input['evlonmax']
+        params = events_params(input)
         print 'Event Catalog: ',
-        if input['event_catalog'] == 'EMSC':
-            print 'EMSC'
-            client_neries = Client_neries()
-            events = client_neries.getEvents(min_datetime=input['min_date'], \
-                max_datetime=input['max_date'], min_magnitude=input['min_mag'], \
-                max_magnitude=input['max_mag'], min_latitude=evlatmin, \
-                max_latitude=evlatmax, min_longitude=evlonmin, \
-                max_longitude=evlonmax, min_depth = input['min_depth'], \
-                max_depth=input['max_depth'], magnitude_type=input['mag_type'],
-                max_results=input['max_result'])
-        elif input['event_catalog'] == 'IRIS':
-            try:
-                if input['evlat']==None:
-                    evlat=0.0;evlon=0.0;evradmax=180.0;evradmin=0.0
-                else:
-                    evlat=input['evlat'];evlon=input['evlon']
-                    evradmax=input['evradmax'];evradmin=input['evradmin']
-                print 'IRIS'
-                client_iris = Client_iris()
-                events_QML = client_iris.getEvents(\
-                        minlat=evlatmin,maxlat=evlatmax,\
-                        minlon=evlonmin,maxlon=evlonmax,\
-                        lat=evlat,lon=evlon,\
-                        maxradius=evradmax,minradius=evradmin,\
-                        mindepth=-input['min_depth'],maxdepth=-input['max_depth'],\
-                        starttime=input['min_date'],endtime=input['max_date'],\
-                        minmag=input['min_mag'],maxmag=input['max_mag'],\
-                        magtype=input['mag_type'])
-                events = []
-                for i in range(0, len(events_QML)):
-                    event_time = events_QML.events[i].preferred_origin().time or \
-										events_QML.events[i].origins[0].time
-                    if event_time.month < 10:
-                        event_time_month = '0' + str(event_time.month)
-                    else:
-                        event_time_month = str(event_time.month)
-                    if event_time.day < 10:
-                        event_time_day = '0' + str(event_time.day)
-                    else:
-                        event_time_day = str(event_time.day)
-                    events.append({\
-                        'author': \
-                            events_QML.events[i].preferred_magnitude().creation_info.author or \
-								events_QML.events[i].magnitudes[0].creation_info.author, \
-                        'event_id': str(event_time.year) + event_time_month + \
-                                     event_time_day + '_' + str(i), \
-                        'origin_id': events_QML.events[i].preferred_origin_id or \
-										events_QML.events[i].origins[0].resource_id.resource_id, \
-                        'longitude': events_QML.events[i].preferred_origin().longitude or \
-										events_QML.events[i].origins[0].longitude, \
-                        'latitude': events_QML.events[i].preferred_origin().latitude or \
-										events_QML.events[i].origins[0].latitude, \
-                        'datetime': event_time, \
-                        'depth': -events_QML.events[i].preferred_origin().depth or \
-										-events_QML.events[i].origins[0].depth, \
-                        'magnitude': events_QML.events[i].preferred_magnitude().mag or \
-										events_QML.events[i].magnitudes[0].mag, \
-                        'magnitude_type': \
-                            events_QML.events[i].preferred_magnitude().magnitude_type.lower() or \
-										events_QML.events[i].magnitudes[0].magnitude_type.lower(), \
-                        'flynn_region': 'NAN'})
-            except Exception, e:
-                print 30*'-'
-                print e
-                print 30*'-'
-                events = []
-        for i in range(0, len(events)):
-            #client_iris.flinnengdahl(lat=-1.196, lon=121.33, rtype="code")
-            events[i]['t1'] = events[i]['datetime'] - input['preset']
-            events[i]['t2'] = events[i]['datetime'] + input['offset']
+        print input['event_catalog']
+        if input['event_cache'] == 'Y':
+            events = events_cache(params, input['min_date'], \
+                            input['max_date'], address = \
+                            os.path.join(input['datapath'], 'EVENTS-CACHE'), \
+                            num_proc = input['event_np'])
+        else:
+            events = events_paged(params, \
+                            [(input['min_date'], input['max_date'])], \
+                            num_proc = input['event_np'])[0][0]
+        if input['event_catalog'] == 'IRIS':
+            # event_id: date and the number of the event in the order of
+            # IRIS (the newest first) as for one request: the same ids
+            # as the existing archives (the pages are sorted by time)
+            num_iris = np.argsort(-events['datetime'], kind = 'mergesort')
+            for i in range(0, len(events)):
+                events['event_id'][num_iris[i]] = UTCDateTime(\
+                        events['datetime'][num_iris[i]]).strftime('%Y%m%d') + \
+                        '_' + str(i)
+        #client_iris.flinnengdahl(lat=-1.196, lon=121.33, rtype="code")
+        events['t1'] = events['datetime'] - input['preset']
+        events['t2'] = events['datetime'] + input['offset']
+        events = events_list(events)
     elif request == 'continuous':
         print 'Start identifying the intervals...',
         m_date = UTCDateTime(input['min_date'])
@@ -1642,6 +2162,7 @@ def seismicity():
     if input['evlatmin'] == None:
         input['evlatmin']=-90;input['evlatmax']=+90
         input['evlonmin']=-180;input['evlonmax']=+180
+    plt.figure()
     m = Basemap(projection='cyl',llcrnrlat=input['evlatmin'],\
         urcrnrlat=input['evlatmax'], llcrnrlon=input['evlonmin'],\
         urcrnrlon=input['evlonmax'],resolution='l')
@@ -1651,47 +2172,65 @@ def seismicity():
     m.drawmeridians(np.arange(0.,420.,60.))
     m.drawmapboundary()
     
-    # Defining Labels:
-    x_ev, y_ev = m(-360, 0)
-    m.scatter(x_ev, y_ev, 20, color='red', marker="o", \
-                edgecolor="black", zorder=10, label = '0-70km')
-    m.scatter(x_ev, y_ev, 20, color='green', marker="o", \
-                edgecolor="black", zorder=10, label = '70-300km')
-    m.scatter(x_ev, y_ev, 20, color='blue', marker="o", \
-                edgecolor="black", zorder=10, label = '300< km')
-    
-    m.scatter(x_ev, y_ev, 5, color='white', marker="o", \
-                edgecolor="black", zorder=10, label = '<=4.0')
-    m.scatter(x_ev, y_ev, 20, color='white', marker="o", \
-                edgecolor="black", zorder=10, label = '4.0-5.0')
-    m.scatter(x_ev, y_ev, 35, color='white', marker="o", \
-                edgecolor="black", zorder=10, label = '5.0-6.0')
-    m.scatter(x_ev, y_ev, 50, color='white', marker="o", \
-                edgecolor="black", zorder=10, label = '6.0<')
-    
-    for i in range(0, len(events)):
-        x_ev, y_ev = m(float(events[i]['longitude']), float(events[i]['latitude']))
-        if abs(float(events[i]['depth'])) <= 70.0:
-            color = 'red'
-        elif 70.0 < abs(float(events[i]['depth'])) <= 300.0:
-            color = 'green'
-        elif 300.0 < abs(float(events[i]['depth'])) <= 1000.0:
-            color = 'blue'
-        
-        if float(events[i]['magnitude']) <= 4.0:
-            size = 5
-        elif 4.0 < float(events[i]['magnitude']) <= 5.0:
-            size = 20
-        elif 5.0 < float(events[i]['magnitude']) <= 6.0:
-            size = 35
-        elif 6.0 < float(events[i]['magnitude']):
-            size = 50
+    events_tab = events_table(events)
+    sel = np.isfinite(events_tab['longitude']) & \
+                                np.isfinite(events_tab['latitude'])
+    events_tab = events_tab[sel]
+    # all the events are projected in one call
+    x_ev, y_ev = m(events_tab['longitude'], events_tab['latitude'])
+    
+    seis_mode = input['seismicity_mode']
+    if seis_mode == 'auto':
+        if len(events_tab) > 20000:
+            seis_mode = 'density'
+        else:
+            seis_mode = 'scatter'
+    print 'Number of events: %s (%s)' %(len(events_tab), seis_mode)
+    
+    if seis_mode == 'density':
+        # 2-D histogram of the events for very large catalogs
+        ev_hex = plt.hexbin(x_ev, y_ev, gridsize=180, bins='log', \
+                            mincnt=1, cmap=plt.cm.hot_r, zorder=10)
+        ev_cb = plt.colorbar(ev_hex, orientation='horizontal', \
+                                                    shrink=0.8, pad=0.05)
+        ev_cb.set_label('log10(number of events)')
+    else:
+        # Defining Labels:
+        x_lab, y_lab = m(-360, 0)
+        depth_colors = ['red', 'green', 'blue']
+        depth_labels = ['0-70km', '70-300km', '300< km']
+        mag_sizes = np.array([5, 20, 35, 50])
+        mag_labels = ['<=4.0', '4.0-5.0', '5.0-6.0', '6.0<']
+        for k in range(0, len(depth_colors)):
+            m.scatter(x_lab, y_lab, 20, color=depth_colors[k], marker="o", \
+                        edgecolor="black", zorder=10, label = depth_labels[k])
+        for k in range(0, len(mag_sizes)):
+            m.scatter(x_lab, y_lab, mag_sizes[k], color='white', marker="o", \
+                        edgecolor="black", zorder=10, label = mag_labels[k])
         
-        m.scatter(x_ev, y_ev, size,\
-                color=color, marker="o", \
-                edgecolor="black", zorder=10)
-    plt.legend(bbox_to_anchor=(1.01, 1), loc=2, borderaxespad=0.)
-    plt.show()
+        # classes: (a, b] intervals as in the labels
+        depth_class = np.searchsorted([70.0, 300.0], \
+                                np.abs(np.nan_to_num(events_tab['depth'])))
+        mag_class = np.searchsorted([4.0, 5.0, 6.0], \
+                                np.nan_to_num(events_tab['magnitude']))
+        size = mag_sizes[mag_class]
+        # one scatter for each depth class
+        for k in range(0, len(depth_colors)):
+            sel = (depth_class == k)
+            if not sel.any():
+                continue
+            m.scatter(x_ev[sel], y_ev[sel], size[sel], \
+                    color=depth_colors[k], marker="o", \
+                    edgecolor="black", zorder=10)
+        plt.legend(bbox_to_anchor=(1.01, 1), loc=2, borderaxespad=0.)
+    
+    print '\nSaving the plot in the following address:'
+    print os.path.join(input['plot_save'], 'seismicity.' + \
+                                                input['plot_format'])
+    plt.savefig(os.path.join(input['plot_save'], 'seismicity.' + \
+                                                input['plot_format']), \
+                                                bbox_inches='tight')
+    plt.close()
 
 ###################### IRIS_network ####################################
 
@@ -1725,6 +2264,9 @@ def IRIS_network(input):
         t_iris_2 = datetime.now()
         t_iris = t_iris_2 - t_iris_1
         print 'Time for checking the availability: ' + str(t_iris)
+        Stas_iris = chan_preference(input, Stas_iris)
+        Stas_iris = filter_request(input, events[i], Stas_iris, \
+                                address = os.path.join(target_path, 'info'))
         if Stas_iris:
             IRIS_waveform(input, Stas_iris, i, type = 'save')
         else:
@@ -1740,7 +2282,10 @@ def IRIS_available(input, event, target_path, event_number):
     client_iris = Client_iris()
     Sta_iris = []
     try:       
-        available = client_iris.availability(network=input['net'], \
+        # the XML file is written to the disk and parsed channel by 
+        # channel (never kept as one string in the memory)
+        avail_xml = os.path.join(target_path, 'info', 'availability.xml')
+        client_iris.availability(network=input['net'], \
             station=input['sta'], location=input['loc'], \
             channel=input['cha'], \
             starttime=UTCDateTime(event['t1']), \
@@ -1749,8 +2294,14 @@ def IRIS_available(input, event, target_path, event_number):
             lon=input['lon_cba'], minradius=input['mr_cba'], \
             maxradius=input['Mr_cba'], minlat=input['mlat_rbb'], \
             maxlat=input['Mlat_rbb'], minlon=input['mlon_rbb'], \
-            maxlon=input['Mlon_rbb'], output='xml')
-        Sta_iris = XML_list_avail(xmlfile = available)
+            maxlon=input['Mlon_rbb'], filename = avail_xml, output='xml')
+        avail_open = open(avail_xml, 'rb')
+        try:
+            for sta_avail in XML_iter_avail(xmlfile = avail_open):
+                Sta_iris.append(sta_avail)
+        finally:
+            avail_open.close()
+            os.remove(avail_xml)
         if input['iris_bulk'] == 'Y':
             if os.path.exists(os.path.join(target_path,\
                                     'info', 'bulkdata.txt')):
@@ -1818,7 +2369,7 @@ def read_list_stas(add_list, specfem3D):
 
 ###################### IRIS_waveform ###############################
 
-def IRIS_waveform(input, Sta_req, i, type):
+def IRIS_waveform(input, Sta_req, i, type, t_spans = None):
     """
     Gets Waveforms, Response files and meta-data 
     from IRIS DMC based on the requested events...
@@ -1846,6 +2397,9 @@ def IRIS_waveform(input, Sta_req, i, type):
     if input['iris_bulk'] == 'Y':
         t11 = datetime.now()
         bulk_file = os.path.join(add_event[i], 'info', 'bulkdata.txt')
+        if input['req_min_epi'] != None or input['req_min_azi'] != None or \
+                input['req_azi_bin'] != None or input['chan_pref'] != None:
+            filter_bulkfile(bulk_file, Sta_req)
         if input['req_parallel'] == 'Y':
             num_lines=1000; bulk_enum=0; bulk_num_files=1
             bulkfile_new=open(os.path.join(add_event[i], 'info', 'bulk_split_0.txt'), 'wb')
@@ -1891,6 +2445,22 @@ def IRIS_waveform(input, Sta_req, i, type):
     
     dic = {}                
     print '\nIRIS-Event: %s/%s' %(i+1, len_events)
+    if input['cut_time_phase']:
+        t_windows = calculate_time_phase_all(events[i], Sta_req, \
+                        address = os.path.join(add_event[i], 'info'))
+    else:
+        t_windows = None
+    if t_spans:
+        # saved channels that miss parts of the time window (update):
+        # the response covers all the missing spans
+        if not t_windows:
+            t_windows = [None] * len(Sta_req)
+        for j in range(0, len(Sta_req)):
+            sta_id = Sta_req[j][0] + '.' + Sta_req[j][1] + '.' + \
+                                        Sta_req[j][2] + '.' + Sta_req[j][3]
+            if sta_id in t_spans:
+                t_windows[j] = (t_spans[sta_id][0][0], \
+                                                t_spans[sta_id][-1][1])
     if input['req_parallel'] == 'Y':
         print "Parallel request with %s processes.\n" %(input['req_np'])
         parallel_results = pprocess.Map(limit=input['req_np'], reuse=1)
@@ -1899,14 +2469,16 @@ def IRIS_waveform(input, Sta_req, i, type):
             parallel_job(i = i, j = j, dic = dic, type = type, \
                             len_events = len_events, \
                             events = events, add_event = add_event, \
-                            Sta_req = Sta_req, input = input)
+                            Sta_req = Sta_req, input = input, \
+                            t_windows = t_windows, t_spans = t_spans)
         parallel_results.finish()
     else:
         for j in range(0, len_req_iris):
             IRIS_download_core(i = i, j = j, dic = dic, type = type, \
                                 len_events = len_events, \
                                 events = events, add_event = add_event, \
-                                Sta_req = Sta_req, input = input)
+                                Sta_req = Sta_req, input = input, \
+                                t_windows = t_windows, t_spans = t_spans)
     try:
         if bulk_parallel_tmp_flag:
             input['req_parallel'] = 'Y'
@@ -1915,7 +2487,7 @@ def IRIS_waveform(input, Sta_req, i, type):
    
     if input['iris_bulk'] == 'Y':
         input['waveform'] = 'Y'
-        sta_saved_path = glob.glob(os.path.join(add_event[i], 'BH_RAW', '*.*.*.*'))
+        sta_saved_path = waveform_glob(os.path.join(add_event[i], 'BH_RAW'))
         print '\nAdjusting the station_event file...',
         sta_saved_list = []
         sta_ev_new = []
@@ -1931,10 +2503,20 @@ def IRIS_waveform(input, Sta_req, i, type):
         file_staev_open.writelines(sta_ev_new)
         file_staev_open.close()
         print 'DONE'
-    if input['SAC'] == 'Y':
+    # the channels of the event in the metadata catalog
+    db_channels_sync([add_event[i]])
+    # streaming: converted in the download, packed after the correction
+    ic_streamed = IC_streamed(input, 'iris', type)
+    if ic_streamed and not add_event[i] in input['ic_spool_events']:
+        input['ic_spool_events'].append(add_event[i])
+    if input['SAC'] == 'Y' and not ic_streamed:
         print '\nConverting the MSEED files to SAC...',
         writesac_all(i = i, events = events, address_events = add_event)
         print 'DONE'
+    if input['container'] == 'Y' and not ic_streamed:
+        print '\nPacking the waveforms...',
+        volume_pack(os.path.join(add_event[i], 'BH_RAW'))
+        print 'DONE'
    
     #len_sta_ev_open=open(os.path.join(add_event[i], 'info', 'station_event'), 'r')
     #len_sta_ev=len(len_sta_ev_open.readlines())
@@ -2009,7 +2591,8 @@ def bulk_download_core(bulk_file, add_event):
 
 ###################### IRIS_download_core ##################################
 
-def IRIS_download_core(i, j, dic, type, len_events, events, add_event, Sta_req, input):
+def IRIS_download_core(i, j, dic, type, len_events, events, add_event, Sta_req, input, \
+                        t_windows = None, t_spans = None):
     
     try:
         dummy = 'Initializing'
@@ -2020,20 +2603,36 @@ def IRIS_download_core(i, j, dic, type, len_events, events, add_event, Sta_req,
         info_req = '['+str(i+1)+'/'+str(len_events)+'-'+\
                     str(j+1)+'/'+str(len(Sta_req))+'-'+input['cha']+'] ' 
 
-        if input['cut_time_phase']:
+        if t_windows and t_windows[j]:
+            t_start, t_end = t_windows[j]
+        elif input['cut_time_phase']:
             t_start, t_end = calculate_time_phase(events[i], Sta_req[j])
         else:
             t_start = events[i]['t1']
             t_end = events[i]['t2']
+        # saved channel: only the missing spans are retrieved and merged
+        t_span = None
+        if t_spans:
+            t_span = t_spans.get(Sta_req[j][0] + '.' + Sta_req[j][1] + \
+                        '.' + Sta_req[j][2] + '.' + Sta_req[j][3])
         
         if input['waveform'] == 'Y':                    
             dummy = 'Waveform'
-            client_iris.saveWaveform(os.path.join(add_event[i], 'BH_RAW', \
+            address_st = os.path.join(add_event[i], 'BH_RAW', \
                 Sta_req[j][0] + '.' + Sta_req[j][1] + '.' + \
-                Sta_req[j][2] + '.' + Sta_req[j][3]), \
-                Sta_req[j][0], Sta_req[j][1], \
-                Sta_req[j][2], Sta_req[j][3], \
-                t_start, t_end)
+                Sta_req[j][2] + '.' + Sta_req[j][3])
+            if t_span:
+                update_save(address_st, t_span, \
+                    lambda address_up, t_up_1, t_up_2: \
+                    client_iris.saveWaveform(address_up, \
+                    Sta_req[j][0], Sta_req[j][1], \
+                    Sta_req[j][2], Sta_req[j][3], \
+                    t_up_1, t_up_2))
+            else:
+                client_iris.saveWaveform(address_st, \
+                    Sta_req[j][0], Sta_req[j][1], \
+                    Sta_req[j][2], Sta_req[j][3], \
+                    t_start, t_end)
             print str(info_req) + "Saving Waveform for: " + Sta_req[j][0] + \
                 '.' + Sta_req[j][1] + '.' + \
                 Sta_req[j][2] + '.' + Sta_req[j][3] + "  ---> DONE"  
@@ -2082,7 +2681,9 @@ def IRIS_download_core(i, j, dic, type, len_events, events, add_event, Sta_req,
                 + ',' + str(events[i]['longitude']) + ',' + \
                 str(events[i]['depth']) + ',' + \
                 str(events[i]['magnitude']) + ',' + 'iris' + ',' + '\n'
-        Syn_file.writelines(syn)
+        # saved channels (t_span) are already in the station_event
+        if not t_span:
+            Syn_file.writelines(syn)
         Syn_file.close()
         '''
         if input['SAC'] == 'Y':
@@ -2091,6 +2692,8 @@ def IRIS_download_core(i, j, dic, type, len_events, events, add_event, Sta_req,
                 Sta_req[j][2] + '.' + Sta_req[j][3]), \
                 sta_info = dic[j], ev_info = events[i])
         '''
+        if input['ic_spool'] and type == 'save':
+            IC_stream_put(input, 'iris', add_event[i], dic[j], events[i])
         print str(info_req) + "Saving Metadata for: " + Sta_req[j][0] + \
             '.' + Sta_req[j][1] + '.' + \
             Sta_req[j][2] + '.' + Sta_req[j][3] + "  ---> DONE"
@@ -2147,6 +2750,11 @@ def calculate_time_phase(event, sta):
     calculate arrival time of the requested phase to use in 
     retrieving waveforms.
     """
+    t_windows = calculate_time_phase_all(event, [sta])
+    if t_windows[0]:
+        return t_windows[0]
+    
+    # the station is outside of the travel-time table: ask taup directly
     ev_lat = event['latitude']
     ev_lon = event['longitude']
     ev_dp = abs(float(event['depth']))
@@ -2171,6 +2779,361 @@ def calculate_time_phase(event, sta):
     t_end = event['t2'] + time
     return t_start, t_end 
 
+###################### calculate_time_phase_all ##############################
+
+def calculate_time_phase_all(event, Sta_req, address = None):
+    
+    """
+    calculate the time window (based on the first arrival: P, Pdiff 
+    or PKIKP) for all the stations of one event in one call.
+    Returns a list of (t_start, t_end) with the same length as Sta_req,
+    None for the stations that could not be handled by the table.
+    address: "info" folder of the event to cache the geometry.
+    """
+    global input
+    
+    t_windows = [None] * len(Sta_req)
+    num_sta = []
+    sta_id = []
+    sta_lat = []
+    sta_lon = []
+    for j in range(0, len(Sta_req)):
+        try:
+            sta_lat.append(float(Sta_req[j][4]))
+            sta_lon.append(float(Sta_req[j][5]))
+            sta_id.append(Sta_req[j][0] + '.' + Sta_req[j][1] + '.' + \
+                            Sta_req[j][2] + '.' + Sta_req[j][3])
+            num_sta.append(j)
+        except Exception, e:
+            continue
+    if not num_sta:
+        return t_windows
+    
+    tt_grid = tt_table(address = input['datapath'])
+    delta = geometry_event(address, event['latitude'], \
+                        event['longitude'], sta_id, sta_lat, sta_lon)[0]
+    ev_dp = np.ones(len(delta)) * abs(float(event['depth']))
+    tt = tt_interpolate(tt_grid, delta, ev_dp)
+    
+    for k in range(0, len(num_sta)):
+        if np.isnan(tt[k]):
+            continue
+        t_windows[num_sta[k]] = (event['t1'] + float(tt[k]), \
+                                    event['t2'] + float(tt[k]))
+    return t_windows
+
+###################### tt_table ########################################
+
+def tt_table(address, dist_step = 1.0, depth_step = 10.0, max_depth = 700.0):
+    
+    """
+    Returns the travel-time table of the first arrival (P, Pdiff, PKIKP
+    in this order) on a (depth x distance) grid and the phase of each
+    node (index in P, Pdiff, PKIKP, -1: no arrival).
+    The table is calculated once by taup and stored in 
+    "address/tt_table_..." for the next runs (rebuilt if it can not
+    be read).
+    """
+    
+    global tt_grid
+    
+    tt_name = 'tt_table_P_Pdiff_PKIKP_' + str(dist_step) + '_' + \
+                        str(depth_step) + '_' + str(max_depth) + '.npz'
+    tt_file = os.path.join(address, tt_name)
+    
+    if tt_grid and tt_grid['name'] == tt_name:
+        return tt_grid
+    
+    if os.path.isfile(tt_file):
+        try:
+            tt_npz = np.load(tt_file)
+            tt_grid = {'name': tt_name, 'dist': tt_npz['dist'], \
+                        'depth': tt_npz['depth'], 'time': tt_npz['time'], \
+                        'phase': tt_npz['phase']}
+            return tt_grid
+        except Exception, e:
+            print 'Could not read the travel-time table: %s' %(e)
+    
+    print '\nCreating the travel-time table (only once)...',
+    sys.stdout.flush()
+    dist_ax = np.arange(0., 180. + dist_step/2., dist_step)
+    depth_ax = np.arange(0., max_depth + depth_step/2., depth_step)
+    tt_time = np.empty((len(depth_ax), len(dist_ax)))
+    tt_time.fill(np.nan)
+    tt_phase = -np.ones((len(depth_ax), len(dist_ax)), dtype = np.int8)
+    phase_list = ['P', 'Pdiff', 'PKIKP']
+    for i in range(0, len(depth_ax)):
+        for j in range(0, len(dist_ax)):
+            try:
+                tt = taup.getTravelTimes(dist_ax[j], depth_ax[i])
+            except Exception, e:
+                continue
+            tt_ph = {}
+            for k in range(len(tt)):
+                if not tt[k]['phase_name'] in tt_ph:
+                    tt_ph[tt[k]['phase_name']] = tt[k]['time']
+            for k in range(0, len(phase_list)):
+                if phase_list[k] in tt_ph:
+                    tt_time[i, j] = tt_ph[phase_list[k]]
+                    tt_phase[i, j] = k
+                    break
+    print 'DONE'
+    
+    try:
+        if not os.path.isdir(address):
+            os.makedirs(address)
+        # written to a temporary file: the table appears complete
+        tt_tmp = tt_file + '.' + str(os.getpid())
+        tt_npz = open(tt_tmp, 'wb')
+        np.savez(tt_npz, dist = dist_ax, depth = depth_ax, time = tt_time, \
+                                                        phase = tt_phase)
+        tt_npz.close()
+        os.rename(tt_tmp, tt_file)
+    except Exception, e:
+        print 'Could not save the travel-time table: %s' %(e)
+    
+    tt_grid = {'name': tt_name, 'dist': dist_ax, \
+                    'depth': depth_ax, 'time': tt_time, 'phase': tt_phase}
+    return tt_grid
+
+###################### tt_interpolate ##################################
+
+def tt_interpolate(tt_grid, dist, depth):
+    
+    """
+    Bilinear interpolation of the travel-time table (tt_table) for 
+    arrays of epicentral distances (deg) and depths (km).
+    NaN is returned where one of the surrounding nodes has no arrival
+    or where the nodes have different phases (no real arrival between
+    them): these stations are calculated by taup.
+    """
+    
+    dist_ax = tt_grid['dist']
+    depth_ax = tt_grid['depth']
+    tt_time = tt_grid['time']
+    
+    dist = np.clip(np.asarray(dist, dtype=float), dist_ax[0], dist_ax[-1])
+    depth = np.clip(np.asarray(depth, dtype=float), depth_ax[0], depth_ax[-1])
+    
+    ix = np.clip(np.searchsorted(dist_ax, dist, side='right') - 1, \
+                                                    0, len(dist_ax) - 2)
+    iz = np.clip(np.searchsorted(depth_ax, depth, side='right') - 1, \
+                                                    0, len(depth_ax) - 2)
+    wx = (dist - dist_ax[ix]) / (dist_ax[ix+1] - dist_ax[ix])
+    wz = (depth - depth_ax[iz]) / (depth_ax[iz+1] - depth_ax[iz])
+    
+    tt = (1. - wz) * ((1. - wx) * tt_time[iz, ix] + wx * tt_time[iz, ix+1]) + \
+            wz * ((1. - wx) * tt_time[iz+1, ix] + wx * tt_time[iz+1, ix+1])
+    
+    tt_phase = tt_grid['phase']
+    phase_mixed = (tt_phase[iz, ix] != tt_phase[iz, ix+1]) | \
+                  (tt_phase[iz, ix] != tt_phase[iz+1, ix]) | \
+                  (tt_phase[iz, ix] != tt_phase[iz+1, ix+1])
+    tt = np.where(phase_mixed, np.nan, tt)
+    return tt
+
+###################### chan_preference #################################
+
+def chan_preference(input, Sta_req):
+    
+    """
+    Keep only one set of co-located channels for each station (net.sta)
+    based on the preferences given in chan_pref, in this order:
+    - band/instrument code (eg: BH > HH)
+    - location code (eg: 00 > 10 > --)
+    - orientation (eg: ZNE > Z12)
+    If none of the preferred codes is available for a station, all the 
+    channels of that station are kept.
+    """
+    
+    if not input['chan_pref']:
+        return Sta_req
+    
+    sta_rows = {}
+    sta_order = []
+    for j in range(0, len(Sta_req)):
+        if len(Sta_req[j]) < 4:
+            continue
+        net_sta = Sta_req[j][0] + '.' + Sta_req[j][1]
+        if not net_sta in sta_rows:
+            sta_rows[net_sta] = []
+            sta_order.append(net_sta)
+        sta_rows[net_sta].append(j)
+    if not sta_order:
+        return Sta_req
+    
+    keep = []
+    for net_sta in sta_order:
+        rows = sta_rows[net_sta]
+        if input['chan_pref_band']:
+            rows = chan_preference_code(Sta_req, rows, \
+                        input['chan_pref_band'], lambda sta: sta[3][:2])
+        if input['chan_pref_loc']:
+            rows = chan_preference_code(Sta_req, rows, \
+                        input['chan_pref_loc'], lambda sta: \
+                        (sta[2].strip() or '--'))
+        if input['chan_pref_orient']:
+            comps = set([Sta_req[j][3][2:] for j in rows])
+            orient_best = None
+            num_best = 0
+            for orient in input['chan_pref_orient']:
+                num_orient = len(comps.intersection(orient))
+                if num_orient > num_best:
+                    orient_best = orient
+                    num_best = num_orient
+            if orient_best:
+                rows = [j for j in rows if Sta_req[j][3][2:] in orient_best]
+        keep.extend(rows)
+    keep.sort()
+    
+    Sta_req_new = [Sta_req[j] for j in keep]
+    
+    print '------------------------------------------'
+    print 'Info:'
+    print 'Number of all available channels: ' + str(len(Sta_req))
+    print 'Number of channels after applying the channel preferences: ' + \
+                                                    str(len(Sta_req_new))
+    print '------------------------------------------'
+    
+    if len(Sta_req_new) == 0:
+        Sta_req_new.append([])
+    return Sta_req_new
+
+###################### chan_preference_code ############################
+
+def chan_preference_code(Sta_req, rows, pref, code):
+    
+    """
+    Returns the rows of Sta_req with the best available code 
+    (the first one in pref). All the rows are returned if none of the 
+    codes in pref is available.
+    """
+    
+    codes = set([code(Sta_req[j]) for j in rows])
+    for code_pref in pref:
+        if code_pref in codes:
+            return [j for j in rows if code(Sta_req[j]) == code_pref]
+    return rows
+
+###################### filter_request ##################################
+
+def filter_request(input, event, Sta_req, address = None):
+    
+    """
+    Restrict the list of the requested stations (Sta_req) before 
+    sending the waveform/response requests based on:
+    - epicentral distance (req_epi)
+    - azimuth from the event to the station (req_azi)
+    - maximum number of stations in each azimuth bin (req_azi_bin), 
+      the closest stations to the event are kept.
+    address: "info" folder of the event to cache the geometry.
+    """
+    
+    if input['req_min_epi'] == None and input['req_min_azi'] == None and \
+                                        input['req_azi_bin'] == None:
+        return Sta_req
+    if float(event['latitude']) == -12345.0:
+        # continuous requests do not have any event location
+        return Sta_req
+    
+    num_sta = []
+    sta_id = []
+    sta_lat = []
+    sta_lon = []
+    for j in range(0, len(Sta_req)):
+        try:
+            sta_lat.append(float(Sta_req[j][4]))
+            sta_lon.append(float(Sta_req[j][5]))
+            sta_id.append(Sta_req[j][0] + '.' + Sta_req[j][1] + '.' + \
+                            Sta_req[j][2] + '.' + Sta_req[j][3])
+            num_sta.append(j)
+        except Exception, e:
+            continue
+    if not num_sta:
+        return Sta_req
+    
+    dist, az, baz = geometry_event(address, event['latitude'], \
+                        event['longitude'], sta_id, sta_lat, sta_lon)
+    keep = np.ones(len(num_sta), dtype=bool)
+    
+    if input['req_min_epi'] != None:
+        keep &= (dist >= input['req_min_epi']) & (dist <= input['req_max_epi'])
+    
+    if input['req_min_azi'] != None:
+        if input['req_min_azi'] <= input['req_max_azi']:
+            keep &= (az >= input['req_min_azi']) & (az <= input['req_max_azi'])
+        else:
+            # azimuth range crosses the north (eg: 300/60)
+            keep &= (az >= input['req_min_azi']) | (az <= input['req_max_azi'])
+    
+    if input['req_azi_bin'] != None:
+        # all the channels of one station (net.sta) are kept or removed 
+        # together; stations are counted from the closest one
+        azi_bin = np.floor(az / input['req_azi_bin']).astype(int)
+        bin_stas = {}
+        sta_bin = {}
+        for k in np.argsort(dist, kind='mergesort'):
+            if not keep[k]:
+                continue
+            net_sta = Sta_req[num_sta[k]][0] + '.' + Sta_req[num_sta[k]][1]
+            if not net_sta in sta_bin:
+                sta_bin[net_sta] = azi_bin[k]
+                bin_stas.setdefault(azi_bin[k], [])
+                if len(bin_stas[azi_bin[k]]) < input['req_azi_bin_max']:
+                    bin_stas[azi_bin[k]].append(net_sta)
+            if not net_sta in bin_stas[sta_bin[net_sta]]:
+                keep[k] = False
+    
+    Sta_req_new = []
+    for k in range(0, len(num_sta)):
+        if keep[k]:
+            Sta_req_new.append(Sta_req[num_sta[k]])
+    
+    print '------------------------------------------'
+    print 'Info:'
+    print 'Number of all available stations: ' + str(len(num_sta))
+    print 'Number of stations after the epicentral/azimuth restrictions: ' + \
+                                                    str(len(Sta_req_new))
+    print '------------------------------------------'
+    
+    if len(Sta_req_new) == 0:
+        Sta_req_new.append([])
+    return Sta_req_new
+
+###################### filter_bulkfile #################################
+
+def filter_bulkfile(bulk_file, Sta_req):
+    
+    """
+    Remove the lines of the bulkdataselect file (bulkdata.txt) that 
+    are not in the (restricted) list of the requested stations.
+    """
+    
+    sta_req_set = set()
+    for sta in Sta_req:
+        if len(sta) < 4:
+            continue
+        loc = sta[2]
+        if loc == '' or loc == '  ':
+            loc = '--'
+        sta_req_set.add(sta[0] + '.' + sta[1] + '.' + loc + '.' + sta[3])
+    
+    bulk_new = []
+    for line in fileinput.FileInput(bulk_file):
+        line_split = line.split()
+        if len(line_split) < 4:
+            bulk_new.append(line)
+            continue
+        loc = line_split[2]
+        if loc == '' or loc == '  ':
+            loc = '--'
+        if line_split[0] + '.' + line_split[1] + '.' + loc + '.' + \
+                                        line_split[3] in sta_req_set:
+            bulk_new.append(line)
+    bulk_open = open(bulk_file, 'w')
+    bulk_open.writelines(bulk_new)
+    bulk_open.close()
+
 ###################### Arclink_network #################################
 
 def ARC_network(input):
@@ -2201,6 +3164,9 @@ def ARC_network(input):
         t_arc_2 = datetime.now()
         t_arc_21 = t_arc_2 - t_arc_1
         print 'Time for checking the availability: ' + str(t_arc_21)
+        Stas_arc = chan_preference(input, Stas_arc)
+        Stas_arc = filter_request(input, events[i], Stas_arc, \
+                                address = os.path.join(target_path, 'info'))
         
         if Stas_arc:
             ARC_waveform(input, Stas_arc, i, type = 'save')
@@ -2262,7 +3228,7 @@ def ARC_available(input, event, target_path, event_number):
 
 ###################### Arclink_waveform ############################
 
-def ARC_waveform(input, Sta_req, i, type):
+def ARC_waveform(input, Sta_req, i, type, t_spans = None):
     """
     Gets Waveforms, Response files and meta-data 
     from ArcLink based on the requested events...
@@ -2289,6 +3255,22 @@ def ARC_waveform(input, Sta_req, i, type):
         len_req_arc = len(Sta_req)       
     dic = {}
     print '\nArcLink-Event: %s/%s' %(i+1, len_events)
+    if input['cut_time_phase']:
+        t_windows = calculate_time_phase_all(events[i], Sta_req, \
+                        address = os.path.join(add_event[i], 'info'))
+    else:
+        t_windows = None
+    if t_spans:
+        # saved channels that miss parts of the time window (update):
+        # the response covers all the missing spans
+        if not t_windows:
+            t_windows = [None] * len(Sta_req)
+        for j in range(0, len(Sta_req)):
+            sta_id = Sta_req[j][0] + '.' + Sta_req[j][1] + '.' + \
+                                        Sta_req[j][2] + '.' + Sta_req[j][3]
+            if sta_id in t_spans:
+                t_windows[j] = (t_spans[sta_id][0][0], \
+                                                t_spans[sta_id][-1][1])
     if input['req_parallel'] == 'Y':
         print "Parallel request with %s processes.\n" %(input['req_np'])
         parallel_results = pprocess.Map(limit=input['req_np'], reuse=1)
@@ -2298,18 +3280,30 @@ def ARC_waveform(input, Sta_req, i, type):
             parallel_job(i = i, j = j, dic = dic, type = type, \
                             len_events = len_events, \
                             events = events, add_event = add_event, \
-                            Sta_req = Sta_req, input = input)
+                            Sta_req = Sta_req, input = input, \
+                            t_windows = t_windows, t_spans = t_spans)
         parallel_results.finish()
     else:
         for j in range(0, len_req_arc):
             ARC_download_core(i = i, j = j, dic = dic, type = type, \
                             len_events = len_events, \
                             events = events, add_event = add_event, \
-                            Sta_req = Sta_req, input = input)
-    if input['SAC'] == 'Y':
+                            Sta_req = Sta_req, input = input, \
+                            t_windows = t_windows, t_spans = t_spans)
+    # the channels of the event in the metadata catalog
+    db_channels_sync([add_event[i]])
+    # streaming: converted in the download, packed after the correction
+    ic_streamed = IC_streamed(input, 'arc', type)
+    if ic_streamed and not add_event[i] in input['ic_spool_events']:
+        input['ic_spool_events'].append(add_event[i])
+    if input['SAC'] == 'Y' and not ic_streamed:
         print '\nConverting the MSEED files to SAC...',
         writesac_all(i = i, events = events, address_events = add_event)
         print 'DONE'
+    if input['container'] == 'Y' and not ic_streamed:
+        print '\nPacking the waveforms...',
+        volume_pack(os.path.join(add_event[i], 'BH_RAW'))
+        print 'DONE'
     Report = open(os.path.join(add_event[i], 'info', 'report_st'), 'a')
     eventsID = events[i]['event_id']
     Report.writelines('<><><><><><><><><><><><><><><><><>' + '\n')
@@ -2354,7 +3348,8 @@ def ARC_waveform(input, Sta_req, i, type):
 
 ###################### ARC_download_core ###############################
 
-def ARC_download_core(i, j, dic, type, len_events, events, add_event, Sta_req, input):
+def ARC_download_core(i, j, dic, type, len_events, events, add_event, Sta_req, input, \
+                        t_windows = None, t_spans = None):
  
     try:
         dummy = 'Initializing'
@@ -2364,37 +3359,46 @@ def ARC_download_core(i, j, dic, type, len_events, events, add_event, Sta_req, i
         info_req = '['+str(i+1)+'/'+str(len_events)+'-'+\
                     str(j+1)+'/'+str(len(Sta_req))+'-'+input['cha']+'] ' 
         
-        if input['cut_time_phase']:
+        if t_windows and t_windows[j]:
+            t_start, t_end = t_windows[j]
+        elif input['cut_time_phase']:
             t_start, t_end = calculate_time_phase(events[i], Sta_req[j])
         else:
             t_start = events[i]['t1']
             t_end = events[i]['t2']
+        # saved channel: only the missing spans are retrieved and merged
+        t_span = None
+        if t_spans:
+            t_span = t_spans.get(Sta_req[j][0] + '.' + Sta_req[j][1] + \
+                        '.' + Sta_req[j][2] + '.' + Sta_req[j][3])
         
         if input['waveform'] == 'Y':
             dummy = 'Waveform'
-            try:
-                client_arclink.saveWaveform(os.path.join(add_event[i], \
-                    'BH_RAW', \
-                    Sta_req[j][0] + '.' + Sta_req[j][1] + '.' + \
-                    Sta_req[j][2] + '.' + Sta_req[j][3]), \
-                    Sta_req[j][0], Sta_req[j][1], \
-                    Sta_req[j][2], Sta_req[j][3], \
-                    t_start, t_end)
-            except Exception, e: 
-                print e
-                if input['NERIES'] == 'Y':
-                    print "\nWaveform is not available in ArcLink, trying NERIES!\n"
-                    client_neries.saveWaveform(os.path.join(add_event[i], \
-                        'BH_RAW', \
-                        Sta_req[j][0] + '.' + Sta_req[j][1] + '.' + \
-                        Sta_req[j][2] + '.' + Sta_req[j][3]), \
+            address_st = os.path.join(add_event[i], 'BH_RAW', \
+                Sta_req[j][0] + '.' + Sta_req[j][1] + '.' + \
+                Sta_req[j][2] + '.' + Sta_req[j][3])
+            
+            def save_waveform(address_save, t_save_1, t_save_2):
+                try:
+                    client_arclink.saveWaveform(address_save, \
                         Sta_req[j][0], Sta_req[j][1], \
                         Sta_req[j][2], Sta_req[j][3], \
-                        t_start, t_end)
-            check_file = open(os.path.join(add_event[i], 'BH_RAW', \
-                Sta_req[j][0] + '.' + Sta_req[j][1] + '.' + \
-                Sta_req[j][2] + '.' + Sta_req[j][3]))
-            check_file.close()
+                        t_save_1, t_save_2)
+                except Exception, e: 
+                    print e
+                    if input['NERIES'] == 'Y':
+                        print "\nWaveform is not available in ArcLink, trying NERIES!\n"
+                        client_neries.saveWaveform(address_save, \
+                            Sta_req[j][0], Sta_req[j][1], \
+                            Sta_req[j][2], Sta_req[j][3], \
+                            t_save_1, t_save_2)
+                check_file = open(address_save)
+                check_file.close()
+            
+            if t_span:
+                update_save(address_st, t_span, save_waveform)
+            else:
+                save_waveform(address_st, t_start, t_end)
             print str(info_req) + "Saving Waveform for: " + Sta_req[j][0] + \
                 '.' + Sta_req[j][1] + '.' + \
                 Sta_req[j][2] + '.' + Sta_req[j][3] + "  ---> DONE"  
@@ -2452,7 +3456,9 @@ def ARC_download_core(i, j, dic, type, len_events, events, add_event, Sta_req, i
              + ',' + str(events[i]['longitude']) + ',' + \
              str(events[i]['depth']) + ',' + \
              str(events[i]['magnitude']) + ',' + 'arc' + ',' + '\n'
-        Syn_file.writelines(syn)
+        # saved channels (t_span) are already in the station_event
+        if not t_span:
+            Syn_file.writelines(syn)
         Syn_file.close()
         '''
         if input['SAC'] == 'Y':
@@ -2461,6 +3467,8 @@ def ARC_download_core(i, j, dic, type, len_events, events, add_event, Sta_req, i
                     '.' + Sta_req[j][2] + '.' + Sta_req[j][3]), \
                     sta_info = dic[j], ev_info = events[i])
         '''
+        if input['ic_spool'] and type == 'save':
+            IC_stream_put(input, 'arc', add_event[i], dic[j], events[i])
         print str(info_req) + "Saving Station  for: " + Sta_req[j][0] + '.' + \
             Sta_req[j][1] + '.' + \
             Sta_req[j][2] + '.' + Sta_req[j][3] + "  ---> DONE"
@@ -2531,18 +3539,27 @@ def IRIS_update(input, address):
         else:
             print 'IRIS-bulkfile for event    : ' + str(i+1) + str('/') + \
                                     str(len_events) + '  ---> ' + 'DONE'
+        # the preferences and the restrictions (eg: stations per azimuth
+        # bin) are applied to all the available channels (the saved
+        # ones included) before removing the saved ones
+        Stas_iris = chan_preference(input, Stas_iris)
+        Stas_iris = filter_request(input, events[i], Stas_iris, \
+                    address = os.path.join(address_events[i], 'info'))
         if Stas_iris != [[]]:
-            Stas_req = rm_duplicate(Stas_iris, \
-                            address = os.path.join(address_events[i]))
+            Stas_req, t_spans = update_diff(Stas_iris, \
+                            address = os.path.join(address_events[i], 'info'), \
+                            event = events[i], input = input)
         else:
             Stas_req = [[]]
+            t_spans = {}
             print '------------------------------------------'
             print 'There is no available station!'
             print '------------------------------------------'
         if not os.path.isdir(os.path.join(address_events[i], 'BH_RAW')):
             os.makedirs(os.path.join(address_events[i], 'BH_RAW'))
         if Stas_req:
-            IRIS_waveform(input, Stas_req, i, type = 'update')
+            IRIS_waveform(input, Stas_req, i, type = 'update', \
+                                                        t_spans = t_spans)
         else:
             'No available station in IRIS for your request!'
             continue
@@ -2564,19 +3581,28 @@ def ARC_update(input, address):
         Stas_arc = ARC_available(input, events[i], target_path[i], event_number = i)
         print '\nArcLink-Availability for event: ' + str(i+1) + str('/') + \
                                     str(len_events) + '  --->' + 'DONE'
+        # the preferences and the restrictions (eg: stations per azimuth
+        # bin) are applied to all the available channels (the saved
+        # ones included) before removing the saved ones
+        Stas_arc = chan_preference(input, Stas_arc)
+        Stas_arc = filter_request(input, events[i], Stas_arc, \
+                    address = os.path.join(address_events[i], 'info'))
         
         if Stas_arc != [[]]:
-            Stas_req = rm_duplicate(Stas_arc, \
-                            address = os.path.join(address_events[i]))
+            Stas_req, t_spans = update_diff(Stas_arc, \
+                            address = os.path.join(address_events[i], 'info'), \
+                            event = events[i], input = input)
         else:
             Stas_req = [[]]
+            t_spans = {}
             print '------------------------------------------'
             print 'There is no available station!'
             print '------------------------------------------'
         if not os.path.isdir(os.path.join(address_events[i], 'BH_RAW')):
             os.makedirs(os.path.join(address_events[i], 'BH_RAW'))
         if Stas_req:
-            ARC_waveform(input, Stas_req, i, type = 'update')
+            ARC_waveform(input, Stas_req, i, type = 'update', \
+                                                        t_spans = t_spans)
         else:
             'No available station in ArcLink for your request!'
             continue
@@ -2589,8 +3615,29 @@ def IRIS_ARC_IC(input, clients):
     Call "inst_correct" function based on the channel request.
     """
     
+    ic_events = IC_stations(input, clients)
+    
+    for i in range(0, len(ic_events)):
+        address_event, ls_saved_stas = ic_events[i]
+        if len(ls_saved_stas) != 0:        
+            print '\nevent: ' + str(i+1) + '/' + str(len(ic_events)) + \
+                                             ' -- ' + clients + '\n'
+            inst_correct(input, ls_saved_stas, address_event, clients) 
+        else:
+            print "There is no station in the folder to correct!"
+
+###################### IC_stations #####################################
+
+def IC_stations(input, clients):
+    
+    """
+    Stations of all the events to be corrected (channel request):
+    [(address of the event, [BH_RAW/net.sta.loc.cha, ...]), ...]
+    """
+    
+    global events
+    
     if input[clients + '_ic_auto'] == 'Y':
-        global events        
         Period = input['min_date'].split('T')[0] + '_' + \
                     input['max_date'].split('T')[0] + '_' + \
                     str(input['min_mag']) + '_' + str(input['max_mag'])
@@ -2600,32 +3647,96 @@ def IRIS_ARC_IC(input, clients):
         address = input[clients + '_ic']
     
     events, address_events = quake_info(address, 'info')
-
+    
+    pattern_sta = input['net'] + '.' + input['sta'] + '.' + \
+                    input['loc'] + '.' + input['cha']
+    
+    ic_events = []
     for i in range(0, len(events)):
         sta_ev = read_station_event(address_events[i])
-        ls_saved_stas_tmp = []
         ls_saved_stas = []
         
         for j in range(0, len(sta_ev[0])):
             if clients == sta_ev[0][j][13]:
                 station_id = sta_ev[0][j][0] + '.' + sta_ev[0][j][1] + '.' + \
                              sta_ev[0][j][2] + '.' + sta_ev[0][j][3]
-                ls_saved_stas_tmp.append(os.path.join(address_events[i], 'BH_RAW',\
-                                        station_id))
-        
-        pattern_sta = input['net'] + '.' + input['sta'] + '.' + \
-                        input['loc'] + '.' + input['cha']
+                if fnmatch.fnmatch(station_id, pattern_sta):
+                    ls_saved_stas.append(os.path.join(address_events[i], \
+                                                    'BH_RAW', station_id))
         
-        for k in range(0, len(ls_saved_stas_tmp)):
-            if fnmatch.fnmatch(ls_saved_stas_tmp[k].split('/')[-1], pattern_sta):
-                ls_saved_stas.append(ls_saved_stas_tmp[k])
-        
-        if len(ls_saved_stas) != 0:        
-            print '\nevent: ' + str(i+1) + '/' + str(len(events)) + \
-                                             ' -- ' + clients + '\n'
-            inst_correct(input, ls_saved_stas, address_events[i], clients) 
-        else:
-            print "There is no station in the folder to correct!"
+        ic_events.append((address_events[i], ls_saved_stas))
+    return ic_events
+
+###################### IC_archive ######################################
+
+def IC_archive(input, clients_list):
+    
+    """
+    Instrument correction of all the events of all the clients
+    (clients_list) in one pool of processes (--ic_parallel):
+    the stations of every event are split into chunks and each process
+    takes the next chunk as soon as it is free (the largest events
+    first), the reports of the events are written at the end.
+    """
+    
+    t_inst_1 = datetime.now()
+    
+    ic_tasks = []
+    for clients in clients_list:
+        for address_event, ls_saved_stas in IC_stations(input, clients):
+            if ls_saved_stas:
+                ic_tasks.append((address_event, clients, ls_saved_stas))
+    if not ic_tasks:
+        print "There is no station in the folder to correct!"
+        return
+    BH_files = {}
+    for address_event, clients, ls_saved_stas in ic_tasks:
+        if not address_event in BH_files:
+            BH_files[address_event] = IC_prepare(input, address_event)
+    
+    # only the new or changed waveforms (manifest)
+    t_ic = time.time()
+    ic_entries = {}
+    for k in range(0, len(ic_tasks)):
+        address_event, clients, ls_saved_stas = ic_tasks[k]
+        ls_saved_stas, ic_entries[(address_event, clients)] = IC_pending(\
+                input, address_event, BH_files[address_event], ls_saved_stas)
+        ic_tasks[k] = (address_event, clients, ls_saved_stas)
+    ic_tasks = [x for x in ic_tasks if x[2]]
+    if not ic_tasks:
+        print 'All the waveforms are up to date.'
+        return
+    ic_tasks.sort(key = lambda x: len(x[2]), reverse = True)
+    
+    ic_func = IC_func(input)
+    num_stas = sum([len(x[2]) for x in ic_tasks])
+    # small chunks (about 4 per process) so that the processes finish
+    # at the same time, but not more than --ic_batch stations
+    ic_chunk = max(1, min(input['ic_batch'], \
+                int(math.ceil(num_stas / (4. * input['ic_np'])))))
+    
+    print '\nParallel Instrument Correction with %s processes:' \
+                                                        %(input['ic_np'])
+    print '%s events, %s stations, %s stations per chunk\n' \
+                                    %(len(ic_tasks), num_stas, ic_chunk)
+    parallel_results = pprocess.Map(limit=input['ic_np'], reuse=1)
+    parallel_job = parallel_results.manage(pprocess.MakeReusable(ic_func))
+    for address_event, clients, ls_saved_stas in ic_tasks:
+        for i in range(0, len(ls_saved_stas), ic_chunk):
+            parallel_job(ls_saved_stas = ls_saved_stas[i:i+ic_chunk], \
+                    clients = clients, address = address_event, \
+                    BH_file = BH_files[address_event], num_start = i, \
+                    num_all = len(ls_saved_stas))
+    parallel_results.finish()
+    
+    # all the events are updated before the packing (IC_finish removes
+    # the corrected files of an event, also the ones of the other client)
+    for address_event, clients, ls_saved_stas in ic_tasks:
+        IC_update(input, address_event, BH_files[address_event], \
+                            ic_entries[(address_event, clients)], t_ic)
+    for address_event, clients, ls_saved_stas in ic_tasks:
+        IC_finish(input, ls_saved_stas, address_event, clients, \
+                        BH_files[address_event], t_inst_1, num_pool = num_stas)
 
 ###################### inst_correct ###############################
     
@@ -2645,6 +3756,287 @@ def inst_correct(input, ls_saved_stas, address, clients):
     
     t_inst_1 = datetime.now()
     
+    BH_file = IC_prepare(input, address)
+    
+    # only the new or changed waveforms (manifest)
+    t_ic = time.time()
+    ls_saved_stas, ic_entries = IC_pending(input, address, BH_file, \
+                                                            ls_saved_stas)
+    if not ls_saved_stas:
+        print 'All the waveforms are up to date.'
+        return
+    
+    ic_func = IC_func(input)
+    
+    # --ic_parallel corrects all the events in one pool (IC_archive)
+    if ic_func != IC_chunk:
+        # traces are corrected in batches
+        ic_batch = max(input['ic_batch'], 1)
+        for i in range(0, len(ls_saved_stas), ic_batch):
+            ic_func(ls_saved_stas = ls_saved_stas[i:i+ic_batch], \
+                    clients = clients, address = address, \
+                    BH_file = BH_file, num_start = i, \
+                    num_all = len(ls_saved_stas))
+    else:
+        for i in range(0, len(ls_saved_stas)):
+            IC_core(ls_saved_stas = ls_saved_stas[i], \
+                    clients = clients, address = address, \
+                    BH_file = BH_file, \
+                    inform = clients + ' -- ' + \
+                    str(i+1) + '/' + str(len(ls_saved_stas)))
+    
+    IC_update(input, address, BH_file, ic_entries, t_ic)
+    IC_finish(input, ls_saved_stas, address, clients, BH_file, t_inst_1)
+
+###################### IC_stream_start #################################
+
+def IC_stream_start(input):
+    
+    """
+    Starts the instrument correction processes (--ic_np) that correct
+    the channels during the download (--ic_stream): the download
+    processes put every saved channel in a spool folder and the
+    correction processes take them from there.
+    The clients with --*_ic_auto are corrected in this way.
+    Returns (spool folder, processes, start time) or None.
+    """
+    
+    ic_clients = []
+    if input['IRIS'] == 'Y' and input['iris_ic_auto'] == 'Y':
+        ic_clients.append('iris')
+    if input['ArcLink'] == 'Y' and input['arc_ic_auto'] == 'Y':
+        ic_clients.append('arc')
+    if not ic_clients:
+        return None
+    
+    spool_dir = os.path.join(input['datapath'], '.obspyDMT_ic_spool')
+    spool_open(spool_dir)
+    input['ic_spool'] = spool_dir
+    input['ic_spool_clients'] = ic_clients
+    # events downloaded with the spool (converted and packed at the end)
+    input['ic_spool_events'] = []
+    
+    print '\nInstrument Correction during the download ' + \
+            '(%s) with %s processes.' %(', '.join(ic_clients), input['ic_np'])
+    parallel_results = pprocess.Map(limit=input['ic_np'])
+    parallel_job = parallel_results.manage(\
+                                pprocess.MakeParallel(IC_stream_worker))
+    for i in range(0, input['ic_np']):
+        parallel_job(spool_dir)
+    return (spool_dir, parallel_results, time.time())
+
+###################### IC_streamed #####################################
+
+def IC_streamed(input, clients, type):
+    
+    """
+    True if the channels of the client are corrected during the download
+    """
+    
+    return input['ic_spool'] != None and type == 'save' and \
+                                clients in input['ic_spool_clients']
+
+###################### IC_stream_put ###################################
+
+def IC_stream_put(input, clients, address, sta_info, ev_info):
+    
+    """
+    Puts a saved channel (waveform and response) in the spool of the
+    instrument correction, the waveform is converted to SAC before.
+    """
+    
+    if not IC_streamed(input, clients, 'save'):
+        return
+    address_st = os.path.join(address, 'BH_RAW', sta_info['info'])
+    try:
+        if not os.path.isfile(address_st):
+            return
+        if input['SAC'] == 'Y':
+            writesac(address_st = address_st, sta_info = sta_info, \
+                                                    ev_info = ev_info)
+        spool_put(input['ic_spool'], clients + '_' + \
+                        os.path.basename(address) + '_' + sta_info['info'], \
+                        [address, clients, address_st])
+    except Exception, e:
+        print 'Could not send %s to the instrument correction: %s' \
+                                                        %(address_st, e)
+
+###################### IC_stream_worker ################################
+
+def IC_stream_worker(spool_dir):
+    
+    """
+    Instrument correction process of --ic_stream: corrects the channels
+    of the spool until the spool is closed and empty.
+    Returns the corrected channels {(event address, client): [...]}.
+    """
+    
+    ic_func = IC_func(input)
+    corrected = {}
+    num_ic = 0
+    while True:
+        task = spool_take(spool_dir)
+        if task == None:
+            if spool_closed(spool_dir):
+                # the last tasks could be put just before closing
+                task = spool_take(spool_dir)
+                if task == None:
+                    break
+            else:
+                time.sleep(0.5)
+                continue
+        address, clients, address_st = task
+        t_task = time.time()
+        try:
+            BH_file = IC_prepare(input, address, paz = False)
+            ic_func(ls_saved_stas = [address_st], clients = clients, \
+                    address = address, BH_file = BH_file, \
+                    num_start = num_ic, num_all = '-')
+            # the correction functions print their errors: corrected
+            # if the corrected waveform has been written
+            corr_file = IC_corr_file(input, address, BH_file, \
+                                                address_st.split('/')[-1])
+            if os.path.isfile(corr_file) and \
+                            os.path.getmtime(corr_file) >= int(t_task):
+                corrected.setdefault((address, clients), []).append(\
+                                                                address_st)
+        except Exception, e:
+            print '%s -- %s' %(address_st, e)
+        num_ic += 1
+    return corrected
+
+###################### IC_stream_finish ################################
+
+def IC_stream_finish(input, ic_stream):
+    
+    """
+    Closes the spool after the download, waits for the instrument
+    correction processes and writes the reports of the events
+    (the --*_ic_auto step is not needed any more for these clients).
+    All the downloaded events are converted to SAC (the channels that
+    were not sent to the spool) and packed.
+    """
+    
+    spool_dir, parallel_results, t_ic = ic_stream
+    t_inst_1 = datetime.fromtimestamp(t_ic)
+    spool_close(spool_dir)
+    print '\nWaiting for the Instrument Correction...'
+    corrected = {}
+    for results in parallel_results:
+        for key in results:
+            corrected.setdefault(key, []).extend(results[key])
+    
+    # all the events are updated before the packing (IC_finish)
+    BH_files = {}
+    for (address, clients) in sorted(corrected.keys()):
+        BH_files[address] = IC_prepare(input, address, paz = False)
+        ic_entries = {}
+        for address_st in corrected[(address, clients)]:
+            station_id = address_st.split('/')[-1]
+            ic_entries[station_id] = ic_entry(address_st, \
+                        os.path.join(address, 'Resp', 'RESP.' + station_id), \
+                        IC_params(input))
+        IC_update(input, address, BH_files[address], ic_entries, t_ic)
+    for (address, clients) in sorted(corrected.keys()):
+        IC_finish(input, corrected[(address, clients)], address, clients, \
+                        BH_files[address], t_inst_1, num_pool = sum([len(x) \
+                        for x in corrected.values()]))
+    ic_events = input['ic_spool_events']
+    for i in range(0, len(ic_events)):
+        if input['SAC'] == 'Y':
+            writesac_all(i = i, events = events, address_events = ic_events, \
+                                                            skip_sac = True)
+        if input['container'] == 'Y':
+            volume_pack(os.path.join(ic_events[i], 'BH_RAW'))
+    
+    for clients in input['ic_spool_clients']:
+        input[clients + '_ic_auto'] = 'N'
+    input['ic_spool'] = None
+    try:
+        shutil.rmtree(spool_dir)
+    except Exception, e:
+        pass
+
+###################### IC_params #######################################
+
+def IC_params(input):
+    
+    """
+    Parameters of the instrument correction that change the corrected
+    waveforms (saved in the manifest)
+    """
+    
+    return (input['ic_obspy_full'] == 'Y', input['ic_sac_full'] == 'Y', \
+            input['ic_paz'] == 'Y', input['corr_unit'].upper(), \
+            str(input['pre_filt']).replace(' ', ''), input['mseed'])
+
+###################### IC_corr_file ####################################
+
+def IC_corr_file(input, address, BH_file, station_id):
+    
+    """
+    Corrected waveform of a station (net.sta.loc.cha)
+    """
+    
+    return os.path.join(address, BH_file, input['corr_unit'].lower() + \
+                                '.' + '.'.join(station_id.split('.')[1:]))
+
+###################### IC_pending ######################################
+
+def IC_pending(input, address, BH_file, ls_saved_stas):
+    
+    """
+    Stations of an event that have to be corrected (new or changed raw
+    waveform or response file, other parameters, see ic_pending),
+    all the stations with --ic_force.
+    Returns the stations and their entries for the manifest.
+    """
+    
+    station_ids = [x.split('/')[-1] for x in ls_saved_stas]
+    ls_pending, ic_entries = ic_pending(os.path.join(address, BH_file), \
+        ls_saved_stas, \
+        [os.path.join(address, 'Resp', 'RESP.' + x) for x in station_ids], \
+        [IC_corr_file(input, address, BH_file, x) for x in station_ids], \
+        IC_params(input), force = input['ic_force'] == 'Y')
+    if len(ls_pending) != len(ls_saved_stas):
+        print '%s: %s of %s waveforms are up to date.' \
+                %(address, len(ls_saved_stas) - len(ls_pending), \
+                len(ls_saved_stas))
+    return ls_pending, ic_entries
+
+###################### IC_update #######################################
+
+def IC_update(input, address, BH_file, ic_entries, t_ic):
+    
+    """
+    Adds the stations corrected since t_ic to the manifest and sets 
+    their processing state in the metadata catalog (one transaction 
+    per event, the correction processes do not write to the catalog)
+    """
+    
+    corr_files = {}
+    states = []
+    for station_id in ic_entries:
+        corr_files[station_id] = IC_corr_file(input, address, BH_file, \
+                                                                station_id)
+        if os.path.isfile(corr_files[station_id]) and \
+                    os.path.getmtime(corr_files[station_id]) >= int(t_ic):
+            states.append((station_id, 'done', corr_files[station_id]))
+        else:
+            states.append((station_id, 'failed', None))
+    ic_manifest_update(os.path.join(address, BH_file), ic_entries, \
+                                                        corr_files, t_ic)
+    db_processing_event(address, BH_file, states)
+
+###################### IC_prepare ######################################
+
+def IC_prepare(input, address, paz = True):
+    
+    """
+    Folder of the corrected waveforms of an event (created if needed)
+    and the PAZ index (--ic_paz and paz), returns the name of the folder
+    """
+    
     if input['corr_unit'] == 'DIS':
         BH_file = 'BH'
     else:
@@ -2655,31 +4047,39 @@ def inst_correct(input, ls_saved_stas, address, clients):
     except Exception, e:
         pass
     
-    if input['ic_parallel'] == 'Y':
-       
-        print '\nParallel Instrument Correction with %s processes.\n' %(input['ic_np'])
-        #!! Still do not know which one is the best: 
-        #parallel_results = pprocess.Queue(limit=input['req_np'])
-        #parallel_job = parallel_results.manage(pprocess.MakeParallel(IC_core))
-        #parallel_results = pprocess.Map(limit=input['req_np'], continuous=1)
-        #parallel_job = parallel_results.manage(pprocess.MakeParallel(IC_core))
-        parallel_results = pprocess.Map(limit=input['ic_np'], reuse=1)
-        parallel_job = parallel_results.manage(pprocess.MakeReusable(IC_core))
-        for i in range(0, len(ls_saved_stas)):
-            parallel_job(ls_saved_stas = ls_saved_stas[i], \
-                    clients = clients, address = address, \
-                    BH_file = BH_file, \
-                    inform = clients + ' -- ' + \
-                    str(i+1) + '/' + str(len(ls_saved_stas)))
+    if input['ic_paz'] == 'Y' and paz:
+        # the RESP files are parsed once (PAZ index of the event)
+        paz_index_build(os.path.join(address, 'Resp'))
+    
+    return BH_file
 
-        parallel_results.finish()
-    else:
-        for i in range(0, len(ls_saved_stas)):
-            IC_core(ls_saved_stas = ls_saved_stas[i], \
-                    clients = clients, address = address, \
-                    BH_file = BH_file, \
-                    inform = clients + ' -- ' + \
-                    str(i+1) + '/' + str(len(ls_saved_stas)))
+###################### IC_func #########################################
+
+def IC_func(input):
+    
+    """
+    Function that corrects a chunk of stations for the chosen method:
+    --ic_obspy_full: one array per batch, --ic_sac_full: one SAC
+    process per batch, otherwise IC_core for each station
+    """
+    
+    if input['ic_paz'] != 'Y':
+        if input['ic_obspy_full'] == 'Y' and input['ic_sac_full'] != 'Y':
+            return IC_batch
+        elif input['ic_sac_full'] == 'Y' and input['ic_obspy_full'] != 'Y':
+            return IC_sac_batch
+    return IC_chunk
+
+###################### IC_finish #######################################
+
+def IC_finish(input, ls_saved_stas, address, clients, BH_file, t_inst_1, \
+                                                            num_pool = None):
+    
+    """
+    Compressing, packing and report of an event after the
+    instrument correction, num_pool: number of stations of all the
+    events corrected in the same pool (the time is the time of the pool)
+    """
     
     # ---------Creating Tar files (Response files)
     if input['zip_w'] == 'Y':
@@ -2698,7 +4098,15 @@ def inst_correct(input, ls_saved_stas, address, clients):
         compress_gzip(path = path, tar_file = tar_file, files = files)
         print 'DONE'
     
+    if input['container'] == 'Y':
+        print '\nPacking the corrected waveforms...',
+        volume_pack(os.path.join(address, BH_file))
+        print 'DONE'
+    
     t_inst_2 = datetime.now()
+    t_label = ''
+    if num_pool:
+        t_label = ' (pool of %s stations)' %(num_pool)
     if input['ic_parallel'] == 'Y':
         report_parallel_open = open(os.path.join(address, \
                                     'info', 'report_parallel'), 'a')
@@ -2711,9 +4119,27 @@ def inst_correct(input, ls_saved_stas, address, clients):
         report_parallel_open.writelines(\
             'Number of Stas : ' + str(len(ls_saved_stas)) + '\n')
         report_parallel_open.writelines(\
-            'Total Time     : ' + str(t_inst_2 - t_inst_1) + '\n')
+            'Total Time     : ' + str(t_inst_2 - t_inst_1) + t_label + '\n')
     print '\nTime for Instrument Correction of ' + \
-            str(len(ls_saved_stas))+' stations: %s' %(t_inst_2-t_inst_1)
+            str(len(ls_saved_stas))+' stations: %s%s' %(t_inst_2-t_inst_1, \
+                                                                t_label)
+
+###################### IC_chunk ########################################
+
+def IC_chunk(ls_saved_stas, clients, address, BH_file, num_start = 0, \
+                                                            num_all = None):
+    
+    """
+    IC_core for a chunk of stations (same arguments as IC_batch)
+    """
+    
+    if num_all == None:
+        num_all = len(ls_saved_stas)
+    for k in range(0, len(ls_saved_stas)):
+        IC_core(ls_saved_stas = ls_saved_stas[k], clients = clients, \
+                address = address, BH_file = BH_file, \
+                inform = clients + ' -- ' + str(num_start+k+1) + '/' + \
+                str(num_all))
 
 ###################### IC_core #########################################
 
@@ -2722,16 +4148,26 @@ def IC_core(ls_saved_stas, clients, address, BH_file, inform):
     global input
     
     try:
+        # long trace (--ic_segment): corrected in segments (IC_long)
+        long_trace = input['ic_segment'] and \
+                        waveform_npts(ls_saved_stas) > input['ic_segment']
         
-        if input['ic_obspy_full'] == 'Y':
-            # Removing the trend
-            rt_c = RTR(stream = ls_saved_stas, degree = 2)
-            tr = read(ls_saved_stas)[0]
-            tr.data = rt_c
-            
-            # Tapering
-            taper = invsim.cosTaper(len(tr.data))
-            tr.data *= taper
+        if (input['ic_paz'] == 'Y' or input['ic_obspy_full'] == 'Y') and \
+                                                            not long_trace:
+            # the raw waveform is read once: removing the trend, tapering
+            # and the correction are done on the same trace
+            tr_raw = waveform_read(ls_saved_stas)[0]
+            tr_raw.data = RTR(tr_raw.data, degree = 2)
+            tr_raw.data *= invsim.cosTaper(len(tr_raw.data))
+        
+        if input['ic_obspy_full'] == 'Y' and long_trace:
+            IC_long(ls_saved_stas, address, BH_file, inform)
+        
+        elif input['ic_obspy_full'] == 'Y':
+            if input['ic_paz'] == 'Y':
+                tr = tr_raw.copy()
+            else:
+                tr = tr_raw
             
             resp_file = os.path.join(address, 'Resp', 'RESP' + '.' + \
                                         ls_saved_stas.split('/')[-1])
@@ -2745,9 +4181,13 @@ def IC_core(ls_saved_stas, clients, address, BH_file, inform):
             resp_file = os.path.join(address, 'Resp', 'RESP' + '.' + \
                                         ls_saved_stas.split('/')[-1])
         
+            # SAC needs the waveform as a file
+            st_extract = waveform_file(ls_saved_stas)
             SAC_fullresp(trace = ls_saved_stas, resp_file = resp_file, \
                 address = address, BH_file = BH_file, unit = input['corr_unit'], \
                 BP_filter = input['pre_filt'], inform = inform)
+            if st_extract:
+                os.remove(ls_saved_stas)
         
         if input['ic_paz'] == 'Y':
             """
@@ -2759,13 +4199,11 @@ def IC_core(ls_saved_stas, clients, address, BH_file, inform):
                 BP_filter = input['pre_filt'], inform = inform)
             """
             """ 
-            rt_c = RTR(stream = ls_saved_stas, degree = 2)
-            tr = read(ls_saved_stas)[0]
-            tr.data = rt_c
+            tr = waveform_read(ls_saved_stas)[0]
+            tr.data = RTR(tr.data, degree = 2)
             
             # Tapering
-            taper = invsim.cosTaper(len(tr.data))
-            tr.data *= taper
+            tr.data *= invsim.cosTaper(len(tr.data))
             
             resp_file = os.path.join(address, 'Resp', 'RESP' + '.' + \
                                         ls_saved_stas.split('/')[-1])
@@ -2787,30 +4225,25 @@ def IC_core(ls_saved_stas, clients, address, BH_file, inform):
             #if clients == 'arc':
 
             print "instrument correction using PAZ"
-            rt_c = RTR(stream = ls_saved_stas, degree = 2)
-            tr = read(ls_saved_stas)[0]
-            tr.data = rt_c
-            
-            # Tapering
-            taper = invsim.cosTaper(len(tr.data))
-            tr.data *= taper
+            if long_trace:
+                IC_long(ls_saved_stas, address, BH_file, inform, paz = True)
+            else:
+                tr = tr_raw
+                
+                resp_file = os.path.join(address, 'Resp', 'RESP' + '.' + \
+                                            ls_saved_stas.split('/')[-1])
             
-            resp_file = os.path.join(address, 'Resp', 'RESP' + '.' + \
-                                        ls_saved_stas.split('/')[-1])
-        
-            obspy_PAZ(trace = tr, resp_file = resp_file, \
-                Address = os.path.join(address, BH_file), \
-                clients = clients, unit = input['corr_unit'], \
-                BP_filter = input['pre_filt'], inform = inform)
+                obspy_PAZ(trace = tr, resp_file = resp_file, \
+                    Address = os.path.join(address, BH_file), \
+                    clients = clients, unit = input['corr_unit'], \
+                    BP_filter = input['pre_filt'], inform = inform)
         
             """
-            rt_c = RTR(stream = ls_saved_stas, degree = 2)
-            tr = read(ls_saved_stas)[0]
-            tr.data = rt_c
+            tr = waveform_read(ls_saved_stas)[0]
+            tr.data = RTR(tr.data, degree = 2)
             
             # Tapering
-            taper = invsim.cosTaper(len(tr.data))
-            tr.data *= taper
+            tr.data *= invsim.cosTaper(len(tr.data))
             
             paz_file_open = open(os.path.join(address, 'Resp', 'PAZ' + '.' + \
                             ls_saved_stas.split('/')[-1] + '.' + 'paz'))
@@ -2829,36 +4262,315 @@ def IC_core(ls_saved_stas, clients, address, BH_file, inform):
     except Exception, e:
         print e
 
-###################### RTR #############################################
+###################### IC_batch ########################################
 
-def RTR(stream, degree = 2):
+def IC_batch(ls_saved_stas, clients, address, BH_file, num_start = 0, \
+                                                            num_all = None):
     
     """
-    Remove the trend by Fitting a linear function to the trace 
-    with least squares and subtracting it
+    Instrument correction (--ic_obspy_full) of a group of stations:
+    the traces with the same sampling rate and number of samples are
+    detrended, tapered and deconvolved together (2-D arrays),
+    the output files are the same as obspy_fullresp.
     """
     
-    raw_f = read(stream)
-
-    t = []
-    b0 = 0
-    inc = []
+    global input
     
-    b = raw_f[0].stats['starttime']
+    if num_all == None:
+        num_all = len(ls_saved_stas)
+    unit = input['corr_unit']
+    
+    groups = {}
+    for k in range(0, len(ls_saved_stas)):
+        inform = clients + ' -- ' + str(num_start+k+1) + '/' + str(num_all)
+        try:
+            if input['ic_segment'] and \
+                    waveform_npts(ls_saved_stas[k]) > input['ic_segment']:
+                # long trace: in segments, not in the arrays of the batch
+                IC_long(ls_saved_stas[k], address, BH_file, inform)
+                continue
+            tr = waveform_read(ls_saved_stas[k])[0]
+        except Exception, e:
+            print inform + ' -- ' + str(e)
+            continue
+        key = (tr.stats.sampling_rate, tr.stats.npts)
+        groups.setdefault(key, []).append((ls_saved_stas[k], tr, inform))
+    
+    for (samp_rate, npts), group in groups.items():
+        data = RTR_batch(np.array([x[1].data for x in group], \
+                                                    dtype = np.float64))
+        data *= invsim.cosTaper(npts)
+        resp_files = [os.path.join(address, 'Resp', 'RESP' + '.' + \
+                                    x[0].split('/')[-1]) for x in group]
+        dates = [x[1].stats['starttime'] for x in group]
+        data, errors = resp_correct_batch(data = data, \
+                samp_rate = samp_rate, resp_files = resp_files, \
+                dates = dates, unit = unit, \
+                pre_filt = eval(input['pre_filt']), water_level = 600.0, \
+                cache_dir = input['resp_cache'])
+        
+        for k in range(0, len(group)):
+            station_id = group[k][0].split('/')[-1]
+            trace = group[k][1]
+            inform = group[k][2]
+            if k in errors:
+                print inform + ' -- ' + str(errors[k])
+                continue
+            try:
+                trace.data = data[k] * 1.e9
+                trace_identity = trace.stats['station'] + '.' + \
+                    trace.stats['location'] + '.' + trace.stats['channel']
+                corr_file = os.path.join(address, BH_file, \
+                                    unit.lower() + '.' + trace_identity)
+                if input['mseed'] == 'N':
+                    trace.write(corr_file, format = 'SAC')
+                else:
+                    trace.write(corr_file, format = 'MSEED')
+                print inform + ' -- Instrument Correction to ' + \
+                    {'dis': 'displacement', 'vel': 'velocity', \
+                    'acc': 'acceleration'}[unit.lower()] + \
+                    ' for: ' + trace_identity
+            except Exception, e:
+                print inform + ' -- ' + str(e)
+
+###################### IC_long #########################################
 
-    for i in range(0, raw_f[0].stats['npts']):
-        inc.append(b0)
-        b0 = b0+1.0/raw_f[0].stats['sampling_rate'] 
-        b0 = round(b0, 4)
+def IC_long(address_st, address, BH_file, inform, paz = False):
+    
+    """
+    Instrument correction (--ic_obspy_full or --ic_paz with paz = True)
+    of a long trace in segments (--ic_segment), same output as IC_core:
+    the raw trace is read by blocks (waveform_trace) into a
+    memory-mapped file (float64) in the folder of the corrected
+    waveforms, the trend, the taper and the correction are done on it
+    in place (segment by segment) and the output is written from it.
+    The memory does not depend on the length of the trace.
+    """
+    
+    station_id = address_st.split('/')[-1]
+    unit = input['corr_unit']
+    segment = input['ic_segment']
+    resp_file = os.path.join(address, 'Resp', 'RESP' + '.' + station_id)
+    data_file = os.path.join(address, BH_file, '.' + station_id + '.' + \
+                                                        str(os.getpid()))
+    try:
+        stats = None
+        data_open = open(data_file, 'wb')
+        try:
+            for tr in waveform_trace(address_st):
+                if stats == None:
+                    stats = tr.stats.copy()
+                tr.data.astype(np.float64).tofile(data_open)
+        finally:
+            data_open.close()
+        if stats == None:
+            raise Exception('no samples in ' + address_st)
+        stats.npts = os.path.getsize(data_file) // 8
+        data = np.memmap(data_file, dtype = np.float64, mode = 'r+', \
+                                                    shape = (stats.npts,))
+        
+        detrend_chunked(data, segment)
+        taper_chunked(data)
+        if paz:
+            # impulse response of the correction of obspy_PAZ (spike in
+            # the middle), the trace is convolved in segments
+            nfft = chunk_nfft(segment, stats.sampling_rate, \
+                                                    eval(input['pre_filt']))
+            spike = np.zeros(nfft // 2)
+            spike[nfft // 4] = 1.0
+            kernel = seisSim(data = spike, \
+                samp_rate = stats.sampling_rate, \
+                paz_remove = resp_paz(resp_file, unit), \
+                paz_simulate = None, remove_sensitivity=True, \
+                simulate_sensitivity = False, water_level = 600.0, \
+                zero_mean = False, taper = False, \
+                pre_filt = eval(input['pre_filt']), \
+                seedresp=None, pitsasim=False, sacsim = True)
+            chunk_correct(data, kernel)
+        else:
+            resp_correct_chunked(data = data, \
+                samp_rate = stats.sampling_rate, resp_file = resp_file, \
+                date = stats.starttime, segment = segment, unit = unit, \
+                pre_filt = eval(input['pre_filt']), water_level = 600.0, \
+                cache_dir = input['resp_cache'])
+        for i in range(0, stats.npts, segment):
+            data[i:i+segment] *= 1.e9
         
-    A = np.vander(inc, degree)
-    (coeffs, residuals, rank, sing_vals) = np.linalg.lstsq(A, raw_f[0].data)
+        trace_identity = stats['station'] + '.' + stats['location'] + \
+                                                    '.' + stats['channel']
+        IC_long_write(stats, data, os.path.join(address, BH_file, \
+                            unit.lower() + '.' + trace_identity), segment)
+        del data
+        print inform + ' -- Instrument Correction to ' + \
+            {'dis': 'displacement', 'vel': 'velocity', \
+            'acc': 'acceleration'}[unit.lower()] + \
+            ' for: ' + trace_identity
+    except Exception, e:
+        print inform + ' -- ' + str(e)
+    if os.path.isfile(data_file):
+        os.remove(data_file)
+
+###################### IC_long_write ###################################
+
+def IC_long_write(stats, data, corr_file, segment):
+    
+    """
+    Writes a corrected long trace (data: np.memmap, stats of the raw
+    trace) segment by segment. MSEED: the segments are written one
+    after the other (the records of a MSEED file are independent).
+    SAC: the header is written with the first segment, the other
+    segments are appended (float32) and the header is completed.
+    """
+    
+    corr_tmp = corr_file + '.' + str(os.getpid())
+    segment_file = corr_tmp + '.segment'
+    try:
+        if input['mseed'] == 'N':
+            header = stats.copy()
+            header.npts = len(data[0:segment])
+            Trace(data = np.array(data[0:segment]), \
+                            header = header).write(corr_tmp, format = 'SAC')
+            corr_open = open(corr_tmp, 'r+b')
+            try:
+                head = corr_open.read(sac_head)
+                order = sac_byteorder(head, os.path.getsize(corr_tmp))
+                if not order:
+                    raise Exception('could not write the SAC header of ' + \
+                                                                corr_file)
+                corr_open.seek(0, os.SEEK_END)
+                depmin = depmax = data[0]
+                depsum = 0.0
+                for i in range(0, stats.npts, segment):
+                    piece = np.asarray(data[i:i+segment], \
+                                                    dtype = order + 'f4')
+                    if i:
+                        corr_open.write(piece.tostring())
+                    depmin = min(depmin, piece.min())
+                    depmax = max(depmax, piece.max())
+                    depsum += piece.sum(dtype = np.float64)
+                # npts, e, depmin, depmax and depmen of the whole trace
+                delta, = struct.unpack(order + 'f', head[0:4])
+                b, = struct.unpack(order + 'f', head[20:24])
+                for position, value in [(4, depmin), (8, depmax), \
+                        (24, b + (stats.npts - 1) * delta), \
+                        (224, depsum / stats.npts)]:
+                    corr_open.seek(position)
+                    corr_open.write(struct.pack(order + 'f', value))
+                corr_open.seek(316)
+                corr_open.write(struct.pack(order + 'i', stats.npts))
+            finally:
+                corr_open.close()
+        else:
+            corr_open = open(corr_tmp, 'wb')
+            try:
+                for i in range(0, stats.npts, segment):
+                    header = stats.copy()
+                    header.starttime = stats.starttime + i * stats.delta
+                    header.npts = len(data[i:i+segment])
+                    Trace(data = np.array(data[i:i+segment]), \
+                        header = header).write(segment_file, format = 'MSEED')
+                    segment_open = open(segment_file, 'rb')
+                    shutil.copyfileobj(segment_open, corr_open)
+                    segment_open.close()
+            finally:
+                corr_open.close()
+        os.rename(corr_tmp, corr_file)
+    finally:
+        for tmp_file in [corr_tmp, segment_file]:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+###################### IC_sac_batch ####################################
+
+def IC_sac_batch(ls_saved_stas, clients, address, BH_file, num_start = 0, \
+                                                            num_all = None):
     
-    f = np.poly1d(coeffs)
-    y_est = f(inc)
-    rt_c = raw_f[0].data-y_est
+    """
+    Instrument correction (--ic_sac_full) of a group of stations
+    in one SAC process, the output files are the same as SAC_fullresp.
+    """
+    
+    global input
+    
+    if num_all == None:
+        num_all = len(ls_saved_stas)
+    unit = input['corr_unit']
+    
+    jobs = []
+    extracted = []
+    for address_st in ls_saved_stas:
+        # SAC needs the waveforms as files
+        if waveform_file(address_st):
+            extracted.append(address_st)
+        trace_info = address_st.split('/')[-1].split('.')
+        jobs.append((address_st, os.path.join(address, 'Resp', 'RESP' + \
+                    '.' + address_st.split('/')[-1]), \
+                    os.path.join(address, BH_file, unit.lower() + '.' + \
+                    '.'.join(trace_info[1:]))))
+    
+    try:
+        errors = sac_correct(jobs, unit = unit, \
+                                    BP_filter = eval(input['pre_filt']))
+    except Exception, e:
+        errors = dict([(k, e) for k in range(0, len(jobs))])
     
-    return rt_c
+    for address_st in extracted:
+        os.remove(address_st)
+    
+    for k in range(0, len(jobs)):
+        station_id = ls_saved_stas[k].split('/')[-1]
+        inform = clients + ' -- ' + str(num_start+k+1) + '/' + str(num_all)
+        if k in errors:
+            print inform + ' -- ' + str(errors[k])
+            continue
+        corr_file = jobs[k][2]
+        try:
+            if input['mseed'] == 'Y':
+                tr_mseed = read(corr_file)
+                tr_mseed.write(corr_file, format = 'MSEED')
+            print inform + ' -- Instrument Correction to ' + \
+                {'dis': 'displacement', 'vel': 'velocity', \
+                'acc': 'acceleration'}[unit.lower()] + \
+                ' for: ' + station_id
+        except Exception, e:
+            print inform + ' -- ' + str(e)
+
+###################### RTR_batch #######################################
+
+def RTR_batch(data):
+    
+    """
+    Same as RTR for a 2-D array of traces (one trace per row):
+    removes the least-squares line of each trace (closed form)
+    """
+    
+    data = data - data.mean(axis = 1)[:, np.newaxis]
+    if data.shape[1] < 2:
+        return data
+    t = np.arange(data.shape[1], dtype = np.float64)
+    t -= t.mean()
+    slope = np.dot(data, t) / np.dot(t, t)
+    data -= slope[:, np.newaxis] * t
+    return data
+
+###################### RTR #############################################
+
+def RTR(data, degree = 2):
+    
+    """
+    Remove the trend by Fitting a polynomial (degree - 1, default: line)
+    to the samples of the trace with least squares and subtracting it,
+    the line is fitted in closed form (RTR_batch)
+    """
+    
+    data = np.asarray(data, dtype = np.float64)
+    if degree == 2:
+        return RTR_batch(data[np.newaxis, :])[0]
+    
+    t = np.arange(len(data), dtype = np.float64)
+    t -= t.mean()
+    coeffs = np.polyfit(t, data, degree - 1)
+    return data - np.polyval(coeffs, t)
 
 ###################### obspy_fullresp #######################################
 
@@ -2866,16 +4578,16 @@ def obspy_fullresp(trace, resp_file, Address, unit = 'DIS', \
             BP_filter = (0.008, 0.012, 3.0, 4.0), inform = 'N/N'):
 
     date = trace.stats['starttime']
-    seedresp = {'filename':resp_file,'date':date,'units':unit}
     
     try:
         
-        trace.data = seisSim(data = trace.data, \
-            samp_rate = trace.stats.sampling_rate,paz_remove=None, \
-            paz_simulate = None, remove_sensitivity=True, \
-            simulate_sensitivity = False, water_level = 600.0, \
-            zero_mean = True, taper = False, pre_filt=eval(BP_filter), \
-            seedresp=seedresp, pitsasim=False, sacsim = True)
+        # same as seisSim (seedresp) with the cached evaluated response,
+        # long traces (--ic_segment) are corrected by IC_long
+        trace.data = resp_correct(data = trace.data, \
+            samp_rate = trace.stats.sampling_rate, \
+            resp_file = resp_file, date = date, unit = unit, \
+            pre_filt = eval(BP_filter), water_level = 600.0, \
+            cache_dir = input['resp_cache'])
         
         trace.data *= 1.e9
         trace_identity = trace.stats['station'] + '.' + \
@@ -2919,47 +4631,19 @@ def SAC_fullresp(trace, resp_file, address, BH_file = 'BH', unit = 'DIS', \
     try:
         
         trace_info = trace.split('/')[-1].split('.')
+        corr_file = os.path.join(address, BH_file, unit.lower() + '.' + \
+                    trace_info[1] + '.' + trace_info[2] + '.' + trace_info[3])
         
-        if unit.lower() == 'dis':
-            unit_sac = 'NONE'
-        if unit.lower() == 'vel':
-            unit_sac = 'VEL'
-        if unit.lower() == 'acc':
-            unit_sac = 'ACC'
-        
-        BP_filter_tuple = eval(BP_filter)
-        freqlim = str(BP_filter_tuple[0]) + ' ' +  str(BP_filter_tuple[1]) \
-                    + ' ' + str(BP_filter_tuple[2]) + ' ' + \
-                    str(BP_filter_tuple[3])
-        
-        pwd = commands.getoutput('pwd')
-        os.chdir(os.path.join(address, BH_file))
-        
-        p = subprocess.Popen(['sac'],
-                             stdout = subprocess.PIPE,
-                             stdin  = subprocess.PIPE,
-                             stderr = subprocess.STDOUT )
-                             
-        s = \
-        'setbb resp ../Resp/' + resp_file.split('/')[-1] + '\n' + \
-        'read ../BH_RAW/' + trace.split('/')[-1] + '\n' + \
-        'rtrend' + '\n' + \
-        'taper' + '\n' + \
-        'rmean' + '\n' + \
-        'trans from evalresp fname %resp to ' + unit_sac + ' freqlim ' + freqlim + '\n' + \
-        'write ' + unit.lower() + '.' + trace_info[1] + '.' + trace_info[2] + \
-                                            '.' + trace_info[3] + '\n' + \
-        'quit\n'
+        # absolute paths, no chdir (safe in parallel)
+        errors = sac_correct([(trace, resp_file, corr_file)], unit = unit, \
+                                            BP_filter = eval(BP_filter))
+        if errors:
+            print inform + ' -- ' + str(errors[0])
+            return
         
-        out = p.communicate(s)
-        print out[0]
         if input['mseed'] == 'Y':
-            tr_mseed = read('%s.%s.%s.%s' %(unit.lower(), trace_info[1], 
-                                                trace_info[2], trace_info[3]))
-            tr_mseed.write('%s.%s.%s.%s' %(unit.lower(), trace_info[1],
-                                                trace_info[2], trace_info[3]), 
-                                                format='MSEED')
-        os.chdir(pwd)
+            tr_mseed = read(corr_file)
+            tr_mseed.write(corr_file, format='MSEED')
                             
         if unit.lower() == 'dis':
             unit_print = 'displacement'
@@ -2976,111 +4660,6 @@ def SAC_fullresp(trace, resp_file, address, BH_file = 'BH', unit = 'DIS', \
     except Exception, e:
         print inform + ' -- ' + str(e)
 
-###################### readRESP ########################################
-
-def readRESP(resp_file, unit):
-
-    resp_open = open(resp_file)
-    resp_read = resp_open.readlines()
-    
-    check_resp = []
-    
-    for resp_line in resp_read:
-        if "velocity in meters per second" in resp_line.lower() or \
-            "velocity in meters/second" in resp_line.lower() or \
-            "m/s -" in resp_line.lower():
-            check_resp.append('M/S')
-        
-        elif "m/s**2 - acceleration" in resp_line.lower():
-            check_resp.append('M/S**2')
-    
-    if check_resp == []:
-        print '\n***************************************************************'
-        print 'The response file is not in the right dimension (M/S) or (M/S**2)'
-        print 'This could cause problems in the instrument correction.'
-        print 'Please check the response file:'
-        print resp_file
-        print '*****************************************************************'
-        sys.exit()
-    
-    gain_num = []
-    A0_num = []
-    poles_num = []
-    poles = []
-    zeros = []
-    zeros_num = []
-    #if clients == 'iris':
-    if resp_read[0].find('obspy.xseed') == -1:
-        for i in range(0, len(resp_read)):
-            if resp_read[i].find('B058F04') != -1:  
-                gain_num.append(i)
-            if resp_read[i].find('B053F07') != -1:  
-                A0_num.append(i)
-            if resp_read[i].find('B053F10-13') != -1:  
-                zeros_num.append(i)
-            if resp_read[i].find('B053F15-18') != -1:  
-                poles_num.append(i)
-                
-    #elif clients == 'arc':
-    elif resp_read[0].find('obspy.xseed') != -1:
-        for i in range(0, len(resp_read)):
-            if resp_read[i].find('B058F04') != -1:  
-                gain_num.append(i)
-            if resp_read[i].find('B043F08') != -1:  
-                A0_num.append(i)
-            if resp_read[i].find('B043F11-14') != -1:  
-                zeros_num.append(i)
-            if resp_read[i].find('B043F16-19') != -1:  
-                poles_num.append(i)
-        
-    list_sensitivity = resp_read[gain_num[-1]].split('\n')[0].split(' ')
-    list_new_sensitivity = [x for x in list_sensitivity if x]
-    sensitivity = eval(list_new_sensitivity[-1])
-    
-    list_A0 = resp_read[A0_num[0]].split('\n')[0].split(' ')
-    list_new_A0 = [x for x in list_A0 if x]
-    A0 = eval(list_new_A0[-1])
-
-    
-    for i in range(0, len(poles_num)):
-        
-        list_poles = resp_read[poles_num[i]].split('\n')[0].split(' ')
-        list_new_poles = [x for x in list_poles if x]
-        
-        poles_r = eval(list_new_poles[-4])
-        poles_i = eval(list_new_poles[-3])
-        poles.append(complex(poles_r, poles_i))
-    
-    for i in range(0, len(zeros_num)):
-        
-        list_zeros = resp_read[zeros_num[i]].split('\n')[0].split(' ')
-        list_new_zeros = [x for x in list_zeros if x]
-        
-        zeros_r = eval(list_new_zeros[-4])
-        zeros_i = eval(list_new_zeros[-3])
-        zeros.append(complex(zeros_r, zeros_i))
-            
-    if check_resp[0] == 'M/S':
-        if unit.lower() == 'dis':
-            zeros.append(0j)
-        #if unit.lower() == 'vel':
-        #    zeros = [0j, 0j]
-        #if unit.lower() == 'acc':
-        #    zeros = [0j]
-    elif check_resp[0] == 'M/S**2':
-        if unit.lower() == 'dis':
-            zeros.append(0j)
-            zeros.append(0j)
-    
-    paz = {\
-    'poles': poles,
-    'zeros': zeros,
-    'gain': A0,
-    'sensitivity': sensitivity\
-    }
- 
-    return paz
-
 ###################### obspy_PAZ #######################################
 
 def obspy_PAZ(trace, resp_file, Address, clients, unit = 'DIS', \
@@ -3088,8 +4667,9 @@ def obspy_PAZ(trace, resp_file, Address, clients, unit = 'DIS', \
     
     try:
         
-        paz = readRESP(resp_file, unit)
+        paz = resp_paz(resp_file, unit)
         
+        # long traces (--ic_segment) are corrected by IC_long
         trace.data = seisSim(data = trace.data, \
             samp_rate = trace.stats.sampling_rate,paz_remove=paz, \
             paz_simulate = None, remove_sensitivity=True, \
@@ -3314,11 +4894,11 @@ def merge_stream(ls_address, ls_sta, network_name):
     
     for i in range(0, len(ls_sta)):
         for j in range(0, len(ls_address)):
-            if os.path.isfile(os.path.join(ls_address[j], ls_sta[i])):
-                st = read(os.path.join(ls_address[j], ls_sta[i]))
+            if waveform_exists(os.path.join(ls_address[j], ls_sta[i])):
+                st = waveform_read(os.path.join(ls_address[j], ls_sta[i]))
                 for k in range(j+1, len(ls_address)):
                     try:
-                        st.append(read(os.path.join(ls_address[k], \
+                        st.append(waveform_read(os.path.join(ls_address[k], \
                                                         ls_sta[i]))[0])
                     except Exception, e:
                         print e
@@ -3632,24 +5212,39 @@ def plot_epi(input, ls_add_stas, ls_saved_stas):
         sys.stdout.write("[%-100s] %d%%" % ('='*int(100.*(target+1)/len(ls_add_stas)),
                                                 100.*(target+1)/len(ls_add_stas)))
         sys.stdout.flush()
+        if len(ls_add_stas[target]) == 0:
+            continue
+        
+        # epicentral distances of all the stations of this event at once
+        try:
+            sta_id = []
+            for i in range(0, len(ls_saved_stas[target])):
+                sta_id.append(ls_add_stas[target][i].split('/')[-1])
+            dist_all = geometry_event(\
+                    os.path.join(os.path.dirname(os.path.dirname(\
+                                        ls_add_stas[target][0])), 'info'), \
+                    ls_saved_stas[target][0][9], ls_saved_stas[target][0][10], \
+                    sta_id, \
+                    [x[4] for x in ls_saved_stas[target]], \
+                    [x[5] for x in ls_saved_stas[target]])[0]
+        except Exception, e:
+            print e
+            continue
+        
         for i in range(0, len(ls_add_stas[target])):
+            if not input['min_epi'] <= dist_all[i] <= input['max_epi']:
+                continue
             try:
-                tr = read(ls_add_stas[target][i])[0]
+                tr = waveform_read(ls_add_stas[target][i])[0]
                 tr.normalize()
-                dist = locations2degrees(float(ls_saved_stas[target][i][9]), \
-                            float(ls_saved_stas[target][i][10]), \
-                            float(ls_saved_stas[target][i][4]), \
-                            float(ls_saved_stas[target][i][5]))
-                if input['min_epi'] <= dist <= input['max_epi']:
-                    x = range(0, len(tr.data))
-                    for i in range(0, len(x)):
-                        x[i] = x[i]/float(tr.stats['sampling_rate'])
-                    plt.plot(x, tr.data + dist, color = 'black')
+                x = np.arange(0, len(tr.data)) / \
+                                    float(tr.stats['sampling_rate'])
+                plt.plot(x, tr.data + dist_all[i], color = 'black')
             except Exception, e:
                 print e
                 pass
-            plt.xlabel('Time (sec)')
-            plt.ylabel('Epicentral distance (deg)')
+    plt.xlabel('Time (sec)')
+    plt.ylabel('Epicentral distance (deg)')
     print '\nSaving the plot in the following address:'
     print input['plot_save'] + 'plot.' + input['plot_format']
     plt.savefig(os.path.join(input['plot_save'], 'plot.' + \
@@ -3744,34 +5339,48 @@ def plot_dt(input, address_events):
                             'Data-Time_' + client.split('_')[1] + \
                             '.' + input['plot_format']))
             
-###################### XML_list_avail ##################################
+###################### XML_iter_avail ##################################
 
-def XML_list_avail(xmlfile):
+def XML_iter_avail(xmlfile):
     
     """
-    This module changes the XML file got from availability to a list
+    Streaming parser for the XML file got from availability, 
+    yields one [net, sta, loc, cha, lat, lon, ele] for each channel 
+    as soon as its station is parsed. The parsed elements are freed 
+    on the way so the memory does not grow with the size of the file.
+    xmlfile: content of the XML file (string) or a file object
     """
     
-    sta_obj = objectify.XML(xmlfile)
-    sta_req = []
-
-    for i in range(0, len(sta_obj.Station)):
-        
-        station = sta_obj.Station[i]
-        net = station.get('net_code')
-        sta = station.get('sta_code')
-        
-        lat = str(station.Lat)
-        lon = str(station.Lon)
-        ele = str(station.Elevation)
-        
-        for j in range(0, len(station.Channel)):
-            cha = station.Channel[j].get('chan_code')
-            loc = station.Channel[j].get('loc_code')
-            
-            sta_req.append([net, sta, loc, cha, lat, lon, ele])
+    if not hasattr(xmlfile, 'read'):
+        xmlfile = io.BytesIO(xmlfile)
     
-    return sta_req
+    for event, elem in etree.iterparse(xmlfile, events=('end',)):
+        # remove the namespace (if any)
+        if not isinstance(elem.tag, basestring) or \
+                        elem.tag.rsplit('}', 1)[-1] != 'Station':
+            continue
+        net = elem.get('net_code')
+        sta = elem.get('sta_code')
+        lat = lon = ele = None
+        channels = []
+        for child in elem:
+            if not isinstance(child.tag, basestring):
+                continue
+            tag = child.tag.rsplit('}', 1)[-1]
+            if tag == 'Lat':
+                lat = (child.text or '').strip()
+            elif tag == 'Lon':
+                lon = (child.text or '').strip()
+            elif tag == 'Elevation':
+                ele = (child.text or '').strip()
+            elif tag == 'Channel':
+                channels.append((child.get('loc_code'), \
+                                    child.get('chan_code')))
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+        for loc, cha in channels:
+            yield [net, sta, loc, cha, lat, lon, ele]
 
 ###################### create_folders_files ############################
 
@@ -3799,78 +5408,106 @@ def create_folders_files(events, eventpath):
                 print 'So...you decided to update your folder...Ciao'
                 print '------------------------------------------------'
                 sys.exit()
-
-    for i in range(0, len_events):
-        try:
-            os.makedirs(os.path.join(eventpath, events[i]['event_id'], 'BH_RAW'))
-            os.makedirs(os.path.join(eventpath, events[i]['event_id'], 'Resp'))
-            os.makedirs(os.path.join(eventpath, events[i]['event_id'], 'info'))
-        except Exception, e:
-            pass
     
-    for i in range(0, len_events):
-        Report = open(os.path.join(eventpath, events[i]['event_id'], \
-            'info', 'report_st'), 'a+')
-        Report.close()
+    # one pass over the events, in parallel chunks for long lists 
+    # (eg: continuous requests)
+    num_chunk = 200
+    if input['req_parallel'] == 'Y' and len_events > num_chunk:
+        parallel_results = pprocess.Map(limit=input['req_np'], reuse=1)
+        parallel_job = \
+            parallel_results.manage(pprocess.MakeReusable(create_event_files))
+        for i in range(0, len_events, num_chunk):
+            parallel_job(events[i:i+num_chunk], eventpath)
+        parallel_results.finish()
+    else:
+        create_event_files(events, eventpath)
     
+    # metadata catalog in the datapath (written by this process only)
+    db_events_add(eventpath, events)
+
+###################### create_event_files ##############################
+
+def create_event_files(events, eventpath):
     
-    for i in range(0, len_events):
-        Exception_file = open(os.path.join(eventpath, events[i]['event_id'], \
-            'info', 'exception'), 'a+')
-        eventsID = events[i]['event_id']
-        Exception_file.writelines('\n' + eventsID + '\n')
-        
-        Syn_file = open(os.path.join(eventpath, events[i]['event_id'], \
-            'info', 'station_event'), 'a+')
-        Syn_file.close()
-        
-    for i in range(0, len_events):
-        quake_file = open(os.path.join(eventpath, events[i]['event_id'],\
-                            'info', 'quake'), 'a+')
+    """
+    Create the folders and the info files (report_st, exception, 
+    station_event and quake) of the given events, 
+    each file is opened once and written in one go.
+    """
+    
+    for event in events:
+        address_event = os.path.join(eventpath, event['event_id'])
+        for folder in ['BH_RAW', 'Resp', 'info']:
+            try:
+                os.makedirs(os.path.join(address_event, folder))
+            except Exception, e:
+                pass
+        address_info = os.path.join(address_event, 'info')
         
-        quake_file.writelines(repr(events[i]['datetime'].year).rjust(15)\
-                + repr(events[i]['datetime'].julday).rjust(15) + '\n')
-        quake_file.writelines(repr(events[i]['datetime'].hour).rjust(15)\
-                + repr(events[i]['datetime'].minute).rjust(15) + \
-                repr(events[i]['datetime'].second).rjust(15) + \
-                repr(events[i]['datetime'].microsecond).rjust(15) + '\n')
+        Report = open(os.path.join(address_info, 'report_st'), 'a+')
+        Report.close()
         
-        quake_file.writelines(\
-                ' '*(15 - len('%.5f' % events[i]['latitude'])) + '%.5f' \
-                % events[i]['latitude'] + \
-                ' '*(15 - len('%.5f' % events[i]['longitude'])) + '%.5f' \
-                % events[i]['longitude'] + '\n')
-        quake_file.writelines(\
-                ' '*(15 - len('%.5f' % abs(events[i]['depth']))) + '%.5f' \
-                % abs(events[i]['depth']) + '\n')
-        quake_file.writelines(\
-                ' '*(15 - len('%.5f' % abs(events[i]['magnitude']))) + '%.5f' \
-                % abs(events[i]['magnitude']) + '\n')
-        quake_file.writelines(\
-                ' '*(15 - len(events[i]['event_id'])) + \
-                        events[i]['event_id'] + '-' + '\n')
+        Exception_file = open(os.path.join(address_info, 'exception'), 'a+')
+        Exception_file.write('\n' + event['event_id'] + '\n')
+        Exception_file.close()
         
-        quake_file.writelines(repr(events[i]['t1'].year).rjust(15)\
-                + repr(events[i]['t1'].julday).rjust(15) \
-                + repr(events[i]['t1'].month).rjust(15) \
-                + repr(events[i]['t1'].day).rjust(15) + '\n')
-        quake_file.writelines(repr(events[i]['t1'].hour).rjust(15)\
-                + repr(events[i]['t1'].minute).rjust(15) + \
-                repr(events[i]['t1'].second).rjust(15) + \
-                repr(events[i]['t1'].microsecond).rjust(15) + '\n')
+        Syn_file = open(os.path.join(address_info, 'station_event'), 'a+')
+        Syn_file.close()
         
-        quake_file.writelines(repr(events[i]['t2'].year).rjust(15)\
-                + repr(events[i]['t2'].julday).rjust(15) \
-                + repr(events[i]['t2'].month).rjust(15) \
-                + repr(events[i]['t2'].day).rjust(15) + '\n')
-        quake_file.writelines(repr(events[i]['t2'].hour).rjust(15)\
-                + repr(events[i]['t2'].minute).rjust(15) + \
-                repr(events[i]['t2'].second).rjust(15) + \
-                repr(events[i]['t2'].microsecond).rjust(15) + '\n')
+        quake_file = open(os.path.join(address_info, 'quake'), 'a+')
+        quake_file.write(quake_lines(event))
+        quake_file.close()
+
+###################### quake_lines #####################################
+
+def quake_lines(event):
+    
+    """
+    Content of the quake file for one event
+    """
+    
+    quake = []
+    quake.append(repr(event['datetime'].year).rjust(15)\
+            + repr(event['datetime'].julday).rjust(15) + '\n')
+    quake.append(repr(event['datetime'].hour).rjust(15)\
+            + repr(event['datetime'].minute).rjust(15) + \
+            repr(event['datetime'].second).rjust(15) + \
+            repr(event['datetime'].microsecond).rjust(15) + '\n')
+    
+    quake.append(\
+            ' '*(15 - len('%.5f' % event['latitude'])) + '%.5f' \
+            % event['latitude'] + \
+            ' '*(15 - len('%.5f' % event['longitude'])) + '%.5f' \
+            % event['longitude'] + '\n')
+    quake.append(\
+            ' '*(15 - len('%.5f' % abs(event['depth']))) + '%.5f' \
+            % abs(event['depth']) + '\n')
+    quake.append(\
+            ' '*(15 - len('%.5f' % abs(event['magnitude']))) + '%.5f' \
+            % abs(event['magnitude']) + '\n')
+    quake.append(\
+            ' '*(15 - len(event['event_id'])) + \
+                    event['event_id'] + '-' + '\n')
+    
+    for t in [event['t1'], event['t2']]:
+        quake.append(repr(t.year).rjust(15)\
+                + repr(t.julday).rjust(15) \
+                + repr(t.month).rjust(15) \
+                + repr(t.day).rjust(15) + '\n')
+        quake.append(repr(t.hour).rjust(15)\
+                + repr(t.minute).rjust(15) + \
+                repr(t.second).rjust(15) + \
+                repr(t.microsecond).rjust(15) + '\n')
+    return ''.join(quake)
 
 ###################### writesac_all ####################################
 
-def writesac_all(i, events, address_events):
+def writesac_all(i, events, address_events, skip_sac = False):
+    
+    """
+    Converts the waveforms of an event to SAC with the station and
+    event information (skip_sac: the SAC files are not converted again)
+    """
     
     sta_ev = read_station_event(address_events[i])
     ls_saved_stas = []
@@ -3882,7 +5519,10 @@ def writesac_all(i, events, address_events):
                                 station_id))
     for j in range(0, len(sta_ev[0])):
         try:
-            st = read(ls_saved_stas[j])
+            if skip_sac and waveform_read(ls_saved_stas[j], \
+                            headonly = True)[0].stats._format == 'SAC':
+                continue
+            st = waveform_read(ls_saved_stas[j])
             st[0].write(ls_saved_stas[j], format = 'SAC')
             tr = read(ls_saved_stas[j])[0]
             if sta_ev[0][j][4] != None:
@@ -3919,84 +5559,182 @@ def writesac(address_st, sta_info, ev_info):
     st = read(address_st)
     
     if sta_info['latitude'] != None:
-        st[0].stats['sac']['stla'] = sta_info['latitude']
+        st[0].stats['sac']['stla'] = float(sta_info['latitude'])
     if sta_info['longitude'] != None:
-        st[0].stats['sac']['stlo'] = sta_info['longitude']
+        st[0].stats['sac']['stlo'] = float(sta_info['longitude'])
     if sta_info['elevation'] != None:
-        st[0].stats['sac']['stel'] = sta_info['elevation']
+        st[0].stats['sac']['stel'] = float(sta_info['elevation'])
     if sta_info['depth'] != None:
-        st[0].stats['sac']['stdp'] = sta_info['depth']
+        st[0].stats['sac']['stdp'] = float(sta_info['depth'])
     
     if ev_info['latitude'] != None:
-        st[0].stats['sac']['evla'] = ev_info['latitude']    
+        st[0].stats['sac']['evla'] = float(ev_info['latitude'])
     if ev_info['longitude'] != None:
-        st[0].stats['sac']['evlo'] = ev_info['longitude']   
+        st[0].stats['sac']['evlo'] = float(ev_info['longitude'])
     if ev_info['depth'] != None:
-        st[0].stats['sac']['evdp'] = ev_info['depth']
+        st[0].stats['sac']['evdp'] = float(ev_info['depth'])
     if ev_info['magnitude'] != None:
-        st[0].stats['sac']['mag'] = ev_info['magnitude']
+        st[0].stats['sac']['mag'] = float(ev_info['magnitude'])
         
     st[0].write(address_st, format = 'SAC')
 
-###################### rm_duplicate ####################################
+###################### update_diff #####################################
 
-def rm_duplicate(Sta_all, address):
+def update_diff(Sta_all, address, event = None, input = None):
     
     """
-    remove duplicates and give back the required list for updating
+    remove duplicates and give back the required list for updating:
+    channels (exact SEED ids) that are not saved yet and saved channels
+    that do not cover the requested time window (if event is given).
+    Returns the list of channels and the time spans to request for the
+    saved channels {net.sta.loc.cha: (t_start, t_end)}.
     """
-        
-    sta_all = []
-    saved = []
-        
+    
+    sta_ev = read_station_event(address)
+    saved = set()
+    for sta_info in sta_ev[0]:
+        loc = sta_info[2]
+        if loc == '--' or loc == '  ':
+            loc = ''
+        saved.add(sta_info[0] + '.' + sta_info[1] + '.' + loc + '.' + \
+                                                            sta_info[3])
+    
+    Stas_req = []
+    t_spans = {}
+    available = set()
     for i in Sta_all:
+        if not i:
+            continue
+        i = [str(x) for x in i]
         if i[2] == '--' or i[2] == '  ':
             i[2] = ''
-        for j in range(0, len(i)):
-            if i[j] != str(i[j]):
-                i[j] = str(i[j]) 
-        if len(i) == 7:
-            sta_all.append(str(i[0] + '_' + i[1] + '_' + i[2] + '_' + \
-                            i[3] + '_' + i[4] + '_' + i[5] + '_' + i[6]))
-        elif len(i) == 8:
-            sta_all.append(str(i[0] + '_' + i[1] + '_' + i[2] + '_' + \
-                            i[3] + '_' + i[4] + '_' + i[5] + '_' + i[6]\
-                             + '_' + i[7]))
-                            
-    sta_ev = read_station_event(address)
-    ls_saved_stas = sta_ev[0]
-    
-    for i in range(0, len(ls_saved_stas)):
-        sta_info = ls_saved_stas[i]
-        saved.append(sta_info[0] + '_' + sta_info[1] + '_' + \
-                            sta_info[2] + '_' + sta_info[3])
-    
-    Stas_req = sta_all
-    
-    len_all_sta = len(sta_all)
-    num = []
-    for i in range(0, len(saved)):
-        for j in range(0, len(Stas_req)):
-            if saved[i] in Stas_req[j]:
-                num.append(j)
-
-    num.sort(reverse=True)
-    for i in num:
-        del Stas_req[i]  
-    
-    for m in range(0, len(Stas_req)):
-        Stas_req[m] = Stas_req[m].split('_')
+        sta_id = i[0] + '.' + i[1] + '.' + i[2] + '.' + i[3]
+        if sta_id in available:
+            continue
+        available.add(sta_id)
+        if not sta_id in saved:
+            Stas_req.append(i)
+            continue
+        if event == None:
+            continue
+        if input and input['cut_time_phase']:
+            t_start, t_end = calculate_time_phase(event, i)
+        else:
+            t_start, t_end = event['t1'], event['t2']
+        t_span = update_span(os.path.join(os.path.dirname(address), \
+                            'BH_RAW', sta_id), t_start, t_end)
+        if t_span:
+            Stas_req.append(i)
+            t_spans[sta_id] = t_span
     
     Stas_req.sort()
     
     print '------------------------------------------'
     print 'Info:'
     print 'Number of all saved stations:     ' + str(len(saved))
-    print 'Number of all available stations: ' + str(len_all_sta)
+    print 'Number of all available stations: ' + str(len(available))
     print 'Number of stations to update for: ' + str(len(Stas_req))
+    print 'Incomplete saved stations:        ' + str(len(t_spans))
     print '------------------------------------------'
     
-    return Stas_req
+    return Stas_req, t_spans
+
+###################### update_span #####################################
+
+def update_span(address_st, t_start, t_end, tol = 1.0):
+    
+    """
+    Time spans that are missing in a saved waveform (address_st) with
+    respect to the requested window (t_start, t_end): the beginning,
+    the gaps between the traces and the end (tol: tolerance in seconds).
+    Returns the list of the spans [(t1, t2), ...] or None if the file 
+    covers the window.
+    """
+    
+    try:
+        st = waveform_read(address_st, headonly = True)
+    except Exception, e:
+        return [(t_start, t_end)]
+    if len(st) == 0:
+        return [(t_start, t_end)]
+    t_spans = []
+    t_covered = t_start
+    for tr in sorted(st, key = lambda x: x.stats.starttime):
+        if tr.stats.starttime - t_covered > tol:
+            t_spans.append((t_covered, min(tr.stats.starttime, t_end)))
+        t_covered = max(t_covered, tr.stats.endtime)
+        if t_covered >= t_end:
+            break
+    if t_end - t_covered > tol:
+        t_spans.append((t_covered, t_end))
+    t_spans = [x for x in t_spans if x[1] - x[0] > tol]
+    return t_spans or None
+
+###################### update_save #####################################
+
+def update_save(address_st, t_spans, save_waveform):
+    
+    """
+    Retrieves the missing spans (t_spans) of a saved waveform 
+    (address_st) with save_waveform(file, t1, t2) and merges them into 
+    the waveform. The spans without data are skipped (error if there is
+    no data at all), the temporary files are always removed.
+    """
+    
+    address_ups = []
+    try:
+        error = None
+        for k in range(0, len(t_spans)):
+            address_up = address_st + '.update' + str(k)
+            try:
+                save_waveform(address_up, t_spans[k][0], t_spans[k][1])
+                address_ups.append(address_up)
+            except Exception, e:
+                error = e
+        if not address_ups:
+            raise error
+        update_merge(address_st, address_ups)
+    finally:
+        for k in range(0, len(t_spans)):
+            if os.path.isfile(address_st + '.update' + str(k)):
+                os.remove(address_st + '.update' + str(k))
+
+###################### update_merge ####################################
+
+def update_merge(address_st, address_ups):
+    
+    """
+    Merges the waveforms retrieved for the missing spans (address_ups)
+    into the saved waveform (address_st), the format (and the header) 
+    of the saved waveform is kept
+    """
+    
+    if waveform_exists(address_st):
+        st = waveform_read(address_st)
+        st_format = st[0].stats._format
+        st_sac = st[0].stats.get('sac')
+    else:
+        st = Stream()
+        st_format = 'MSEED'
+        st_sac = None
+    for address_up in address_ups:
+        st += read(address_up)
+    st_merged = st.copy()
+    st_merged.merge(method = 1)
+    if st_format == 'SAC':
+        # one trace per SAC file: the spans without data are set to zero
+        for tr in st_merged:
+            if np.ma.isMaskedArray(tr.data):
+                print 'WARNING: %s has still gaps (set to zero)' %(address_st)
+                tr.data = tr.data.filled(0)
+            if st_sac:
+                tr.stats.sac = st_sac
+        st = st_merged
+    elif not [tr for tr in st_merged if np.ma.isMaskedArray(tr.data)]:
+        st = st_merged
+    # otherwise the traces are saved separately (masked arrays can not be 
+    # written)
+    st.write(address_st, st_format)
 
 ###################### read_station_event ##############################
 
@@ -4008,14 +5746,32 @@ def read_station_event(address):
     
     if address.split('/')[-1].split('.') == ['info']:
         target_add = [address]
-    elif locate(address, 'info'):
-        target_add = locate(address, 'info')
     else:
-        print 'Error: There is no "info" folder in the address.'
+        target_add = locate(address, 'info')
+        if not target_add:
+            print 'Error: There is no "info" folder in the address.'
+    
+    # missing station_event files are created together (in parallel)
+    target_miss = [x for x in target_add if \
+                    not os.path.isfile(os.path.join(x, 'station_event'))]
+    if target_miss:
+        print '====================================='
+        print 'station_event could not be found for %s events' \
+                                                    %(len(target_miss))
+        print 'Start Creating the station_event files'
+        print '====================================='
+        station_event_rebuild(target_miss, num_proc = rebuild_np())
+    
+    # station_event files that have not changed are read from the 
+    # metadata catalog
+    db_sta_ev = db_read_station_event(target_add)
     
     sta_ev = []
     
     for k in range(0, len(target_add)):
+        if db_sta_ev[k] != None:
+            sta_ev.append(db_sta_ev[k])
+            continue
         sta_ev_tmp = []
         
         if os.path.isfile(os.path.join(target_add[k], 'station_event')):
@@ -4032,6 +5788,20 @@ def read_station_event(address):
     
     return sta_ev
 
+###################### rebuild_np ######################################
+
+def rebuild_np():
+    
+    """
+    Number of processes to rebuild the station_event files (--req_np)
+    """
+    
+    global input
+    
+    if input['req_parallel'] == 'Y':
+        return input['req_np']
+    return 1
+
 ###################### create_station_event ############################
 
 def create_station_event(address):
@@ -4045,48 +5815,7 @@ def create_station_event(address):
     print 'Start Creating the station_event file'
     print '====================================='
     
-    event_address = os.path.dirname(address)
-    if os.path.isdir(os.path.join(event_address, 'BH_RAW')):
-        sta_address = os.path.join(event_address, 'BH_RAW')
-    elif os.path.isdir(os.path.join(event_address, 'BH')):
-        sta_address = os.path.join(event_address, 'BH')
-    ls_stas = glob.glob(os.path.join(sta_address, '*.*.*.*'))
-    
-    print len(ls_stas)
-    for i in range(0, len(ls_stas)):
-        print i,
-        sta_file_open = open(os.path.join(address, 'station_event'), 'a')
-        
-        try:
-            sta = read(ls_stas[i])[0]
-        except Exception, e:
-            print e
-            print 'could not read the waveform data'
-        
-        sta_stats = sta.stats
-        
-        try:
-            sta_info = sta_stats.network + ',' + sta_stats.station + ',' + \
-                        sta_stats.location + ',' + sta_stats.channel + ',' + \
-                        str(sta_stats.sac.stla) + ',' + str(sta_stats.sac.stlo) + ',' + \
-                        str(sta_stats.sac.stel) + ',' + str(sta_stats.sac.stdp) + ',' + \
-                        event_address.split('/')[-1] + ',' + \
-                        str(sta_stats.sac.evla) + ',' + str(sta_stats.sac.evlo) + ',' + \
-                        str(sta_stats.sac.evdp) + ',' + str(sta_stats.sac.mag) + ',' + \
-                        'iris' + ',' + '\n'
-        except Exception, e:
-            print e
-            sta_info = sta_stats.network + ',' + sta_stats.station + ',' + \
-                        sta_stats.location + ',' + sta_stats.channel + ',' + \
-                        str(-12345.0) + ',' + str(-12345.0) + ',' + \
-                        str(-12345.0) + ',' + str(-12345.0) + ',' + \
-                        event_address.split('/')[-1] + ',' + \
-                        str(-12345.0) + ',' + str(-12345.0) + ',' + \
-                        str(-12345.0) + ',' + str(-12345.0) + ',' + \
-                        'iris' + ',' + '\n'
-        
-        sta_file_open.writelines(sta_info)
-        sta_file_open.close()
+    station_event_rebuild([address], num_proc = rebuild_np())
     
     print '\n--------------------------'
         
@@ -4101,7 +5830,16 @@ def quake_info(address, target):
     events = []
     target_add = locate(address, target)
     
+    # quake files that have not changed are read from the metadata 
+    # catalog, the other ones are parsed and added to the catalog
+    db_events = db_quake_info(target_add)
+    db_rows = []
+    
     for k in range(0, len(target_add)):
+        if db_events[k]:
+            events.append(db_events[k])
+            continue
+        
         if not os.path.isfile(os.path.join(target_add[k], 'quake')):
             print '============================='
             print 'quake file could not be found'
@@ -4110,15 +5848,9 @@ def quake_info(address, target):
             quake_create(address_info = target_add[k])
         quake_file_open = open(os.path.join(target_add[k], 'quake'), 'r')
         quake_file = quake_file_open.readlines()
+        quake_file_open.close()
 
-        tmp = []
-        
-        for i in quake_file:
-            for j in i.split():
-                try:
-                    tmp.append(float(j))
-                except ValueError:
-                    pass
+        tmp = quake_tokens(quake_file)
         
         if len(tmp) < 20:
             print '====================='
@@ -4128,50 +5860,15 @@ def quake_info(address, target):
             
             quake_file_open = open(os.path.join(target_add[k], 'quake'), 'r')
             quake_file = quake_file_open.readlines()
+            quake_file_open.close()
 
-            tmp = []
-            
-            for i in quake_file:
-                for j in i.split():
-                    try:
-                        tmp.append(float(j))
-                    except ValueError:
-                        pass
-
-        quake_d = {'year0': int(tmp[0]), 'julday0': int(tmp[1]), \
-                'hour0': int(tmp[2]), 'minute0': int(tmp[3]), \
-                'second0': int(tmp[4]), 'lat': float(tmp[6]), \
-                'lon': float(tmp[7]), 'dp': float(tmp[8]), \
-                'mag': float(tmp[9]), \
-                'year1': int(tmp[10]), 'julday1': int(tmp[11]), \
-                'hour1': int(tmp[14]), 'minute1': int(tmp[15]), \
-                'second1': int(tmp[16]), \
-                'year2': int(tmp[18]), 'julday2': int(tmp[19]), \
-                'hour2': int(tmp[22]), 'minute2': int(tmp[23]), \
-                'second2': int(tmp[24]),}
-        
-        quake_t0 = UTCDateTime(year=quake_d['year0'], julday=quake_d['julday0'], \
-                        hour=quake_d['hour0'], minute=quake_d['minute0'], \
-                        second=quake_d['second0'])
-        quake_t1 = UTCDateTime(year=quake_d['year1'], julday=quake_d['julday1'], \
-                        hour=quake_d['hour1'], minute=quake_d['minute1'], \
-                        second=quake_d['second1'])
-        quake_t2 = UTCDateTime(year=quake_d['year2'], julday=quake_d['julday2'], \
-                        hour=quake_d['hour2'], minute=quake_d['minute2'], \
-                        second=quake_d['second2'])
-        
-        events.append({'author': 'NONE', 'datetime': quake_t0,\
-                    'depth': quake_d['dp'],
-                    'event_id': quake_file[5].split('-')[0].lstrip(),
-                    'flynn_region': 'NONE',
-                    'latitude': quake_d['lat'],
-                    'longitude': quake_d['lon'],
-                    'magnitude': quake_d['mag'],
-                    'magnitude_type': 'NONE',
-                    'origin_id': -12345.0,
-                    't1': quake_t1,
-                    't2': quake_t2})
+            tmp = quake_tokens(quake_file)
+
+        db_rows.append((target_add[k], quake_row(tmp, quake_file)))
+        events.append(quake_event(db_rows[-1][1]))
 
+    db_events_set(address, db_rows)
+    
     address_event = []
     for i in range(0, len(target_add)):
         address_event.append(os.path.dirname(target_add[i]))
@@ -4198,9 +5895,9 @@ def quake_create(address_info):
     else:
         sta_address = os.path.join(address, 'BH')
         
-    ls_stas = glob.glob(os.path.join(sta_address, '*.*.*.*'))
+    ls_stas = waveform_glob(sta_address)
     
-    sta = read(ls_stas[0])[0]
+    sta = waveform_read(ls_stas[0], headonly = True)[0]
     sta_stats = sta.stats
     
     try:
@@ -4309,9 +6006,9 @@ def quake_modify(quake_item, address_info):
     else:
         sta_address = os.path.join(address, 'BH')
         
-    ls_stas = glob.glob(os.path.join(sta_address, '*.*.*.*'))
+    ls_stas = waveform_glob(sta_address)
     
-    sta = read(ls_stas[0])[0]
+    sta = waveform_read(ls_stas[0], headonly = True)[0]
     sta_stats = sta.stats
     
     try:
@@ -4464,15 +6161,10 @@ def locate(root = '.', target = 'info'):
 
     """
     Locates a subdirectory within a directory.
+    (the tree is indexed in root, refer to dir_index.py)
     """
     
-    matches = []
-    
-    for root, dirnames, filenames in os.walk(root):
-        for dirnames in fnmatch.filter(dirnames, target):
-            matches.append(os.path.join(root, dirnames))
-    
-    return matches
+    return locate_index(root, target)
 
 ########################################################################
 ########################################################################
@@ -39,6 +39,13 @@ from netCDF4 import Dataset
 from obspy.core import read, UTCDateTime, Trace
 from obspy.core.util.attribdict import AttribDict
 
+from dir_index import locate_index
+from quake_parse import quake_tokens, quake_row, quake_event
+from header_rebuild import station_event_rebuild
+from waveform_volume import waveform_read, waveform_glob
+from metadata_db import db_quake_info, db_read_station_event, \
+                        db_events_set
+
 ########################################################################
 ############################# Main Program #############################
 ########################################################################
@@ -432,7 +439,7 @@ def ncCreate(address, ls_saved_stas, eventname, print_str):
                                 'DOES NOT EXIST!'
             resp_read = 'NO RESPONSE FILE AVAILABLE'
         
-        tr = read(ls_saved_stas[0])[0]
+        tr = waveform_read(ls_saved_stas[0])[0]
         
         rootgrp.eventID = eventname
         rootgrp.evla = tr.stats.sac.evla
@@ -587,7 +594,16 @@ def quake_info(address, target):
     events = []
     target_add = locate(address, target)
     
+    # quake files that have not changed are read from the metadata 
+    # catalog, the other ones are parsed and added to the catalog
+    db_events = db_quake_info(target_add)
+    db_rows = []
+    
     for k in range(0, len(target_add)):
+        if db_events[k]:
+            events.append(db_events[k])
+            continue
+        
         if not os.path.isfile(os.path.join(target_add[k], 'quake')):
             print '============================='
             print 'quake file could not be found'
@@ -596,15 +612,9 @@ def quake_info(address, target):
             quake_create(address_info = target_add[k])
         quake_file_open = open(os.path.join(target_add[k], 'quake'), 'r')
         quake_file = quake_file_open.readlines()
+        quake_file_open.close()
 
-        tmp = []
-        
-        for i in quake_file:
-            for j in i.split():
-                try:
-                    tmp.append(float(j))
-                except ValueError:
-                    pass
+        tmp = quake_tokens(quake_file)
         
         if len(tmp) < 20:
             print '====================='
@@ -614,50 +624,15 @@ def quake_info(address, target):
             
             quake_file_open = open(os.path.join(target_add[k], 'quake'), 'r')
             quake_file = quake_file_open.readlines()
+            quake_file_open.close()
 
-            tmp = []
-            
-            for i in quake_file:
-                for j in i.split():
-                    try:
-                        tmp.append(float(j))
-                    except ValueError:
-                        pass
+            tmp = quake_tokens(quake_file)
 
-        quake_d = {'year0': int(tmp[0]), 'julday0': int(tmp[1]), \
-                'hour0': int(tmp[2]), 'minute0': int(tmp[3]), \
-                'second0': int(tmp[4]), 'lat': float(tmp[6]), \
-                'lon': float(tmp[7]), 'dp': float(tmp[8]), \
-                'mag': float(tmp[9]), \
-                'year1': int(tmp[10]), 'julday1': int(tmp[11]), \
-                'hour1': int(tmp[14]), 'minute1': int(tmp[15]), \
-                'second1': int(tmp[16]), \
-                'year2': int(tmp[18]), 'julday2': int(tmp[19]), \
-                'hour2': int(tmp[22]), 'minute2': int(tmp[23]), \
-                'second2': int(tmp[24]),}
-        
-        quake_t0 = UTCDateTime(year=quake_d['year0'], julday=quake_d['julday0'], \
-                        hour=quake_d['hour0'], minute=quake_d['minute0'], \
-                        second=quake_d['second0'])
-        quake_t1 = UTCDateTime(year=quake_d['year1'], julday=quake_d['julday1'], \
-                        hour=quake_d['hour1'], minute=quake_d['minute1'], \
-                        second=quake_d['second1'])
-        quake_t2 = UTCDateTime(year=quake_d['year2'], julday=quake_d['julday2'], \
-                        hour=quake_d['hour2'], minute=quake_d['minute2'], \
-                        second=quake_d['second2'])
-        
-        events.append({'author': 'NONE', 'datetime': quake_t0,\
-                    'depth': quake_d['dp'],
-                    'event_id': quake_file[5].split('-')[0].lstrip(),
-                    'flynn_region': 'NONE',
-                    'latitude': quake_d['lat'],
-                    'longitude': quake_d['lon'],
-                    'magnitude': quake_d['mag'],
-                    'magnitude_type': 'NONE',
-                    'origin_id': -12345.0,
-                    't1': quake_t1,
-                    't2': quake_t2})
+        db_rows.append((target_add[k], quake_row(tmp, quake_file)))
+        events.append(quake_event(db_rows[-1][1]))
 
+    db_events_set(address, db_rows)
+    
     address_event = []
     for i in range(0, len(target_add)):
         address_event.append(os.path.dirname(target_add[i]))
@@ -684,9 +659,9 @@ def quake_create(address_info):
     else:
         sta_address = os.path.join(address, 'BH')
         
-    ls_stas = glob.glob(os.path.join(sta_address, '*.*.*.*'))
+    ls_stas = waveform_glob(sta_address)
     
-    sta = read(ls_stas[0])[0]
+    sta = waveform_read(ls_stas[0], headonly = True)[0]
     sta_stats = sta.stats
     
     try:
@@ -795,9 +770,9 @@ def quake_modify(quake_item, address_info):
     else:
         sta_address = os.path.join(address, 'BH')
         
-    ls_stas = glob.glob(os.path.join(sta_address, '*.*.*.*'))
+    ls_stas = waveform_glob(sta_address)
     
-    sta = read(ls_stas[0])[0]
+    sta = waveform_read(ls_stas[0], headonly = True)[0]
     sta_stats = sta.stats
     
     try:
@@ -892,15 +867,10 @@ def locate(root = '.', target = 'info'):
 
     """
     Locates a subdirectory within a directory.
+    (the tree is indexed in root, refer to dir_index.py)
     """
     
-    matches = []
-    
-    for root, dirnames, filenames in os.walk(root):
-        for dirnames in fnmatch.filter(dirnames, target):
-            matches.append(os.path.join(root, dirnames))
-    
-    return matches
+    return locate_index(root, target)
 
 ###################### read_station_event ##############################
 
@@ -912,14 +882,32 @@ def read_station_event(address):
     
     if address.split('/')[-1].split('.') == ['info']:
         target_add = [address]
-    elif locate(address, 'info'):
-        target_add = locate(address, 'info')
     else:
-        print 'Error: There is no "info" folder in the address.'
+        target_add = locate(address, 'info')
+        if not target_add:
+            print 'Error: There is no "info" folder in the address.'
+    
+    # missing station_event files are created together (in parallel)
+    target_miss = [x for x in target_add if \
+                    not os.path.isfile(os.path.join(x, 'station_event'))]
+    if target_miss:
+        print '====================================='
+        print 'station_event could not be found for %s events' \
+                                                    %(len(target_miss))
+        print 'Start Creating the station_event files'
+        print '====================================='
+        station_event_rebuild(target_miss, num_proc = rebuild_np())
+    
+    # station_event files that have not changed are read from the 
+    # metadata catalog
+    db_sta_ev = db_read_station_event(target_add)
     
     sta_ev = []
     
     for k in range(0, len(target_add)):
+        if db_sta_ev[k] != None:
+            sta_ev.append(db_sta_ev[k])
+            continue
         sta_ev_tmp = []
         
         if os.path.isfile(os.path.join(target_add[k], 'station_event')):
@@ -936,6 +924,20 @@ def read_station_event(address):
     
     return sta_ev
 
+###################### rebuild_np ######################################
+
+def rebuild_np():
+    
+    """
+    Number of processes to rebuild the station_event files (--nc_np)
+    """
+    
+    global input
+    
+    if input['nc_parallel'] == 'Y':
+        return input['nc_np']
+    return 1
+
 ###################### create_station_event ############################
 
 def create_station_event(address):
@@ -949,48 +951,7 @@ def create_station_event(address):
     print 'Start Creating the station_event file'
     print '====================================='
     
-    event_address = os.path.dirname(address)
-    if os.path.isdir(os.path.join(event_address, 'BH_RAW')):
-        sta_address = os.path.join(event_address, 'BH_RAW')
-    elif os.path.isdir(os.path.join(event_address, 'BH')):
-        sta_address = os.path.join(event_address, 'BH')
-    ls_stas = glob.glob(os.path.join(sta_address, '*.*.*.*'))
-    
-    print len(ls_stas)
-    for i in range(0, len(ls_stas)):
-        print i,
-        sta_file_open = open(os.path.join(address, 'station_event'), 'a')
-        
-        try:
-            sta = read(ls_stas[i])[0]
-        except Exception, e:
-            print e
-            print 'could not read the waveform data'
-        
-        sta_stats = sta.stats
-        
-        try:
-            sta_info = sta_stats.network + ',' + sta_stats.station + ',' + \
-                        sta_stats.location + ',' + sta_stats.channel + ',' + \
-                        str(sta_stats.sac.stla) + ',' + str(sta_stats.sac.stlo) + ',' + \
-                        str(sta_stats.sac.stel) + ',' + str(sta_stats.sac.stdp) + ',' + \
-                        event_address.split('/')[-1] + ',' + \
-                        str(sta_stats.sac.evla) + ',' + str(sta_stats.sac.evlo) + ',' + \
-                        str(sta_stats.sac.evdp) + ',' + str(sta_stats.sac.mag) + ',' + \
-                        'iris' + ',' + '\n'
-        except Exception, e:
-            print e
-            sta_info = sta_stats.network + ',' + sta_stats.station + ',' + \
-                        sta_stats.location + ',' + sta_stats.channel + ',' + \
-                        str(-12345.0) + ',' + str(-12345.0) + ',' + \
-                        str(-12345.0) + ',' + str(-12345.0) + ',' + \
-                        event_address.split('/')[-1] + ',' + \
-                        str(-12345.0) + ',' + str(-12345.0) + ',' + \
-                        str(-12345.0) + ',' + str(-12345.0) + ',' + \
-                        'iris' + ',' + '\n'
-        
-        sta_file_open.writelines(sta_info)
-        sta_file_open.close()
+    station_event_rebuild([address], num_proc = rebuild_np())
     
     print '\n--------------------------'
 
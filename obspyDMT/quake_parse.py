@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------
+#   Filename:  quake_parse.py
+#   Purpose:   fast parser for the quake files (the parsed events are
+#              kept in the metadata catalog, refer to metadata_db.py)
+#   Author:    Kasra Hosseini
+#   Email:     hosseini@geophysik.uni-muenchen.de
+#   License:   GPLv3
+#-------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+#----------------Import required Modules (Python and Obspy)-------------
+#-----------------------------------------------------------------------
+
+# Added this line for python 2.5 compatibility
+from __future__ import with_statement
+import calendar
+
+from obspy.core import UTCDateTime
+
+########################################################################
+###################### Functions are defined here ######################
+########################################################################
+
+###################### quake_tokens ####################################
+
+def quake_tokens(quake_file):
+
+    """
+    Numbers in the lines of a quake file (same as float-parsing all the
+    words), the line of the event_id ("<event_id>-") is skipped.
+    """
+
+    tmp = []
+    for line in quake_file:
+        if line.rstrip().endswith('-'):
+            continue
+        for word in line.split():
+            try:
+                tmp.append(float(word))
+            except ValueError:
+                pass
+    return tmp
+
+###################### quake_time ######################################
+
+def quake_time(year, julday, hour, minute, second):
+
+    """
+    Timestamp of the time given in the quake file (julian day)
+    """
+
+    return calendar.timegm((int(year), 1, 1, int(hour), int(minute),
+                            int(second))) + (int(julday) - 1) * 86400
+
+###################### quake_row #######################################
+
+def quake_row(tmp, quake_file):
+
+    """
+    Event (tuple saved in the catalog) of a complete quake file:
+    (event_id, datetime, latitude, longitude, depth, magnitude, t1, t2)
+    """
+
+    return (quake_file[5].split('-')[0].lstrip(),
+            quake_time(tmp[0], tmp[1], tmp[2], tmp[3], tmp[4]),
+            float(tmp[6]), float(tmp[7]), float(tmp[8]), float(tmp[9]),
+            quake_time(tmp[10], tmp[11], tmp[14], tmp[15], tmp[16]),
+            quake_time(tmp[18], tmp[19], tmp[22], tmp[23], tmp[24]))
+
+###################### quake_event #####################################
+
+def quake_event(row):
+
+    """
+    Event (dictionary, as returned by quake_info) of a row (quake_row)
+    """
+
+    return {'author': 'NONE',
+            'datetime': UTCDateTime(row[1]),
+            'depth': row[4],
+            'event_id': row[0],
+            'flynn_region': 'NONE',
+            'latitude': row[2],
+            'longitude': row[3],
+            'magnitude': row[5],
+            'magnitude_type': 'NONE',
+            'origin_id': -12345.0,
+            't1': UTCDateTime(row[6]),
+            't2': UTCDateTime(row[7])}
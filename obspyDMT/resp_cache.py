@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------
+#   Filename:  resp_cache.py
+#   Purpose:   cache of the evaluated instrument responses (evalresp)
+#              used for the instrument correction in obspyDMT
+#   Author:    Kasra Hosseini
+#   Email:     hosseini@geophysik.uni-muenchen.de
+#   License:   GPLv3
+#-------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+#----------------Import required Modules (Python and Obspy)-------------
+#-----------------------------------------------------------------------
+
+# Added this line for python 2.5 compatibility
+from __future__ import with_statement
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from obspy.core import UTCDateTime
+from obspy.signal.invsim import evalresp, specInv, c_sac_taper, cosTaper
+from obspy.signal.util import nextpow2
+
+# maximum size of the cached spectra in memory (bytes)
+resp_cache_max = 256 * 1024**2
+
+# {key: spectrum} in the order of use (LRU)
+resp_cache = OrderedDict()
+resp_cache_size = [0]
+# {(resp_file, mtime, size): (content hash, epochs)}
+resp_files = {}
+
+# minimum length of the segments (overlap-save) in periods of the
+# lowest frequency of the pre-filter (see chunk_check)
+chunk_periods = 64
+
+########################################################################
+###################### Functions are defined here ######################
+########################################################################
+
+###################### resp_info #######################################
+
+def resp_info(resp_file):
+
+    """
+    Hash of the content and epochs [(start, end), ...] of a RESP file,
+    the file is only read again if it has been changed.
+    """
+
+    resp_stat = os.stat(resp_file)
+    resp_key = (resp_file, resp_stat.st_mtime, resp_stat.st_size)
+    if resp_key in resp_files:
+        return resp_files[resp_key]
+
+    resp_open = open(resp_file, 'rb')
+    resp_read = resp_open.read()
+    resp_open.close()
+
+    epochs = []
+    start = None
+    for line in resp_read.splitlines():
+        if 'Start date:' in line:
+            start = resp_date(line.split('Start date:')[1])
+        elif 'End date:' in line and start != None:
+            epochs.append((start, resp_date(line.split('End date:')[1])))
+            start = None
+
+    resp_files[resp_key] = (hashlib.md5(resp_read).hexdigest(), epochs)
+    return resp_files[resp_key]
+
+###################### resp_date #######################################
+
+def resp_date(date):
+
+    """
+    Timestamp of a date in a RESP file (2004,001,00:00:00.0000),
+    None for 'No Ending Time' (or a date that can not be read)
+    """
+
+    try:
+        date = date.strip().split(',')
+        hms = (date[2].split(':') + ['0', '0'])[0:3]
+        return UTCDateTime(year = int(date[0]), julday = int(date[1]), \
+                    hour = int(hms[0]), minute = int(hms[1])).timestamp + \
+                    float(hms[2])
+    except Exception, e:
+        return None
+
+###################### resp_epoch ######################################
+
+def resp_epoch(epochs, date):
+
+    """
+    Epoch of the RESP file that contains the date,
+    None if it can not be found
+    """
+
+    date = UTCDateTime(date).timestamp
+    for start, end in epochs:
+        if start != None and start <= date and (end == None or date < end):
+            return (start, end)
+    return None
+
+###################### resp_spectrum ###################################
+
+def resp_spectrum(resp_file, date, samp_rate, nfft, unit = 'DIS', \
+                        pre_filt = None, water_level = 600.0, \
+                        cache_dir = None):
+
+    """
+    Inverse (water level) of the frequency response of a RESP file
+    multiplied by the pre-filter (SAC cosine taper), as used in seisSim.
+    The spectra are cached (memory, LRU, and optionally cache_dir)
+    by the content of the RESP file, the epoch, the sampling rate,
+    nfft, unit, pre_filt and water level: the same channel in
+    different events is only evaluated once.
+    """
+
+    resp_hash, epochs = resp_info(resp_file)
+    epoch = resp_epoch(epochs, date)
+    if epoch == None:
+        # the epoch is not known, the spectrum is only valid for the date
+        epoch = UTCDateTime(date).timestamp
+    key = hashlib.md5(repr((resp_hash, epoch, float(samp_rate), int(nfft), \
+                unit.upper(), pre_filt, float(water_level)))).hexdigest()
+
+    if key in resp_cache:
+        spectrum = resp_cache.pop(key)
+        resp_cache[key] = spectrum
+        return spectrum
+
+    spectrum = None
+    if cache_dir and os.path.isfile(os.path.join(cache_dir, key + '.npy')):
+        try:
+            spectrum = np.load(os.path.join(cache_dir, key + '.npy'))
+        except Exception, e:
+            spectrum = None
+
+    if spectrum is None:
+        freq_response, freqs = evalresp(1.0 / samp_rate, nfft, resp_file, \
+                            UTCDateTime(date), units = unit.upper(), \
+                            freq = True)
+        if pre_filt:
+            cos_win = c_sac_taper(freqs, flimit = pre_filt)
+        specInv(freq_response, water_level)
+        spectrum = freq_response
+        if pre_filt:
+            spectrum *= cos_win
+        if cache_dir:
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                spectrum_tmp = os.path.join(cache_dir, \
+                                    key + '.npy.' + str(os.getpid()))
+                spectrum_open = open(spectrum_tmp, 'wb')
+                np.save(spectrum_open, spectrum)
+                spectrum_open.close()
+                os.rename(spectrum_tmp, os.path.join(cache_dir, key + '.npy'))
+            except Exception, e:
+                print 'Could not save the response cache: %s' %(e)
+
+    resp_cache[key] = spectrum
+    resp_cache_size[0] += spectrum.nbytes
+    while resp_cache_size[0] > resp_cache_max and len(resp_cache) > 1:
+        key_old, spectrum_old = resp_cache.popitem(last = False)
+        resp_cache_size[0] -= spectrum_old.nbytes
+    return spectrum
+
+###################### resp_correct ####################################
+
+def resp_correct(data, samp_rate, resp_file, date, unit = 'DIS', \
+                        pre_filt = None, water_level = 600.0, \
+                        cache_dir = None):
+
+    """
+    Removes the instrument response (RESP file) from the data, same as
+    seisSim(seedresp = ..., zero_mean = True, taper = False,
+    sacsim = True) but with the cached response spectrum.
+    """
+
+    ndat = len(data)
+    data = np.asarray(data, dtype = np.float64)
+    data = data - data.mean()
+    nfft = nextpow2(2 * ndat)
+    spectrum = resp_spectrum(resp_file, date, samp_rate, nfft, unit, \
+                                pre_filt, water_level, cache_dir)
+    data = np.fft.rfft(data, n = nfft)
+    data *= spectrum
+    data[-1] = abs(data[-1]) + 0.0j
+    return np.fft.irfft(data)[0:ndat]
+
+###################### resp_correct_batch ##############################
+
+def resp_correct_batch(data, samp_rate, resp_files, dates, unit = 'DIS', \
+                        pre_filt = None, water_level = 600.0, \
+                        cache_dir = None):
+
+    """
+    Same as resp_correct for a 2-D array of traces (one trace per row)
+    with the same sampling rate and number of samples, the FFTs and the
+    spectral division are done for all the traces at once.
+    resp_files, dates: RESP file and start time of each trace.
+    Returns the corrected traces and the errors {row: error} of the
+    traces that could not be corrected (their rows are zeros).
+    """
+
+    data = np.array(data, dtype = np.float64, ndmin = 2)
+    ndat = data.shape[1]
+    data -= data.mean(axis = 1)[:, np.newaxis]
+    nfft = nextpow2(2 * ndat)
+
+    spectra = np.zeros((data.shape[0], nfft // 2 + 1), dtype = np.complex128)
+    errors = {}
+    for k in range(0, data.shape[0]):
+        try:
+            spectra[k] = resp_spectrum(resp_files[k], dates[k], samp_rate, \
+                        nfft, unit, pre_filt, water_level, cache_dir)
+        except Exception, e:
+            errors[k] = e
+
+    data = np.fft.rfft(data, n = nfft, axis = 1)
+    data *= spectra
+    data[:, -1] = np.abs(data[:, -1]) + 0.0j
+    return np.fft.irfft(data, axis = 1)[:, 0:ndat], errors
+
+###################### chunk_nfft ######################################
+
+def chunk_nfft(segment, samp_rate = None, pre_filt = None):
+
+    """
+    FFT length of the overlap-save correction for segments of
+    (about) segment samples, the segments are made longer than
+    chunk_periods periods of the lowest frequency of pre_filt
+    (length of the impulse response)
+    """
+
+    if samp_rate and pre_filt:
+        segment = max(segment, int(chunk_periods * samp_rate / pre_filt[0]))
+    return nextpow2(2 * segment)
+
+###################### resp_kernel #####################################
+
+def resp_kernel(spectrum, nfft):
+
+    """
+    Impulse response (nfft/2 samples, lag zero at nfft/4) of a spectrum
+    of resp_spectrum: the same as the correction of a spike in the
+    middle of nfft/2 samples (without the mean removal).
+    """
+
+    impulse = np.fft.irfft(spectrum, nfft)
+    return np.concatenate((impulse[-(nfft // 4):], impulse[0:nfft // 4]))
+
+###################### overlap_save ####################################
+
+def overlap_save(data, kernel, nfft):
+
+    """
+    Convolution (in place) of data with a two-sided kernel (lag zero at
+    len(kernel)/2) by overlap-save: the data are filtered in segments of
+    nfft - len(kernel) + 1 samples, the memory does not depend on the
+    length of the data (data can be an np.memmap).
+    """
+
+    ndat = len(data)
+    nker = len(kernel)
+    kernel_fft = np.fft.rfft(kernel, nfft)
+    nseg = nfft - nker + 1
+    # samples before the segment needed for the convolution
+    npre = nker - 1 - nker // 2
+    history = np.zeros(npre)
+    for start in range(0, ndat, nseg):
+        end = min(start + nseg, ndat)
+        end_in = min(start + nseg + nker // 2, ndat)
+        segment = np.zeros(nfft)
+        segment[0:npre] = history
+        segment[npre:npre + end_in - start] = data[start:end_in]
+        # the input before the next segment (overwritten below)
+        if npre:
+            history = np.concatenate((history, data[start:end]))[-npre:]
+        segment = np.fft.irfft(np.fft.rfft(segment) * kernel_fft, nfft)
+        data[start:end] = segment[nker - 1:nker - 1 + end - start]
+    return data
+
+###################### chunk_correct ###################################
+
+def chunk_correct(data, kernel):
+
+    """
+    Removes the mean and convolves the data with the impulse response
+    of the correction (kernel of nfft/2 samples, see resp_kernel):
+    same as the correction in one FFT (resp_correct or seisSim) within
+    the length of the kernel, for long traces (in place for float64).
+    """
+
+    data = np.asarray(data, dtype = np.float64)
+    data -= data.mean()
+    return overlap_save(data, kernel, 2 * len(kernel))
+
+###################### resp_correct_chunked ############################
+
+def resp_correct_chunked(data, samp_rate, resp_file, date, segment, \
+                        unit = 'DIS', pre_filt = None, water_level = 600.0, \
+                        cache_dir = None):
+
+    """
+    Same as resp_correct for long traces: the response is evaluated
+    for segments of about segment samples and the trace is corrected
+    by overlap-save (see chunk_correct).
+    """
+
+    nfft = chunk_nfft(segment, samp_rate, pre_filt)
+    spectrum = resp_spectrum(resp_file, date, samp_rate, nfft, unit, \
+                                pre_filt, water_level, cache_dir)
+    return chunk_correct(data, resp_kernel(spectrum, nfft))
+
+###################### detrend_chunked #################################
+
+def detrend_chunked(data, segment):
+
+    """
+    Removes the least-squares line of the data in place (same as RTR,
+    closed form) in segments of samples: for np.memmap, no copy of the
+    whole trace.
+    """
+
+    ndat = len(data)
+    if ndat == 0:
+        return data
+    # sums of x and (t - mean of t) * x
+    tmean = (ndat - 1) / 2.
+    sum_x = 0.0
+    sum_tx = 0.0
+    for start in range(0, ndat, segment):
+        end = min(start + segment, ndat)
+        t = np.arange(start, end, dtype = np.float64) - tmean
+        sum_x += data[start:end].sum()
+        sum_tx += np.dot(t, data[start:end])
+    mean = sum_x / ndat
+    slope = 0.0
+    if ndat > 1:
+        slope = sum_tx / (ndat * (float(ndat)**2 - 1) / 12.)
+    for start in range(0, ndat, segment):
+        end = min(start + segment, ndat)
+        t = np.arange(start, end, dtype = np.float64) - tmean
+        data[start:end] -= mean + slope * t
+    return data
+
+###################### taper_chunked ###################################
+
+def taper_chunked(data, p = 0.1):
+
+    """
+    Multiplies the data in place by the cosine taper of cosTaper(len(data),
+    p): only the ends are changed, no window of the whole length.
+    """
+
+    ndat = len(data)
+    frac = int(ndat * p / 2.0 + 0.5)
+    if frac == 0:
+        return data
+    if frac == 1:
+        data[0] = 0.0
+        data[ndat - 1] = 0.0
+        return data
+    taper = 0.5 * (1.0 - np.cos(np.pi * np.arange(0, frac) / (frac - 1.)))
+    data[0:frac] *= taper
+    data[ndat - frac:ndat] *= taper[::-1]
+    return data
+
+###################### chunk_check #####################################
+
+def chunk_check(ndat = 400000, samp_rate = 4.0, nfft = None, \
+                pre_filt = (0.008, 0.012, 3.0, 4.0), tol = 2e-4, seed = 0):
+
+    """
+    Checks the correction of long traces on a synthetic trace (random
+    walk, response of a 20 s seismometer with pre_filt): detrend_chunked
+    and taper_chunked against RTR and cosTaper, chunk_correct against
+    the correction in one FFT (as resp_correct) within tol (maximum
+    difference relative to the maximum of the corrected trace).
+    nfft: FFT length of chunk_correct, by default the shortest one of
+    chunk_nfft (2**16 at 4 Hz).
+    Raises AssertionError, returns the relative difference.
+    """
+
+    def spectrum_synth(nfft):
+        freqs = np.arange(nfft // 2 + 1) * samp_rate / nfft
+        s = 2j * np.pi * freqs
+        w0 = 2 * np.pi / 20.0
+        freq_response = s**3 / (s**2 + 2 * 0.7 * w0 * s + w0**2)
+        specInv(freq_response, 600.0)
+        return freq_response * c_sac_taper(freqs, flimit = pre_filt)
+
+    if not nfft:
+        nfft = chunk_nfft(1, samp_rate, pre_filt)
+    data = np.cumsum(np.random.RandomState(seed).randn(ndat))
+    t = np.arange(ndat, dtype = np.float64)
+    t -= t.mean()
+    data_rtr = data - data.mean()
+    data_rtr -= np.dot(data_rtr, t) / np.dot(t, t) * t
+    data_rtr *= cosTaper(ndat)
+    data = taper_chunked(detrend_chunked(data, nfft // 3))
+    assert np.abs(data - data_rtr).max() <= 1e-9 * np.abs(data_rtr).max(), \
+                                'detrend_chunked/taper_chunked != RTR/cosTaper'
+
+    nfft_one = nextpow2(2 * ndat)
+    data_one = np.fft.rfft(data - data.mean(), n = nfft_one)
+    data_one *= spectrum_synth(nfft_one)
+    data_one[-1] = abs(data_one[-1]) + 0.0j
+    data_one = np.fft.irfft(data_one)[0:ndat]
+    data = chunk_correct(data, resp_kernel(spectrum_synth(nfft), nfft))
+    diff = np.abs(data - data_one).max() / np.abs(data_one).max()
+    assert diff <= tol, 'overlap-save (nfft = %s): %s > %s' %(nfft, diff, tol)
+    return diff
+
+########################################################################
+############################# Main Program #############################
+########################################################################
+
+if __name__ == "__main__":
+    # python resp_cache.py: check of the correction of long traces
+    for samp_rate in [4.0, 20.0]:
+        print 'chunk_correct (%s Hz): %s relative to one FFT' \
+                                %(samp_rate, chunk_check(samp_rate = samp_rate))
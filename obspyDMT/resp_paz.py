@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------
+#   Filename:  resp_paz.py
+#   Purpose:   parser of the RESP files (stages, poles and zeros,
+#              A0, sensitivity) with a cache and an index per event
+#   Author:    Kasra Hosseini
+#   Email:     hosseini@geophysik.uni-muenchen.de
+#   License:   GPLv3
+#-------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+#----------------Import required Modules (Python and Obspy)-------------
+#-----------------------------------------------------------------------
+
+# Added this line for python 2.5 compatibility
+from __future__ import with_statement
+import os
+import re
+import sys
+import glob
+import json
+import shutil
+import tempfile
+import hashlib
+
+# name of the PAZ index in the Resp folder of an event
+paz_index_name = '.obspyDMT_paz'
+
+# line of a blockette: B053F10-13 ...
+resp_blockette = re.compile(r'^B(\d{3})F(\d{2})(?:-\d{2})?\s+(.*)$')
+# input unit of the response
+resp_unit_vel = re.compile(\
+    r'velocity in meters per second|velocity in meters/second|m/s -')
+resp_unit_acc = re.compile(r'm/s\*\*2 - acceleration')
+
+# {md5: parsed RESP file}, {(md5, unit): paz}
+resp_parsed = {}
+paz_cache = {}
+# {Resp folder: ((mtime, size), index)}
+paz_indexes = {}
+
+########################################################################
+###################### Functions are defined here ######################
+########################################################################
+
+###################### resp_parse ######################################
+
+def resp_parse(resp_read):
+
+    """
+    Parses the content of a RESP file (no eval):
+    {'input_unit': 'M/S', 'M/S**2' or None, 'stages': [{'stage', 'gain',
+    'zeros', 'poles'}, ...], 'gain': A0 of the first stage, 'zeros' and
+    'poles' of all the stages, 'sensitivity': last sensitivity}
+    """
+
+    resp_lines = resp_read.splitlines()
+    # a stage starts with the type of the response (f_start),
+    # obspy.xseed writes the dictionary blockette (B043) for the PAZ
+    # from the type on (no stage number)
+    if resp_lines and resp_lines[0].find('obspy.xseed') != -1:
+        b_paz = '043'
+        f_start, f_stage, f_A0, f_zeros, f_poles = \
+                                            '05', None, '08', '11', '16'
+    else:
+        b_paz = '053'
+        f_start, f_stage, f_A0, f_zeros, f_poles = \
+                                            '03', '04', '07', '10', '15'
+
+    input_unit = None
+    stages = []
+    sensitivity = []
+    stage = None
+    for resp_line in resp_lines:
+        if input_unit == None:
+            if resp_unit_vel.search(resp_line.lower()):
+                input_unit = 'M/S'
+            elif resp_unit_acc.search(resp_line.lower()):
+                input_unit = 'M/S**2'
+
+        blockette = resp_blockette.match(resp_line)
+        if not blockette:
+            continue
+        b, f, value = blockette.groups()
+        words = value.split()
+        if b == '058' and f == '04':
+            sensitivity.append(float(words[-1]))
+        elif b == b_paz and f == f_start:
+            stage = {'stage': None, 'gain': None, 'zeros': [], 'poles': []}
+            stages.append(stage)
+        elif b == b_paz and f in [f_stage, f_A0, f_zeros, f_poles]:
+            if stage == None:
+                stage = {'stage': None, 'gain': None, \
+                                            'zeros': [], 'poles': []}
+                stages.append(stage)
+            if f == f_stage:
+                stage['stage'] = int(words[-1])
+            elif f == f_A0:
+                stage['gain'] = float(words[-1])
+            elif f == f_zeros:
+                stage['zeros'].append(complex(float(words[-4]), \
+                                                        float(words[-3])))
+            else:
+                stage['poles'].append(complex(float(words[-4]), \
+                                                        float(words[-3])))
+
+    gains = [x['gain'] for x in stages if x['gain'] != None]
+    return {'input_unit': input_unit,
+            'stages': stages,
+            'gain': gains[0],
+            'zeros': [z for x in stages for z in x['zeros']],
+            'poles': [p for x in stages for p in x['poles']],
+            'sensitivity': sensitivity[-1]}
+
+###################### resp_hash #######################################
+
+def resp_hash(resp_file):
+
+    """
+    md5 of a RESP file and its parsed content (parsed only once)
+    """
+
+    resp_open = open(resp_file, 'rb')
+    resp_read = resp_open.read()
+    resp_open.close()
+    md5 = hashlib.md5(resp_read).hexdigest()
+    if not md5 in resp_parsed:
+        resp_parsed[md5] = resp_parse(resp_read)
+    return md5, resp_parsed[md5]
+
+###################### paz_unit ########################################
+
+def paz_unit(parsed, unit, resp_file = ''):
+
+    """
+    PAZ dictionary (poles, zeros, gain, sensitivity) of a parsed RESP
+    file for the output unit (DIS, VEL or ACC)
+    """
+
+    if parsed['input_unit'] == None:
+        print '\n***************************************************************'
+        print 'The response file is not in the right dimension (M/S) or (M/S**2)'
+        print 'This could cause problems in the instrument correction.'
+        print 'Please check the response file:'
+        print resp_file
+        print '*****************************************************************'
+        sys.exit()
+
+    zeros = list(parsed['zeros'])
+    if unit.lower() == 'dis':
+        zeros.append(0j)
+        if parsed['input_unit'] == 'M/S**2':
+            zeros.append(0j)
+
+    paz = {\
+    'poles': list(parsed['poles']),
+    'zeros': zeros,
+    'gain': parsed['gain'],
+    'sensitivity': parsed['sensitivity']\
+    }
+    return paz
+
+###################### parsed_json #####################################
+
+def parsed_json(parsed, to_json = True):
+
+    """
+    Parsed RESP file with the poles and zeros as [real, imag] (JSON)
+    or back to complex numbers (to_json = False)
+    """
+
+    if to_json:
+        conv = lambda x: [[z.real, z.imag] for z in x]
+    else:
+        conv = lambda x: [complex(z[0], z[1]) for z in x]
+    parsed = dict(parsed)
+    parsed['zeros'] = conv(parsed['zeros'])
+    parsed['poles'] = conv(parsed['poles'])
+    stages = []
+    for stage in parsed['stages']:
+        stage = dict(stage)
+        stage['zeros'] = conv(stage['zeros'])
+        stage['poles'] = conv(stage['poles'])
+        stages.append(stage)
+    parsed['stages'] = stages
+    if not to_json and parsed['input_unit'] != None:
+        parsed['input_unit'] = str(parsed['input_unit'])
+    return parsed
+
+###################### paz_index_load ##################################
+
+def paz_index_load(address_resp):
+
+    """
+    PAZ index of a Resp folder {RESP file: ((mtime, size), md5, parsed)},
+    empty if there is no index.
+    """
+
+    index_file = os.path.join(address_resp, paz_index_name)
+    try:
+        index_stat = os.stat(index_file)
+    except OSError:
+        return {}
+    mtime = (index_stat.st_mtime, index_stat.st_size)
+    if address_resp in paz_indexes and paz_indexes[address_resp][0] == mtime:
+        return paz_indexes[address_resp][1]
+    try:
+        # JSON: the index is in the archive, nothing is executed
+        index_open = open(index_file, 'rb')
+        index = {}
+        for name, entry in json.load(index_open).items():
+            index[str(name)] = (tuple(entry[0]), str(entry[1]), \
+                                            parsed_json(entry[2], False))
+        index_open.close()
+    except Exception, e:
+        print 'Could not read the PAZ index: %s' %(e)
+        return {}
+    paz_indexes[address_resp] = (mtime, index)
+    return index
+
+###################### paz_index_build #################################
+
+def paz_index_build(address_resp):
+
+    """
+    Parses all the new or changed RESP files of a Resp folder and saves
+    the PAZ index of the folder (before the instrument correction, the
+    parallel processes only read the index).
+    Returns the number of parsed RESP files.
+    """
+
+    index = dict(paz_index_load(address_resp))
+    changed = False
+    ls_resp = glob.glob(os.path.join(address_resp, 'RESP.*'))
+    names = set([os.path.basename(x) for x in ls_resp])
+    for name in [x for x in index if not x in names]:
+        del index[name]
+        changed = True
+
+    num_parsed = 0
+    for resp_file in ls_resp:
+        name = os.path.basename(resp_file)
+        resp_stat = os.stat(resp_file)
+        mtime = (resp_stat.st_mtime, resp_stat.st_size)
+        if name in index and index[name][0] == mtime:
+            continue
+        try:
+            md5, parsed = resp_hash(resp_file)
+        except Exception, e:
+            print 'Could not parse the response file: %s (%s)' %(resp_file, e)
+            continue
+        index[name] = (mtime, md5, parsed)
+        changed = True
+        num_parsed += 1
+
+    if changed:
+        index_file = os.path.join(address_resp, paz_index_name)
+        index_tmp = index_file + '.' + str(os.getpid())
+        try:
+            index_open = open(index_tmp, 'wb')
+            json.dump(dict([(x, (index[x][0], index[x][1], \
+                    parsed_json(index[x][2]))) for x in index]), index_open)
+            index_open.close()
+            os.rename(index_tmp, index_file)
+            index_stat = os.stat(index_file)
+            paz_indexes[address_resp] = \
+                    ((index_stat.st_mtime, index_stat.st_size), index)
+        except Exception, e:
+            print 'Could not save the PAZ index: %s' %(e)
+    return num_parsed
+
+###################### resp_paz ########################################
+
+def resp_paz(resp_file, unit):
+
+    """
+    PAZ dictionary of a RESP file for the output unit (same as readRESP),
+    from the PAZ index of the folder or the cache of the parsed files:
+    a RESP file is only parsed if it is not in both.
+    """
+
+    resp_stat = os.stat(resp_file)
+    mtime = (resp_stat.st_mtime, resp_stat.st_size)
+    index = paz_index_load(os.path.dirname(os.path.abspath(resp_file)))
+    entry = index.get(os.path.basename(resp_file))
+    if entry and entry[0] == mtime:
+        md5 = entry[1]
+        resp_parsed.setdefault(md5, entry[2])
+    else:
+        md5 = resp_hash(resp_file)[0]
+
+    key = (md5, unit.lower())
+    if not key in paz_cache:
+        paz_cache[key] = paz_unit(resp_parsed[md5], unit, resp_file)
+    paz = paz_cache[key]
+    return {'poles': list(paz['poles']), 'zeros': list(paz['zeros']),
+            'gain': paz['gain'], 'sensitivity': paz['sensitivity']}
+
+###################### resp_check ######################################
+
+# RESP files (two PAZ stages) of rdseed (IRIS) and obspy.xseed (ArcLink)
+# and their PAZ of readRESP (previous parser of obspyDMT) for DIS
+resp_check_files = {
+'RESP.IU.ANMO.00.BHZ': ('''#
+###################################################################################
+#
+B050F03     Station:     ANMO
+B050F16     Network:     IU
+B052F03     Location:    00
+B052F04     Channel:     BHZ
+#                  +-----------------------------------+
+#                  |    Response (Poles and Zeros)     |
+B053F03     Transfer function type:                A [Laplace Transform (Rad/sec)]
+B053F04     Stage sequence number:                 1
+B053F05     Response in units lookup:              M/S - Velocity in Meters Per Second
+B053F06     Response out units lookup:             V - Volts
+B053F07     A0 normalization factor:               +8.60830E+04
+B053F08     Normalization frequency:               +2.00000E-02
+B053F09     Number of zeroes:                      2
+B053F14     Number of poles:                       3
+B053F10-13     0  +0.00000E+00  +0.00000E+00  +0.00000E+00  +0.00000E+00
+B053F10-13     1  +0.00000E+00  +0.00000E+00  +0.00000E+00  +0.00000E+00
+B053F15-18     0  -5.92900E-02  +5.92900E-02  +0.00000E+00  +0.00000E+00
+B053F15-18     1  -5.92900E-02  -5.92900E-02  +0.00000E+00  +0.00000E+00
+B053F15-18     2  -2.51300E+02  +0.00000E+00  +0.00000E+00  +0.00000E+00
+B058F03     Stage sequence number:                 1
+B058F04     Sensitivity:                           +2.00000E+03
+B053F03     Transfer function type:                A [Laplace Transform (Rad/sec)]
+B053F04     Stage sequence number:                 2
+B053F05     Response in units lookup:              V - Volts
+B053F06     Response out units lookup:             V - Volts
+B053F07     A0 normalization factor:               +6.28300E+02
+B053F09     Number of zeroes:                      0
+B053F14     Number of poles:                       1
+B053F15-18     0  -6.28300E+02  +0.00000E+00  +0.00000E+00  +0.00000E+00
+B058F03     Stage sequence number:                 2
+B058F04     Sensitivity:                           +4.00000E+05
+B058F03     Stage sequence number:                 0
+B058F04     Sensitivity:                           +8.00000E+08
+''',
+    {'poles': [complex(-0.05929, 0.05929), complex(-0.05929, -0.05929),
+                complex(-251.3, 0), complex(-628.3, 0)],
+     'zeros': [0j, 0j, 0j], 'gain': 86083.0, 'sensitivity': 800000000.0}),
+'RESP.GE.FUR..BHZ': ('''#        << obspy.xseed, Version 0.8.4 >>
+#        
+#        ======== CHANNEL RESPONSE DATA ========
+B050F03     Station:     FUR
+B050F16     Network:     GE
+B052F03     Location:    ??
+B052F04     Channel:     BHZ
+#        +               +---------------------------------------+                +
+#        +               |   Response (Poles & Zeros),  FUR ch BHZ   |                +
+B043F05     Response type:                         A [Laplace Transform (Rad/sec)]
+B043F06     Response in units lookup:              M/S - Velocity in Meters per Second
+B043F07     Response out units lookup:             V - Volts
+B043F08     A0 normalization factor:               6.0077E+07
+B043F09     Normalization frequency:               1
+B043F10     Number of zeroes:                      2
+B043F15     Number of poles:                       3
+B043F11-14    0  0.000000E+00  0.000000E+00  0.000000E+00  0.000000E+00
+B043F11-14    1  0.000000E+00  0.000000E+00  0.000000E+00  0.000000E+00
+B043F16-19    0 -3.701600E-02  3.701600E-02  0.000000E+00  0.000000E+00
+B043F16-19    1 -3.701600E-02 -3.701600E-02  0.000000E+00  0.000000E+00
+B043F16-19    2 -2.513300E+02  0.000000E+00  0.000000E+00  0.000000E+00
+B058F03     Stage sequence number:                 1
+B058F04     Sensitivity:                           2.000000E+03
+B043F05     Response type:                         A [Laplace Transform (Rad/sec)]
+B043F06     Response in units lookup:              V - Volts
+B043F07     Response out units lookup:             V - Volts
+B043F08     A0 normalization factor:               1.0
+B043F09     Normalization frequency:               1
+B043F10     Number of zeroes:                      0
+B043F15     Number of poles:                       1
+B043F16-19    0 -1.256600E+03  0.000000E+00  0.000000E+00  0.000000E+00
+B058F03     Stage sequence number:                 0
+B058F04     Sensitivity:                           5.033000E+08
+''',
+    {'poles': [complex(-0.037016, 0.037016), complex(-0.037016, -0.037016),
+                complex(-251.33, 0), complex(-1256.6, 0)],
+     'zeros': [0j, 0j, 0j], 'gain': 60077000.0, 'sensitivity': 503300000.0}),
+}
+
+def resp_check():
+
+    """
+    Checks resp_paz against the output of readRESP (resp_check_files)
+    for a RESP file of rdseed and one of obspy.xseed, the A0 is the one
+    of the first stage. Raises AssertionError.
+    """
+
+    address_resp = tempfile.mkdtemp()
+    try:
+        for name in resp_check_files:
+            resp_read, paz_read = resp_check_files[name]
+            resp_file = os.path.join(address_resp, name)
+            resp_open = open(resp_file, 'w')
+            resp_open.write(resp_read)
+            resp_open.close()
+            paz = resp_paz(resp_file, 'DIS')
+            assert paz == paz_read, '%s: %s != %s' %(name, paz, paz_read)
+    finally:
+        shutil.rmtree(address_resp)
+
+########################################################################
+############################# Main Program #############################
+########################################################################
+
+if __name__ == "__main__":
+    # python resp_paz.py: check of the parser against readRESP
+    resp_check()
+    print 'resp_paz: same PAZ as readRESP (rdseed and obspy.xseed)'
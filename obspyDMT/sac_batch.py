@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------
+#   Filename:  sac_batch.py
+#   Purpose:   instrument correction of many waveforms in one SAC
+#              session (macro with absolute paths, checked per trace)
+#   Author:    Kasra Hosseini
+#   Email:     hosseini@geophysik.uni-muenchen.de
+#   License:   GPLv3
+#-------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+#----------------Import required Modules (Python and Obspy)-------------
+#-----------------------------------------------------------------------
+
+# Added this line for python 2.5 compatibility
+from __future__ import with_statement
+import os
+import re
+import time
+import subprocess
+
+# the output of SAC is split by this message (one part per trace)
+sac_marker = 'obspyDMT_trace'
+
+########################################################################
+###################### Functions are defined here ######################
+########################################################################
+
+###################### sac_unit ########################################
+
+def sac_unit(unit):
+
+    """
+    Unit of the SAC transfer command for DIS, VEL or ACC
+    """
+
+    return {'dis': 'NONE', 'vel': 'VEL', 'acc': 'ACC'}[unit.lower()]
+
+###################### sac_macro #######################################
+
+def sac_macro(jobs, unit = 'DIS', BP_filter = (0.008, 0.012, 3.0, 4.0)):
+
+    """
+    SAC commands for the instrument correction of a list of waveforms,
+    jobs: [(raw waveform, RESP file, output file), ...] (absolute paths).
+    Every trace starts with a message (sac_marker and the number of the
+    job) to find the errors of each trace in the output of SAC.
+    """
+
+    freqlim = ' '.join([str(x) for x in BP_filter])
+    s = ''
+    for k in range(0, len(jobs)):
+        raw_file, resp_file, out_file = jobs[k]
+        s += \
+        'message "' + sac_marker + ' ' + str(k) + '"' + '\n' + \
+        'setbb resp ' + os.path.abspath(resp_file) + '\n' + \
+        'read ' + os.path.abspath(raw_file) + '\n' + \
+        'rtrend' + '\n' + \
+        'taper' + '\n' + \
+        'rmean' + '\n' + \
+        'trans from evalresp fname %resp to ' + sac_unit(unit) + \
+                                            ' freqlim ' + freqlim + '\n' + \
+        'write ' + os.path.abspath(out_file) + '\n'
+    s += 'quit\n'
+    return s
+
+###################### sac_correct #####################################
+
+def sac_correct(jobs, unit = 'DIS', BP_filter = (0.008, 0.012, 3.0, 4.0), \
+                                                            sac = 'sac'):
+
+    """
+    Instrument correction of a list of waveforms in one SAC process
+    (no change of the working directory: safe in parallel).
+    jobs: [(raw waveform, RESP file, output file), ...]
+    Returns the errors {job: error} of the traces that could not be
+    corrected, their output files are removed.
+    """
+
+    if not jobs:
+        return {}
+
+    t_start = time.time()
+    p = subprocess.Popen([sac],
+                         stdout = subprocess.PIPE,
+                         stdin  = subprocess.PIPE,
+                         stderr = subprocess.STDOUT )
+    out = p.communicate(sac_macro(jobs, unit, BP_filter))[0]
+
+    # output of SAC for each trace
+    outs = {}
+    k = None
+    for line in out.splitlines():
+        # (the echo of the command ends with a quote)
+        marker = re.search(sac_marker + r' (\d+)\s*$', line)
+        if marker:
+            k = int(marker.group(1))
+            outs[k] = []
+        elif k != None:
+            outs[k].append(line)
+
+    errors = {}
+    for k in range(0, len(jobs)):
+        out_file = jobs[k][2]
+        if not k in outs:
+            errors[k] = 'SAC stopped before this trace'
+        elif [x for x in outs[k] if 'ERROR' in x.upper()]:
+            errors[k] = ' '.join([x.strip() for x in outs[k] \
+                                            if 'ERROR' in x.upper()])
+        elif not os.path.isfile(out_file) or \
+                            os.path.getmtime(out_file) < int(t_start):
+            errors[k] = 'SAC did not write ' + out_file
+        if k in errors and os.path.isfile(out_file) and \
+                            os.path.getmtime(out_file) >= int(t_start):
+            os.remove(out_file)
+    return errors
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------
+#   Filename:  waveform_volume.py
+#   Purpose:   packed waveform container (one volume per event and
+#              processing level) with a sidecar index by SEED id
+#   Author:    Kasra Hosseini
+#   Email:     hosseini@geophysik.uni-muenchen.de
+#   License:   GPLv3
+#-------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+#----------------Import required Modules (Python and Obspy)-------------
+#-----------------------------------------------------------------------
+
+# Added this line for python 2.5 compatibility
+from __future__ import with_statement
+import os
+import io
+import glob
+import fnmatch
+import json
+import struct
+
+from obspy.core import read
+
+# the volume and its index are saved in the folder of the processing
+# level (eg: BH_RAW/waveforms.volume), the names do not match the
+# pattern of the waveforms (*.*.*.*)
+volume_name = 'waveforms.volume'
+index_name = 'waveforms.index'
+# the volume is rewritten when the replaced channels (dead bytes) are
+# more than this fraction of the volume
+volume_dead = 0.25
+
+# index of the volumes that have been read {folder: (mtime, index)}
+volume_cache = {}
+# bytes of a SAC header
+sac_head = 632
+
+########################################################################
+###################### Functions are defined here ######################
+########################################################################
+
+###################### volume_index ####################################
+
+def volume_index(address_dir):
+
+    """
+    Index of the volume of a folder {net.sta.loc.cha: (offset, length)},
+    empty if there is no volume.
+    """
+
+    index_file = os.path.join(address_dir, index_name)
+    try:
+        index_stat = os.stat(index_file)
+    except OSError:
+        return {}
+    mtime = (index_stat.st_mtime, index_stat.st_size)
+    if address_dir in volume_cache and volume_cache[address_dir][0] == mtime:
+        return volume_cache[address_dir][1]
+    try:
+        # JSON: the index is in the archive and could be written by
+        # other users, nothing is executed while reading it
+        index_open = open(index_file, 'rb')
+        index = {}
+        for sta_id, (offset, length) in json.load(index_open).items():
+            index[str(sta_id)] = (int(offset), int(length))
+        index_open.close()
+    except Exception, e:
+        print 'Could not read the index of the volume: %s' %(e)
+        return {}
+    volume_cache[address_dir] = (mtime, index)
+    return index
+
+###################### volume_pack #####################################
+
+def volume_pack(address_dir, pattern = '*.*.*.*', remove = True):
+
+    """
+    Appends the waveform files of a folder (pattern) to its volume
+    (the files are kept as they are: MSEED or SAC) and removes them.
+    A channel that is already in the volume is replaced, the volume is
+    compacted when too many bytes are not used any more (volume_dead).
+    Returns the number of packed waveforms.
+    """
+
+    # only net.sta.loc.cha (eg: not the partial .update files)
+    ls_stas = sorted([x for x in glob.glob(os.path.join(address_dir, \
+                    pattern)) if len(os.path.basename(x).split('.')) == 4])
+    if not ls_stas:
+        return 0
+    index = dict(volume_index(address_dir))
+    volume_open = open(os.path.join(address_dir, volume_name), 'ab')
+    for address_st in ls_stas:
+        st_open = open(address_st, 'rb')
+        st_bytes = st_open.read()
+        st_open.close()
+        volume_open.seek(0, os.SEEK_END)
+        index[os.path.basename(address_st)] = (volume_open.tell(), \
+                                                            len(st_bytes))
+        volume_open.write(st_bytes)
+    volume_size = volume_open.tell()
+    volume_open.close()
+
+    if volume_size - sum([x[1] for x in index.values()]) > \
+                                                volume_dead * volume_size:
+        volume_compact(address_dir, index)
+    else:
+        volume_index_save(address_dir, index)
+
+    if remove:
+        for address_st in ls_stas:
+            os.remove(address_st)
+    return len(ls_stas)
+
+###################### volume_index_save ###############################
+
+def volume_index_save(address_dir, index):
+
+    """
+    Saves the index of the volume of a folder (JSON)
+    """
+
+    index_tmp = os.path.join(address_dir, index_name + '.' + str(os.getpid()))
+    index_open = open(index_tmp, 'wb')
+    json.dump(index, index_open)
+    index_open.close()
+    os.rename(index_tmp, os.path.join(address_dir, index_name))
+    index_stat = os.stat(os.path.join(address_dir, index_name))
+    volume_cache[address_dir] = ((index_stat.st_mtime, index_stat.st_size), \
+                                                                    index)
+
+###################### volume_compact ##################################
+
+def volume_compact(address_dir, index):
+
+    """
+    Rewrites the volume of a folder with only the channels of the index
+    (the bytes of the replaced channels are reclaimed) and saves the
+    new index. The volume is a new file (the old one is replaced).
+    """
+
+    volume_file = os.path.join(address_dir, volume_name)
+    volume_tmp = volume_file + '.' + str(os.getpid())
+    index_new = {}
+    volume_read = open(volume_file, 'rb')
+    volume_open = open(volume_tmp, 'wb')
+    for sta_id in sorted(index.keys(), key = lambda x: index[x][0]):
+        offset, length = index[sta_id]
+        volume_read.seek(offset)
+        index_new[sta_id] = (volume_open.tell(), length)
+        volume_open.write(volume_read.read(length))
+    volume_open.close()
+    volume_read.close()
+    os.rename(volume_tmp, volume_file)
+    volume_index_save(address_dir, index_new)
+    index.clear()
+    index.update(index_new)
+
+###################### volume_unpack ###################################
+
+def volume_unpack(address_dir):
+
+    """
+    Writes all the waveforms of the volume back to separate files
+    and removes the volume.
+    """
+
+    index = volume_index(address_dir)
+    for sta_id in index:
+        if not os.path.isfile(os.path.join(address_dir, sta_id)):
+            st_open = open(os.path.join(address_dir, sta_id), 'wb')
+            st_open.write(volume_bytes(address_dir, sta_id))
+            st_open.close()
+    for name in [volume_name, index_name]:
+        if os.path.isfile(os.path.join(address_dir, name)):
+            os.remove(os.path.join(address_dir, name))
+    volume_cache.pop(address_dir, None)
+
+###################### volume_bytes ####################################
+
+def volume_bytes(address_dir, sta_id):
+
+    """
+    Content of one waveform (file) in the volume
+    """
+
+    offset, length = volume_index(address_dir)[sta_id]
+    volume_open = open(os.path.join(address_dir, volume_name), 'rb')
+    volume_open.seek(offset)
+    st_bytes = volume_open.read(length)
+    volume_open.close()
+    return st_bytes
+
+###################### waveform_exists #################################
+
+def waveform_exists(address_st):
+
+    """
+    True if the waveform (BH_RAW/net.sta.loc.cha) is saved as a file
+    or in the volume of the folder
+    """
+
+    if os.path.isfile(address_st):
+        return True
+    return os.path.basename(address_st) in \
+                            volume_index(os.path.dirname(address_st))
+
+###################### waveform_read ###################################
+
+def waveform_read(address_st, headonly = False):
+
+    """
+    Same as read for a waveform address (BH_RAW/net.sta.loc.cha),
+    files have priority over the volume.
+    """
+
+    if os.path.isfile(address_st) or \
+            not os.path.basename(address_st) in \
+                            volume_index(os.path.dirname(address_st)):
+        return read(address_st, headonly = headonly)
+    return read(io.BytesIO(volume_bytes(os.path.dirname(address_st), \
+                    os.path.basename(address_st))), headonly = headonly)
+
+###################### waveform_file ###################################
+
+def waveform_file(address_st):
+
+    """
+    Makes sure that the waveform exists as a file (for external tools,
+    eg: SAC), returns True if it has been extracted from the volume
+    (and should be removed afterwards).
+    """
+
+    if os.path.isfile(address_st) or not waveform_exists(address_st):
+        return False
+    st_open = open(address_st, 'wb')
+    st_open.write(volume_bytes(os.path.dirname(address_st), \
+                                        os.path.basename(address_st)))
+    st_open.close()
+    return True
+
+###################### waveform_span ###################################
+
+def waveform_span(address_st):
+
+    """
+    (file, offset, length) of the bytes of a waveform (file or volume),
+    files have priority over the volume.
+    """
+
+    address_dir = os.path.dirname(address_st)
+    sta_id = os.path.basename(address_st)
+    if os.path.isfile(address_st) or \
+                                not sta_id in volume_index(address_dir):
+        return address_st, 0, os.path.getsize(address_st)
+    offset, length = volume_index(address_dir)[sta_id]
+    return os.path.join(address_dir, volume_name), offset, length
+
+###################### sac_byteorder ###################################
+
+def sac_byteorder(head, length):
+
+    """
+    Byte order ('<' or '>') of a SAC file from its header (version 6
+    and the number of samples for length bytes), None if it is not
+    an evenly sampled SAC file.
+    """
+
+    if len(head) < sac_head:
+        return None
+    for order in ['<', '>']:
+        nvhdr, = struct.unpack(order + 'i', head[304:308])
+        npts, = struct.unpack(order + 'i', head[316:320])
+        if nvhdr == 6 and sac_head + 4 * npts == length:
+            return order
+    return None
+
+###################### mseed_reclen ####################################
+
+def mseed_reclen(head):
+
+    """
+    Record length of a MSEED record from its header (blockette 1000),
+    None if there is no blockette 1000.
+    """
+
+    if len(head) < 48:
+        return None
+    # byte order of the fixed header: the year is between 1900 and 2100
+    order = '>'
+    if not 1900 <= struct.unpack('>H', head[20:22])[0] <= 2100:
+        order = '<'
+    blockette, = struct.unpack(order + 'H', head[46:48])
+    while 48 <= blockette and blockette + 7 <= len(head):
+        b_type, b_next = struct.unpack(order + 'HH', \
+                                            head[blockette:blockette + 4])
+        if b_type == 1000:
+            return 2 ** struct.unpack('B', head[blockette + 6])[0]
+        if b_next <= blockette:
+            break
+        blockette = b_next
+    return None
+
+###################### waveform_blocks #################################
+
+def waveform_blocks(address_st, block_size = 2**20, headonly = False):
+
+    """
+    Reads a waveform (file or volume) in blocks of about block_size
+    bytes and yields the stream of each block: MSEED by records (the
+    length of the first record), SAC by samples (the header with the
+    number of samples of the block). Other waveforms are read at once.
+    """
+
+    st_file, offset, length = waveform_span(address_st)
+    st_open = open(st_file, 'rb')
+    try:
+        st_open.seek(offset)
+        head = st_open.read(min(length, sac_head))
+        order = sac_byteorder(head, length)
+        reclen = mseed_reclen(head)
+        if order:
+            npts, = struct.unpack(order + 'i', head[316:320])
+            step = max(1, block_size // 4)
+            for i in range(0, npts, step):
+                n = min(step, npts - i)
+                st = read(io.BytesIO(head[0:316] + \
+                        struct.pack(order + 'i', n) + head[320:sac_head] + \
+                        st_open.read(4 * n)), format = 'SAC', \
+                        headonly = headonly)
+                # the begin time of the header is the one of the trace
+                for tr in st:
+                    tr.stats.starttime += i * tr.stats.delta
+                yield st
+        elif reclen:
+            step = max(1, block_size // reclen) * reclen
+            st_open.seek(offset)
+            for i in range(0, length, step):
+                yield read(io.BytesIO(st_open.read(min(step, length - i))), \
+                                    format = 'MSEED', headonly = headonly)
+        else:
+            yield waveform_read(address_st, headonly = headonly)
+    finally:
+        st_open.close()
+
+###################### waveform_trace ##################################
+
+def waveform_trace(address_st, block_size = 2**20, headonly = False):
+
+    """
+    The first trace of a waveform (waveform_read(address_st)[0]) in
+    parts of about block_size bytes (traces, one after the other):
+    the whole waveform is never in memory.
+    """
+
+    first = None
+    npts = 0
+    for st in waveform_blocks(address_st, block_size, headonly):
+        for tr in st:
+            if first is None:
+                first = tr.stats
+                trace_id = tr.id
+            # the first trace ends at a gap, an overlap or an other channel
+            index = int(round((tr.stats.starttime - first.starttime) * \
+                                                    first.sampling_rate))
+            if tr.id != trace_id or index != npts or \
+                        tr.stats.sampling_rate != first.sampling_rate:
+                return
+            npts += tr.stats.npts
+            yield tr
+
+###################### waveform_npts ###################################
+
+def waveform_npts(address_st):
+
+    """
+    Number of samples of the first trace of a waveform (as
+    waveform_read(address_st)[0].stats.npts), read by blocks
+    """
+
+    return sum([tr.stats.npts for tr in \
+                            waveform_trace(address_st, headonly = True)])
+
+###################### waveform_glob ###################################
+
+def waveform_glob(address_dir, pattern = '*.*.*.*'):
+
+    """
+    Same as glob for the waveforms of a folder, including the
+    waveforms of the volume
+    """
+
+    ls_stas = set(glob.glob(os.path.join(address_dir, pattern)))
+    for sta_id in fnmatch.filter(volume_index(address_dir).keys(), pattern):
+        ls_stas.add(os.path.join(address_dir, sta_id))
+    return sorted(ls_stas)